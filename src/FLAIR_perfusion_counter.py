@@ -18,7 +18,7 @@ import sys
 sys.path.append("..")
 
 import os
-import pydicom
+import dicom_index as di
 # from src import image_processing as ip
 
 _INSTANCE_NUMBER = (0x0020, 0x0013)
@@ -27,12 +27,7 @@ _ACQUISITION_NUMBER = (0x0020, 0x0012)
 print ("Patient No: FLAIR_COUNT PERFUSION_COUNT")
 for patient_no in range(1,19):
     direc1 = "./Patients/{0}/Perfusion".format(patient_no)
-    slice_locations = []
-    for file in os.listdir(direc1):
-        if file.endswith(".dcm"):
-            dcm = pydicom.dcmread(os.path.join(direc1, file))
-            slice_locations.append(dcm.SliceLocation)
-    slice_locations = set(slice_locations)
+    slice_locations = di.slice_locations(di.index_directory(direc1, os.cpu_count())) # header-only, and cached between runs
 
     direc2 = "./Patients/{0}/FLAIR".format(patient_no)
     FLAIR_count = 0
@@ -41,4 +36,3 @@ for patient_no in range(1,19):
             FLAIR_count += 1
 
     print (str(patient_no) + ": ", FLAIR_count, len(slice_locations))
-
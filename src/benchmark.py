@@ -0,0 +1,437 @@
+# :: benchmark.py
+#####################################################
+# Times each stage of the pipeline on synthetic
+# perfusion and FLAIR DCMs, recording wall time and
+# peak memory to a JSON report.
+#####################################################
+# :: Created By: Benji Brandt <benjibrandt@ucla.edu>,
+#                Roy Lin <rlin2k1@gmail.com>,
+#                David Macaraeg <dmacaraeg@g.ucla.edu>
+# :: Creation Date: 18 October 2026
+
+# Standard Library, whole imports
+import os
+import sys
+import argparse
+import json
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+# Standard Library, specific imports
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+# Dependency Imports
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileDataset
+try:
+    from pydicom.dataset import FileMetaDataset
+except ImportError: # pydicom < 2.0
+    FileMetaDataset = Dataset
+
+# Local Imports
+import dicom_index as di
+
+# ----------------------------------------------------------------------------
+#  Argument Parsing
+# ----------------------------------------------------------------------------
+
+parser = argparse.ArgumentParser(description="Benchmarks each stage of the pipeline on a synthetic study, writing wall times and peak memory to a JSON report.")
+
+parser.add_argument("-p", "--patients", action="store", type=int, dest="patients", default=2, help="The number of synthetic patients to generate.")
+parser.add_argument("--slices", action="store", type=int, dest="slices", default=8, help="The number of slices per perfusion acquisition.")
+parser.add_argument("--times", action="store", type=int, dest="times", default=40, help="The number of time points per perfusion slice.")
+parser.add_argument("--size", action="store", type=int, dest="size", default=128, help="The rows and columns of every synthetic image.")
+parser.add_argument("--sample-count", action="store", type=int, dest="sample_count", default=40, help="The number of intensity values to resample each voxel to, as for generate_csvs.py.")
+parser.add_argument("--nlive", action="store", type=int, dest="nlive", default=200, help="The number of surviving pixels to sample per slice, as for generate_csvs.py.")
+parser.add_argument("--ndie", action="store", type=int, dest="ndie", default=200, help="The number of dying pixels to sample per slice, as for generate_csvs.py.")
+parser.add_argument("--model", action="store", dest="model_name", default="DecisionTree", help="The model to cross-validate in the error stage, as named by classify_voxels.py.")
+parser.add_argument("--trials", action="store", type=int, dest="ntrials", default=10, help="The number of cross-validation trials in the error stage.")
+parser.add_argument("-w", "--workers", action="store", type=int, dest="workers", default=1, help="The workers (processes) given to stages which support them.")
+parser.add_argument("-r", "--repeat", action="store", type=int, dest="repeat", default=3, help="The number of times to run each stage, each in a fresh process.")
+parser.add_argument("--stages", action="store", nargs="+", dest="stages", default=None, help="The stages to run, out of: {}. Defaults to all of them.".format(", ".join(["parse_perfusion", "interpolate", "generate_csvs", "data_load", "data_load_cached", "error"])))
+parser.add_argument("--seed", action="store", type=int, dest="seed", default=0, help="The seed for generating the study, and for sampling pixels.")
+parser.add_argument("--study-dir", action="store", dest="study_dir", default=None, help="Where to generate the synthetic study. Defaults to a temporary directory, deleted afterwards.")
+parser.add_argument("-o", "--output", action="store", dest="output", default="benchmark_report.json", help="The JSON report to write.")
+parser.add_argument("--compare", action="store", dest="compare", default=None, help="A previous report to compare this run's timings against.")
+parser.add_argument("--run-stage", action="store", dest="run_stage", default=None, help=argparse.SUPPRESS) # used internally, to run a stage in a fresh interpreter
+parser.add_argument("--config", action="store", dest="config", default=None, help=argparse.SUPPRESS)
+
+# ----------------------------------------------------------------------------
+#  Constants
+# ----------------------------------------------------------------------------
+
+_MR_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.4"
+_EXPLICIT_VR_LITTLE_ENDIAN = "1.2.840.10008.1.2.1"
+_START_TIME = datetime(2019, 5, 1, 12, 0, 0)
+_SECONDS_PER_TIME_POINT = 1.5
+_SLICE_SPACING = 5.0
+
+# ----------------------------------------------------------------------------
+#  Synthetic Study
+# ----------------------------------------------------------------------------
+
+def write_synthetic_dcm(path, pixels, **attributes):
+    """
+    Writes a minimal, single-frame MR DCM which pydicom can read back with its pixel data.
+
+    :param str path: where to write the DCM.
+    :param np.ndarray pixels: a 2D array of pixels, stored as int16.
+    :param attributes: any header values to set, e.g. SliceLocation=-10.0, AcquisitionTime="120000.000000"
+    """
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = _MR_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    file_meta.TransferSyntaxUID = _EXPLICIT_VR_LITTLE_ENDIAN
+    dcm = FileDataset(path, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    dcm.is_little_endian = True
+    dcm.is_implicit_VR = False
+    dcm.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    dcm.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    dcm.Modality = "MR"
+    for attribute, value in attributes.items():
+        setattr(dcm, attribute, value)
+    dcm.Rows, dcm.Columns = pixels.shape
+    dcm.SamplesPerPixel = 1
+    dcm.PhotometricInterpretation = "MONOCHROME2"
+    dcm.BitsAllocated = 16
+    dcm.BitsStored = 16
+    dcm.HighBit = 15
+    dcm.PixelRepresentation = 1
+    dcm.PixelData = np.ascontiguousarray(pixels, dtype="<i2").tobytes()
+    dcm.save_as(path, write_like_original=False)
+
+
+def acquisition_time(seconds):
+    """
+    Formats a time, in seconds after the synthetic study's start, as a DCM AcquisitionTime.
+
+    :param float seconds:
+    :return: a time of the form HHMMSS.FFFFFF
+    :rtype: str
+    """
+    return (_START_TIME + timedelta(seconds=seconds)).strftime("%H%M%S.%f")
+
+
+def synthetic_perfusion_slice(size, times, lesion, random_state):
+    """
+    Simulates the signal of one perfusion slice over time: a disc of brain, whose signal drops as a contrast bolus passes.
+    Within the lesion, the bolus arrives later and weaker.
+
+    :param int size: the rows and columns of the slice.
+    :param int times: the number of time points.
+    :param np.ndarray lesion: a bool array of shape (size, size), True for pixels within the lesion.
+    :param np.random.RandomState random_state: the generator for the signal's noise.
+    :return: an int16 array of shape (times, size, size), zero outside of the brain.
+    :rtype: np.ndarray
+    """
+    rows, cols = np.mgrid[:size, :size]
+    brain = (rows - size / 2.0) ** 2 + (cols - size / 2.0) ** 2 < (size * 0.4) ** 2
+    t = np.arange(times, dtype=float)[:, np.newaxis, np.newaxis]
+    arrival = np.where(lesion, times * 0.35, times * 0.2)
+    depth = np.where(lesion, 60.0, 180.0)
+    delay = np.maximum(t - arrival, 0)
+    bolus = (delay / 4.5) ** 3 * np.exp(3 - delay / 1.5) # gamma variate, peaking at 1 when delay is 4.5
+    signal = 400.0 - depth * bolus + random_state.normal(0, 8.0, (times, size, size))
+    return np.where(brain, np.clip(signal, 1, None), 0).astype(np.int16)
+
+
+def generate_synthetic_study(structured_directory, patients=2, slices=8, times=40, size=128, seed=0):
+    """
+    Generates a synthetic study, structured as for generate_csvs.py, of perfusion DCMs and coregistered, labeled
+    FLAIR DCMs named and listed in a registration manifest as by register_images.py.
+
+    :param str structured_directory: the directory to write the study to.
+    :param int patients: the number of patients.
+    :param int slices: the number of slices per perfusion acquisition.
+    :param int times: the number of time points per slice.
+    :param int size: the rows and columns of every image.
+    :param int seed: the seed for the study's lesions and noise.
+    :return: the number of DCMs written.
+    :rtype: int
+    """
+    random_state = np.random.RandomState(seed)
+    rows, cols = np.mgrid[:size, :size]
+    written = 0
+    for patient in range(1, patients + 1):
+        perfusion_directory = os.path.join(structured_directory, str(patient), "Perfusion")
+        flair_directory = os.path.join(structured_directory, str(patient), "FLAIR")
+        os.makedirs(perfusion_directory, exist_ok=True)
+        os.makedirs(flair_directory, exist_ok=True)
+        flairs = []
+        center = random_state.uniform(size * 0.3, size * 0.7, 2)
+        radius = random_state.uniform(size * 0.08, size * 0.15)
+        for slc in range(slices):
+            slice_loc = (slc - slices // 2) * _SLICE_SPACING
+            # the lesion shrinks towards the ends of the stack, and vanishes on some slices
+            slice_radius = radius * (1 - abs(slc - slices / 2.0) / slices * 1.5)
+            lesion = (rows - center[0]) ** 2 + (cols - center[1]) ** 2 < max(slice_radius, 0) ** 2
+            volume = synthetic_perfusion_slice(size, times, lesion, random_state)
+            for t in range(times):
+                file_name = "IM_{:04d}_{:04d}.dcm".format(slc, t)
+                write_synthetic_dcm(os.path.join(perfusion_directory, file_name), volume[t],
+                                    SliceLocation=slice_loc, AcquisitionNumber=t + 1, AcquisitionTime=acquisition_time(t * _SECONDS_PER_TIME_POINT),
+                                    SeriesDescription="Perfusion", SeriesNumber=1)
+                written += 1
+            first_file = "IM_{:04d}_{:04d}".format(slc, 0)
+            flair = {"file": "result_{}_1_{}_{}.dcm".format(first_file, acquisition_time(0), slice_loc), "source": first_file + ".dcm",
+                     "slice_location": slice_loc, "acquisition_number": 1, "acquisition_time": acquisition_time(0)}
+            write_synthetic_dcm(os.path.join(flair_directory, flair["file"]), lesion.astype(np.int16),
+                                SliceLocation=slice_loc, AcquisitionNumber=1, AcquisitionTime=acquisition_time(0),
+                                SeriesDescription="FLAIR", SeriesNumber=2)
+            flairs.append(flair)
+            written += 1
+        di.write_registration_manifest(flair_directory, flairs)
+    return written
+
+# ----------------------------------------------------------------------------
+#  Stages
+# ----------------------------------------------------------------------------
+# Each stage is run in a fresh interpreter, so that its peak memory is its own. A stage's setup is not timed, but
+# does count towards the process' peak memory; the memory in use after setup is recorded alongside it.
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF):
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0 # bytes on macOS, kilobytes elsewhere
+
+
+def _training_csv(config):
+    """Generates patient 1's training CSV in the output directory, unless the generate_csvs stage already has."""
+    import generate_csvs as gc
+    path = os.path.join(config["output_dir"], "patient_1_training.csv")
+    if not os.path.exists(path):
+        gc.process_patient(os.path.join(config["study_dir"], "1"), "1", config["sample_count"], config["nlive"], config["ndie"],
+                           seed=config["seed"], output_dir=config["output_dir"])
+    return path
+
+
+def _setup_parse_perfusion(config):
+    import image_processing as ip
+    perfusion_directory = os.path.join(config["study_dir"], "1", "Perfusion")
+    return lambda: ip.parse_perfusion_data(perfusion_directory)
+
+
+def _setup_interpolate(config):
+    import data_processing as dp
+    import image_processing as ip
+    slice_dict = ip.parse_perfusion_data(os.path.join(config["study_dir"], "1", "Perfusion"))
+    return lambda: dp.generate_interpolations_per_slice(slice_dict)
+
+
+def _setup_generate_csvs(config):
+    import generate_csvs as gc
+    for output in os.listdir(config["output_dir"]): # CSVs are appended to, so a previous run's must go
+        if output.startswith("patient_"):
+            os.remove(os.path.join(config["output_dir"], output))
+    return lambda: gc.parse_structured_dcm_data(config["study_dir"], config["sample_count"], config["nlive"], config["ndie"],
+                                                workers=config["workers"], seed=config["seed"])
+
+
+def _setup_data_load(config):
+    import utilities
+    training_csv = _training_csv(config)
+    if os.path.exists(utilities.csv_sidecar_path(training_csv)):
+        os.remove(utilities.csv_sidecar_path(training_csv))
+    return lambda: utilities.load_model_data(training_csv, header=1, predict_col=0)
+
+
+def _setup_data_load_cached(config):
+    import utilities
+    training_csv = _training_csv(config)
+    utilities.load_model_data(training_csv, header=1, predict_col=0) # writes the sidecar, if it isn't already fresh
+    return lambda: utilities.load_model_data(training_csv, header=1, predict_col=0)
+
+
+def _setup_error(config):
+    import classify_voxels as cv
+    training = cv.load_model_data(_training_csv(config), header=1, predict_col=0)
+    clf = cv.get_models()[config["model_name"]]
+    return lambda: cv.error(clf, training.X, training.y, ntrials=config["ntrials"], n_jobs=config["workers"])
+
+
+STAGES = {
+    "parse_perfusion": ("image_processing.parse_perfusion_data", _setup_parse_perfusion),
+    "interpolate": ("data_processing.generate_interpolations_per_slice", _setup_interpolate),
+    "generate_csvs": ("generate_csvs.parse_structured_dcm_data", _setup_generate_csvs),
+    "data_load": ("utilities.Data.load", _setup_data_load),
+    "data_load_cached": ("utilities.Data.load (binary sidecar)", _setup_data_load_cached),
+    "error": ("classify_voxels.error", _setup_error),
+}
+
+
+def check_stage_result(stage, result):
+    """
+    Fails a stage whose run reported failures rather than raising them, e.g. generate_csvs' per-patient summaries, so
+    that a broken configuration never yields a timing.
+
+    :param str stage: a key of STAGES.
+    :param result: whatever the stage's timed call returned.
+    """
+    if isinstance(result, list):
+        failed = [summary for summary in result if isinstance(summary, dict) and summary.get("error") is not None]
+        if failed:
+            raise RuntimeError("Stage {} failed for patient(s): {}".format(stage, "; ".join("{}: {}".format(summary["patient"], summary["error"]) for summary in failed)))
+
+
+def run_stage(stage, config):
+    """
+    Sets up and times a single run of a stage, within the current process. Its output is discarded, once checked for
+    failures (see check_stage_result).
+
+    :param str stage: a key of STAGES.
+    :param dict config: the benchmark's configuration, as built by main.
+    :return: a dict of the form {"seconds": float, "setup_rss_mb": float, "peak_rss_mb": float, "children_peak_rss_mb": float}
+    :rtype: dict
+    """
+    os.chdir(config["output_dir"]) # generate_csvs writes into the current directory
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        timed = STAGES[stage][1](config)
+        setup_rss_mb = _peak_rss_mb()
+        start_time = time.perf_counter()
+        result = timed()
+        seconds = time.perf_counter() - start_time
+    check_stage_result(stage, result)
+    return {
+        "seconds": seconds,
+        "setup_rss_mb": setup_rss_mb,
+        "peak_rss_mb": _peak_rss_mb(),
+        "children_peak_rss_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def benchmark_stage(stage, config, repeat=3):
+    """
+    Runs a stage repeat times, each in a fresh interpreter. A subprocess, rather than a multiprocessing worker, so the
+    stage starts without a copy of this process' memory, and any process pools it starts are shut down as usual on exit.
+
+    :param str stage: a key of STAGES.
+    :param dict config: the benchmark's configuration, as built by main.
+    :param int repeat: the number of runs.
+    :return: a summary of the runs, with the best and median wall times, and the largest peak memory of any run.
+    :rtype: dict
+    """
+    runs = []
+    command = [sys.executable, os.path.abspath(__file__), "--run-stage", stage, "--config", json.dumps(config)]
+    for _ in range(repeat):
+        completed = subprocess.run(command, stdout=subprocess.PIPE, check=True)
+        runs.append(json.loads(completed.stdout.decode().strip().splitlines()[-1]))
+    seconds = [run["seconds"] for run in runs]
+    return {
+        "function": STAGES[stage][0],
+        "seconds": seconds,
+        "best_seconds": min(seconds),
+        "median_seconds": statistics.median(seconds),
+        "setup_rss_mb": max(run["setup_rss_mb"] for run in runs),
+        "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+        "children_peak_rss_mb": max(run["children_peak_rss_mb"] for run in runs),
+    }
+
+# ----------------------------------------------------------------------------
+#  Reporting
+# ----------------------------------------------------------------------------
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment_report():
+    """
+    Describes the machine and library versions a benchmark ran with, so reports are only compared like for like.
+
+    :return: a JSON-serializable dict.
+    :rtype: dict
+    """
+    import scipy
+    import sklearn
+    return {
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "scikit-learn": sklearn.__version__,
+        "pydicom": pydicom.__version__,
+    }
+
+
+def print_report(report, baseline=None):
+    """
+    Prints a table of each stage's timings and memory, with its speedup over baseline if given.
+
+    :param dict report: a report, as written by main.
+    :param dict baseline: a previous report to compare against.
+    """
+    print("{:<18} {:>10} {:>10} {:>12} {:>10}".format("Stage", "Best (s)", "Median (s)", "Peak RSS (MB)", "Speedup" if baseline else ""))
+    for stage, result in report["stages"].items():
+        speedup = ""
+        if baseline and stage in baseline.get("stages", {}):
+            speedup = "{:.2f}x".format(baseline["stages"][stage]["best_seconds"] / max(result["best_seconds"], 1e-9))
+        print("{:<18} {:>10.3f} {:>10.3f} {:>12.1f} {:>10}".format(stage, result["best_seconds"], result["median_seconds"], result["peak_rss_mb"], speedup))
+    if baseline and baseline.get("config") != report["config"]:
+        print("WARNING: the baseline was run with a different configuration, so its timings may not be comparable.")
+
+# ----------------------------------------------------------------------------
+#  Main
+# ----------------------------------------------------------------------------
+
+def main(args):
+    stages = args.stages or list(STAGES.keys())
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error("unknown stage(s): {}".format(", ".join(unknown)))
+
+    study_dir = os.path.abspath(args.study_dir) if args.study_dir else tempfile.mkdtemp(prefix="stroke_benchmark_")
+    output_dir = tempfile.mkdtemp(prefix="stroke_benchmark_outputs_")
+    config = {
+        "patients": args.patients, "slices": args.slices, "times": args.times, "size": args.size,
+        "sample_count": args.sample_count, "nlive": args.nlive, "ndie": args.ndie,
+        "model_name": args.model_name, "ntrials": args.ntrials, "workers": args.workers, "seed": args.seed,
+    }
+    try:
+        print("Generating a synthetic study of {} patients, {} slices x {} times of {}x{} pixels...".format(args.patients, args.slices, args.times, args.size, args.size))
+        start_time = time.time()
+        n_dcms = generate_synthetic_study(study_dir, args.patients, args.slices, args.times, args.size, args.seed)
+        print("Wrote {} DCMs in {:.2f} seconds".format(n_dcms, time.time() - start_time))
+
+        results = {}
+        for stage in stages:
+            print("Benchmarking {} ({} runs)...".format(STAGES[stage][0], args.repeat))
+            results[stage] = benchmark_stage(stage, dict(config, study_dir=study_dir, output_dir=output_dir), args.repeat)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        if not args.study_dir:
+            shutil.rmtree(study_dir, ignore_errors=True)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "environment": environment_report(),
+        "config": config,
+        "stages": results,
+    }
+    with open(args.output, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(report, baseline)
+    print("Wrote {}".format(args.output))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.run_stage:
+        print(json.dumps(run_stage(args.run_stage, json.loads(args.config))))
+    else:
+        main(args)
@@ -26,22 +26,87 @@ from sklearn.neighbors import NearestCentroid, KNeighborsRegressor, KNeighborsCl
 from sklearn.svm import SVC
 
 from sklearn.model_selection import train_test_split
+from sklearn.base import clone
+from sklearn.pipeline import Pipeline
 from sklearn import preprocessing
 from sklearn import metrics
 from utilities import *
+from predict_voxels import predict_in_chunks
+from instrumentation import stage
 
 import matplotlib.pyplot as plt
 import numpy as np
 from inspect import signature
 
-from joblib import dump, load
+from joblib import dump, load, Parallel, delayed
+import multiprocessing
+import multiprocessing.connection
+import signal
+import csv
+import re
+import sys
 import time
 import argparse
 
-def error(clf, X, y, ntrials=50, test_size=0.2):
+try: # Optional: Caps Each Model's BLAS/OpenMP Threads to Its CPU Budget in sweep_models
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+_SCORE_NAMES = ['f1', 'accuracy', 'precision', 'recall']
+_SCORE_LABELS = {'f1': 'F1 Score', 'accuracy': 'Accuracy', 'precision': 'Precision', 'recall': 'Recall'}
+_RESULT_COLUMNS = ['model', 'status', 'seconds'] + [split + '_' + score for score in _SCORE_NAMES for split in ['train', 'test']]
+_PATIENT_TRAINING = re.compile(r"^patient_(\d+)_training(\.csv|\.features)$") # As Written by generate_csvs.py
+
+def confusion_scores(y_true, y_pred):
+    """
+    Computes F1 Score, Accuracy, Precision and Recall from a single confusion
+    matrix, rather than one sklearn metric call (and confusion matrix) each.
+    Undefined Precision/Recall/F1 (no predicted/actual positives) are 0, as in
+    sklearn.
+
+    Args:
+        y_true (Numpy Array of Shape (n,)): True Classes (0 or 1)
+        y_pred (Numpy Array of Shape (n,)): Predicted Classes (0 or 1)
+    Returns:
+        (tuple): f1, accuracy, precision, recall -- floats in [0, 1]
+    """
+    tn, fp, fn, tp = metrics.confusion_matrix(y_true, y_pred, labels=[0, 1]).ravel()
+    accuracy = (tp + tn) / float(tn + fp + fn + tp)
+    precision = tp / float(tp + fp) if tp + fp else 0.0
+    recall = tp / float(tp + fn) if tp + fn else 0.0
+    f1 = 2 * tp / float(2 * tp + fp + fn) if tp else 0.0
+    return f1, accuracy, precision, recall
+
+def run_trial(clf, X, y, trial, test_size=0.2):
+    """
+    Fits a fresh model pipeline (see make_model_pipeline) on one random split
+    of the data, so the standardization is fitted on the training split only.
+    The split and (if the model has one) the model's random_state are both
+    seeded by trial, so a trial gives the same result no matter which process
+    runs it.
+
+    Args:
+        clf (Machine Learning Model): Classifier Model, left unfitted
+        X (Numpy Array of Shape (n,d)): Features Values, Unstandardized
+        y (Numpy Array of Shape (n,)): Target Classes
+        trial (integer): Trial Number, Used as the Seed
+        test_size (float): Fraction of the Data to Test On
+    Returns:
+        (tuple): train f1, accuracy, precision, recall, then the same for test
+    """
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=trial)
+    pipeline = make_model_pipeline(clone(clf))
+    if 'random_state' in clf.get_params():
+        pipeline.set_params(model__random_state=trial)
+    pipeline.fit(X_train, y_train)
+    return confusion_scores(y_train, pipeline.predict(X_train)) + confusion_scores(y_test, pipeline.predict(X_test))
+
+def error(clf, X, y, ntrials=50, test_size=0.2, n_jobs=1, return_trials=False):
     """
     Computes the classifier error over a random split of the data, averaged over
-    ntrials runs.
+    ntrials runs. Trials are run concurrently over n_jobs processes, and are
+    deterministic (see run_trial).
 
     Ntrials is Default at 50 Runs
     Train Size is Default at 80% Test 20%
@@ -51,54 +116,367 @@ def error(clf, X, y, ntrials=50, test_size=0.2):
         X (Numpy Array of Shape (n,d)): Features Values
         y (Numpy Array of Shape (n,)): Target Classes
         ntrials (integer): Number of Trials
+        n_jobs (integer): Number of Processes to Run Trials In. -1 Uses All Cores
+        return_trials (boolean): Whether to Also Return Per-Trial Scores
     Returns:
         (type): Description of return value(s)
-        train_error -- float, training error
-        test_error  -- float, test error
+        train_f1_error, test_f1_error, train_accuracy, test_accuracy,
+        train_precision, test_precision, train_recall, test_recall -- floats,
+            means over all trials, as percentages
+        trials -- only if return_trials, dict of the form
+            {'train_f1': Numpy Array of Shape (ntrials,), 'test_f1': ..., ...},
+            per-trial scores as percentages
     """
     # ------------------------------------------------------------------------ #
     # Computes Cross - Validation Error Over N Trials
     # ------------------------------------------------------------------------ #
-    train_f1_error = 0
-    test_f1_error = 0
-    
-    train_accuracy = 0
-    test_accuracy = 0
+    with stage("classify_voxels.error", model=type(clf).__name__, n_jobs=n_jobs) as s:
+        results = Parallel(n_jobs=n_jobs)(delayed(run_trial)(clf, X, y, trial, test_size) for trial in range(ntrials))
+        s.count(trials=ntrials, rows=len(y))
+    results = np.array(results) * 100 # Shape (ntrials, 8)
+
+    trials = {}
+    for i, split in enumerate(['train', 'test']):
+        for j, score in enumerate(_SCORE_NAMES):
+            trials[split + '_' + score] = results[:, i * len(_SCORE_NAMES) + j]
+    trials['train_f1'] = np.round(trials['train_f1'], 0) # F1 Scores Were Always Rounded to 2 Places Per Trial
+    trials['test_f1'] = np.round(trials['test_f1'], 0)
+
+    means = tuple(trials[split + '_' + score].mean() for score in _SCORE_NAMES for split in ['train', 'test'])
+    if return_trials:
+        return means + (trials,)
+    return means
+
+def load_patient_blocks(directory, header=1, predict_col=0):
+    """
+    Loads each patient's training data in directory (patient_{n}_training.csv
+    or .features, as from generate_csvs.py) once, as its own block. Feature
+    stores and CSVs' binary sidecars are memory-mapped (see utilities.Data),
+    so blocks are only read from disk as folds touch them.
+
+    Args:
+        directory (string): Path to the Directory of Training Data
+        header (integer): Number of Header Lines in Each CSV
+        predict_col (integer): Column Holding the Labels
+    Returns:
+        (dictionary): Patient Number -> (X, y), Ordered by Patient Number
+    """
+    paths = {}
+    for file in sorted(os.listdir(directory), key=lambda file: file.endswith('.features')): # Feature Stores Win Over CSVs
+        match = _PATIENT_TRAINING.match(file)
+        if match:
+            paths[int(match.group(1))] = os.path.abspath(os.path.join(directory, file))
+    if not paths:
+        raise ValueError("No patient_{n}_training.csv or .features Files Found in " + directory)
+    blocks = {}
+    for patient in sorted(paths):
+        data = load_model_data(paths[patient], header=header, predict_col=predict_col)
+        blocks[patient] = (data.X, data.y)
+    return blocks
+
+def patient_folds(blocks, n_folds=None):
+    """
+    Splits the patients into folds for grouped cross-validation, so that no
+    patient's voxels are ever both trained and tested on in the same fold.
+    With n_folds None, each patient is its own fold (leave-one-patient-out);
+    otherwise, as in sklearn's GroupKFold, patients are assigned largest first
+    to whichever fold has the fewest voxels so far.
+
+    Args:
+        blocks (dictionary): Patient Number -> (X, y), as From load_patient_blocks
+        n_folds (integer): Number of Folds, or None for One Per Patient
+    Returns:
+        (list): Per Fold, the List of Patients to Test On
+    """
+    patients = list(blocks)
+    if len(patients) < 2:
+        raise ValueError("Grouped Cross-Validation Needs At Least 2 Patients, Found " + str(len(patients)))
+    if n_folds is None or n_folds >= len(patients):
+        return [[patient] for patient in patients]
+    if n_folds < 2:
+        raise ValueError("Grouped Cross-Validation Needs At Least 2 Folds, Got " + str(n_folds))
+    folds = [[] for _ in range(n_folds)]
+    fold_sizes = np.zeros(n_folds)
+    for patient in sorted(patients, key=lambda patient: -len(blocks[patient][1])):
+        fold = int(np.argmin(fold_sizes))
+        folds[fold].append(patient)
+        fold_sizes[fold] += len(blocks[patient][1])
+    return [sorted(fold) for fold in folds]
+
+def run_fold(clf, blocks, test_patients, fold):
+    """
+    Fits a fresh model pipeline (see make_model_pipeline) on every patient's
+    block but test_patients', and tests it on theirs. The blocks are joined
+    with one concatenation per split; nothing is re-read. The standardization
+    is fitted on the training patients only. As in run_trial, the model's
+    random_state (if it has one) is seeded by fold.
+
+    Args:
+        clf (Machine Learning Model): Classifier Model, left unfitted
+        blocks (dictionary): Patient Number -> (X, y), as From load_patient_blocks
+        test_patients (list): Patients to Test On
+        fold (integer): Fold Number, Used as the Seed
+    Returns:
+        (tuple): train f1, accuracy, precision, recall, then the same for test
+    """
+    train_patients = [patient for patient in blocks if patient not in test_patients]
+    X_train = np.concatenate([blocks[patient][0] for patient in train_patients])
+    y_train = np.concatenate([blocks[patient][1] for patient in train_patients])
+    X_test = np.concatenate([blocks[patient][0] for patient in test_patients])
+    y_test = np.concatenate([blocks[patient][1] for patient in test_patients])
+    pipeline = make_model_pipeline(clone(clf))
+    if 'random_state' in clf.get_params():
+        pipeline.set_params(model__random_state=fold)
+    pipeline.fit(X_train, y_train)
+    return confusion_scores(y_train, pipeline.predict(X_train)) + confusion_scores(y_test, pipeline.predict(X_test))
+
+def grouped_error(clf, blocks, n_folds=None, n_jobs=1, return_folds=False):
+    """
+    Computes the classifier error by patient-grouped cross-validation (see
+    patient_folds), averaged over the folds. Unlike error, a patient's voxels
+    are never in both the training and test data. Folds are run concurrently
+    over n_jobs processes.
+
+    Args:
+        clf (Machine Learning Model): Classifier Model
+        blocks (dictionary): Patient Number -> (X, y), as From load_patient_blocks
+        n_folds (integer): Number of Folds, or None for Leave-One-Patient-Out
+        n_jobs (integer): Number of Processes to Run Folds In. -1 Uses All Cores
+        return_folds (boolean): Whether to Also Return Per-Fold Scores
+    Returns:
+        train_f1_error, test_f1_error, train_accuracy, test_accuracy,
+        train_precision, test_precision, train_recall, test_recall -- floats,
+            means over all folds, as percentages, in the same order as error
+        folds -- only if return_folds, dict of the form
+            {'test_patients': [[...], ...], 'train_f1': Numpy Array of Shape (n_folds,), ...},
+            per-fold scores as percentages
+    """
+    test_patients = patient_folds(blocks, n_folds)
+    with stage("classify_voxels.grouped_error", model=type(clf).__name__, n_jobs=n_jobs) as s:
+        results = Parallel(n_jobs=n_jobs)(delayed(run_fold)(clf, blocks, patients, fold) for fold, patients in enumerate(test_patients))
+        s.count(folds=len(test_patients), rows=sum(len(y) for _, y in blocks.values()))
+    results = np.array(results) * 100 # Shape (n_folds, 8)
+
+    folds = {'test_patients': test_patients}
+    for i, split in enumerate(['train', 'test']):
+        for j, score in enumerate(_SCORE_NAMES):
+            folds[split + '_' + score] = results[:, i * len(_SCORE_NAMES) + j]
+
+    means = tuple(folds[split + '_' + score].mean() for score in _SCORE_NAMES for split in ['train', 'test'])
+    if return_folds:
+        return means + (folds,)
+    return means
+
+def _evaluate_model(connection, clf, X, y, ntrials, n_jobs, blocks=None, n_folds=None):
+    """
+    Runs error (or with blocks, grouped_error) in one of sweep_models'
+    processes, and sends back ('ok', Scores) or ('error', Message).
+    """
+    if hasattr(os, 'setsid'):
+        os.setsid() # Leads a Process Group, So _stop_model Also Stops Joblib's Workers
+    if threadpool_limits is not None and n_jobs > 0:
+        threadpool_limits(limits=n_jobs)
+    try:
+        if blocks is not None:
+            scores = grouped_error(clf, blocks, n_folds=n_folds, n_jobs=n_jobs)
+        else:
+            scores = error(clf, X, y, ntrials=ntrials, n_jobs=n_jobs)
+        result = ('ok', [float(score) for score in scores])
+    except Exception as e:
+        result = ('error', repr(e))
+    connection.send(result)
+    connection.close()
+
+def _stop_model(process):
+    """
+    Stops one of sweep_models' processes, along with any worker processes it started.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except (AttributeError, OSError): # No Process Groups, or None Left Running
+        process.terminate()
+    process.join()
 
-    train_precision = 0
-    test_precision = 0
+def sweep_models(models, X, y, ntrials=50, n_jobs=1, max_models=1, timeout=None, on_result=None, blocks=None, n_folds=None):
+    """
+    Computes the classifier error (see error, or with blocks, grouped_error)
+    of every model, running up to max_models of them at a time. Each model runs
+    in its own process, with its trials run over n_jobs processes, so at most
+    max_models * n_jobs cores are busy. A model still running after timeout seconds is terminated, so one slow
+    model (e.g. SVC) doesn't hold up the rest.
 
-    train_recall = 0
-    test_recall = 0
+    Args:
+        models (dictionary): Model Names to Classifier Models, as From get_models
+        X (Numpy Array of Shape (n,d)): Features Values
+        y (Numpy Array of Shape (n,)): Target Classes
+        ntrials (integer): Number of Trials Per Model
+        n_jobs (integer): Number of Processes to Run Each Model's Trials In
+        max_models (integer): Number of Models to Run at Once
+        timeout (float): Seconds Each Model May Run For. None Waits Indefinitely
+        on_result (function): Called With Each Result As Soon As Its Model Finishes
+        blocks (dictionary): If Given, Patient Number -> (X, y) Blocks to Cross-Validate By Patient On, Instead of X and y
+        n_folds (integer): With blocks, Number of Folds, or None for Leave-One-Patient-Out
+    Returns:
+        (list): Results, in the Order the Models Finished, of the form
+            {'model': name, 'status': 'ok' | 'error' | 'timeout', 'seconds': float,
+             'train_f1': float, 'test_f1': float, ..., 'test_recall': float}
+            where the scores are as returned by error, and only present if
+            status is 'ok'; otherwise 'message' says what went wrong
+    """
+    pending = list(models.items())
+    running = {} # Receiving End of Each Model's Pipe -> (Model Name, Process, Start Time)
+    results = []
+
+    def finish(connection, status, payload):
+        name, process, start_time = running.pop(connection)
+        connection.close()
+        process.join(1) # Joblib's Workers Can Hold Up the Process' Exit After It Has Sent Its Scores
+        _stop_model(process)
+        result = {'model': name, 'status': status, 'seconds': time.time() - start_time}
+        if status == 'ok':
+            result.update(zip(_RESULT_COLUMNS[3:], payload))
+        else:
+            result['message'] = payload
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+
+    while pending or running:
+        while pending and len(running) < max_models:
+            name, clf = pending.pop(0)
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_evaluate_model, args=(sender, clf, X, y, ntrials, n_jobs, blocks, n_folds))
+            process.start()
+            sender.close() # So recv Raises EOFError If the Process Dies Without Sending
+            running[receiver] = (name, process, time.time())
+
+        wait_time = None
+        if timeout is not None:
+            wait_time = max(0, min(start_time for _, _, start_time in running.values()) + timeout - time.time())
+        for connection in multiprocessing.connection.wait(list(running), wait_time):
+            try:
+                status, payload = connection.recv()
+            except EOFError:
+                status, payload = 'error', "Exited With Code " + str(running[connection][1].exitcode)
+            finish(connection, status, payload)
+
+        if timeout is not None:
+            for connection, (name, process, start_time) in list(running.items()):
+                if time.time() - start_time >= timeout:
+                    _stop_model(process)
+                    finish(connection, 'timeout', "Took Longer Than " + str(timeout) + " Seconds")
+    return results
+
+def get_models():
+    """
+    Builds a fresh, unfitted instance of every supported model.
+
+    Returns:
+        (dict): Model Name to Classifier Model
+    """
+    return {
+        'BaggingClassifier':BaggingClassifier(n_estimators=20),
+        'GradientBoostingClassifier':GradientBoostingClassifier(n_estimators=300, max_depth=6, loss='exponential'),
+        'LogisticRegression':linear_model.LogisticRegression(solver='lbfgs'),
+        'MLPClassifier_ActivationIdentity':MLPClassifier(activation='identity'),
+        'MLPClassifier_ActivationLogistic':MLPClassifier(activation='logistic', max_iter=400),
+        'MLPClassifier_TanH':MLPClassifier(activation='tanh', max_iter=1000),
+        'MLPClassifier_Relu':MLPClassifier(activation='relu', max_iter=1000),
+        'NearestCentroid':NearestCentroid(),
+        'KNeighborsClassifier':KNeighborsClassifier(n_neighbors=5, weights='distance'),
+        'DecisionTree':DecisionTreeClassifier(max_depth=None),
+        'RandomForest':RandomForestClassifier(n_estimators=30),
+        'ExtraTreesClassifier':ExtraTreesClassifier(n_estimators=30),
+        'StochasticGradientDescent_Hinge':linear_model.SGDClassifier(loss='hinge', max_iter=1000, tol=1e-3),
+        'StochasticGradientDescent_Log':linear_model.SGDClassifier(loss='log', max_iter=1000, tol=1e-3),
+        'StochasticGradientDescent_Perceptron':linear_model.SGDClassifier(loss='perceptron', max_iter=1000, tol=1e-3),
+        'StochasticGradientDescent_ModifiedHuber':linear_model.SGDClassifier(loss='modified_huber', max_iter=1000, tol=1e-3),
+        'StochasticGradientDescent_SquaredHinge':linear_model.SGDClassifier(loss='squared_hinge', max_iter=1000, tol=1e-3),
+        'SupportVectorMachine_RBFKernel':SVC(kernel='rbf', gamma='scale'),
+        'SupportVectorMachine_SigmoidKernel':SVC(kernel='sigmoid', gamma='scale')
+    }
 
-    for trial in range(ntrials):
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=trial)
-        clf.fit(X_train, y_train)
-        y_pred_train = clf.predict(X_train)
-        y_pred_test = clf.predict(X_test)
+def make_model_pipeline(clf):
+    """
+    Wraps a classifier in a pipeline which standardizes its input first, so the
+    scaler's fitted statistics travel with the model when it is dumped.
 
-        train_f1_error = train_f1_error + round(metrics.f1_score(y_train, y_pred_train), 2)
-        test_f1_error = test_f1_error + round(metrics.f1_score(y_test, y_pred_test), 2)
+    Args:
+        clf (Machine Learning Model): Classifier Model
+    Returns:
+        (Pipeline): Pipeline of Steps 'scaler' (StandardScaler) and 'model' (clf)
+    """
+    return Pipeline([('scaler', preprocessing.StandardScaler()), ('model', clf)])
 
-        train_accuracy = train_accuracy + metrics.accuracy_score(y_train, y_pred_train, normalize = True)
-        test_accuracy = test_accuracy + metrics.accuracy_score(y_test, y_pred_test, normalize = True)
+def supports_streaming(clf):
+    """
+    Whether a classifier can be trained a chunk at a time, by fit_streaming.
 
-        train_precision = train_precision + metrics.precision_score(y_train, y_pred_train)
-        test_precision = test_precision + metrics.precision_score(y_test, y_pred_test)
+    Args:
+        clf (Machine Learning Model): Classifier Model
+    Returns:
+        (boolean): True if the Model Has partial_fit (e.g. SGDClassifier, MLPClassifier)
+    """
+    return hasattr(clf, 'partial_fit')
 
-        train_recall = train_recall + metrics.recall_score(y_train, y_pred_train)
-        test_recall = test_recall + metrics.recall_score(y_test, y_pred_test)
+def fit_streaming(clf, training_csv, chunk_size=100000, epochs=5, header=1, predict_col=0, seed=0):
+    """
+    Trains a model pipeline (see make_model_pipeline) one chunk of training_csv
+    at a time, so the training data is never held in memory all at once. The
+    first pass accumulates the scaler's running mean and variance, and the
+    classes; each of the next epochs passes feeds every chunk, standardized and
+    shuffled, to the model's partial_fit.
 
-    train_f1_error = train_f1_error/float(ntrials) * 100
-    test_f1_error = test_f1_error/float(ntrials) * 100
-    train_accuracy = train_accuracy/float(ntrials) * 100
-    test_accuracy = test_accuracy/float(ntrials) * 100
-    train_precision = train_precision/float(ntrials) * 100
-    test_precision = test_precision/float(ntrials) * 100
-    train_recall = train_recall/float(ntrials) * 100
-    test_recall = test_recall/float(ntrials) * 100
+    Args:
+        clf (Machine Learning Model): Classifier Model With partial_fit
+        training_csv (string): Path to the Training CSV (or Feature Store)
+        chunk_size (integer): Number of Rows Per Chunk
+        epochs (integer): Number of Passes Over the Data to Train the Model With
+        header (integer): Number of Header Lines in training_csv
+        predict_col (integer): Column Holding the Labels
+        seed (integer): Seed for Shuffling Each Chunk
+    Returns:
+        (Pipeline): Fitted Pipeline of Steps 'scaler' and 'model'
+        (integer): Number of Training Rows
+    """
+    pipeline = make_model_pipeline(clf)
+    scaler = pipeline.named_steps['scaler']
+    model = pipeline.named_steps['model']
+
+    n = 0
+    classes = np.array([])
+    for X_chunk, y_chunk in iter_training_chunks(training_csv, chunk_size, header=header, predict_col=predict_col):
+        scaler.partial_fit(X_chunk)
+        classes = np.union1d(classes, y_chunk)
+        n += len(y_chunk)
+
+    random_state = np.random.RandomState(seed)
+    for epoch in range(epochs):
+        for X_chunk, y_chunk in iter_training_chunks(training_csv, chunk_size, header=header, predict_col=predict_col):
+            order = random_state.permutation(len(y_chunk)) # Rows Are Grouped by Label Within a Slice
+            model.partial_fit(scaler.transform(X_chunk)[order], np.asarray(y_chunk)[order], classes=classes)
+    return pipeline, n
+
+def streaming_f1_score(pipeline, training_csv, chunk_size=100000, header=1, predict_col=0):
+    """
+    Computes a fitted pipeline's F1 score on training_csv, one chunk at a time.
 
-    return train_f1_error, test_f1_error, train_accuracy, test_accuracy, train_precision, test_precision, train_recall, test_recall
+    Args:
+        pipeline (Pipeline): Fitted Pipeline
+        training_csv (string): Path to the Training CSV (or Feature Store)
+        chunk_size (integer): Number of Rows Per Chunk
+        header (integer): Number of Header Lines in training_csv
+        predict_col (integer): Column Holding the Labels
+    Returns:
+        (float): F1 Score, Treating 1 as the Positive Class
+    """
+    tp = fp = fn = 0
+    for X_chunk, y_chunk in iter_training_chunks(training_csv, chunk_size, header=header, predict_col=predict_col):
+        y_pred = pipeline.predict(X_chunk)
+        tp += np.sum((y_pred == 1) & (y_chunk == 1))
+        fp += np.sum((y_pred == 1) & (y_chunk != 1))
+        fn += np.sum((y_pred != 1) & (y_chunk == 1))
+    return 2 * tp / float(2 * tp + fp + fn) if tp else 0.0
 
 def autolabel(ax, rects, xpos='center'):
     """
@@ -205,84 +583,79 @@ def main():
     'StochasticGradientDescent_SquaredHinge',
     'SupportVectorMachine_RBFKernel',
     'SupportVectorMachine_SigmoidKernel', 'Analyze', 'DeveloperChosen'], help="The identifier to indicate which model to test and train on.")
+
+    parser.add_argument("-c", "--chunk-size", action="store", type=int, default=100000, dest="chunk_size", help="The number of voxels of prediction_csv to read, predict and write at a time, which bounds memory usage.")
+
+    parser.add_argument("-j", "--jobs", action="store", type=int, default=1, help="The number of processes to run cross-validation trials (or with --patients, folds) in. -1 uses all cores.")
+
+    parser.add_argument("-m", "--parallel-models", action="store", type=int, default=1, dest="parallel_models", help="The number of models to run at once, for the 'All' option. Each uses --jobs cores.")
+
+    parser.add_argument("-t", "--timeout", action="store", type=float, default=None, help="The number of seconds each model may run for, for the 'All' option, before it's stopped and recorded as timed out.")
+
+    parser.add_argument("-p", "--patients", action="store", default=None, help="Evaluate by patient-grouped cross-validation over the patient_{n}_training.csv (or .features) files in this directory, so no patient is both trained and tested on, instead of by random splits of training_csv. For the 'All' option, this replaces training_csv's 50 trials; otherwise, it's reported before training on training_csv.")
+
+    parser.add_argument("-k", "--folds", action="store", type=int, default=None, help="With --patients, the number of folds to group the patients into. Defaults to one per patient (leave-one-patient-out).")
+
+    parser.add_argument("-s", "--stream", action="store_true", default=False, help="Train the model a chunk (of --chunk-size rows) at a time, without loading training_csv into memory. Only for models with partial_fit: the StochasticGradientDescent and MLPClassifier models.")
+
+    parser.add_argument("-e", "--epochs", action="store", type=int, default=5, help="The number of passes over training_csv to train with, for --stream.")
     
     args = parser.parse_args()
 
-    models = {
-        'BaggingClassifier':BaggingClassifier(n_estimators=20),
-        'GradientBoostingClassifier':GradientBoostingClassifier(n_estimators=300, max_depth=6, loss='exponential'),
-        'LogisticRegression':linear_model.LogisticRegression(solver='lbfgs'),
-        'MLPClassifier_ActivationIdentity':MLPClassifier(activation='identity'),
-        'MLPClassifier_ActivationLogistic':MLPClassifier(activation='logistic', max_iter=400),
-        'MLPClassifier_TanH':MLPClassifier(activation='tanh', max_iter=1000),
-        'MLPClassifier_Relu':MLPClassifier(activation='relu', max_iter=1000),
-        'NearestCentroid':NearestCentroid(),
-        'KNeighborsClassifier':KNeighborsClassifier(n_neighbors=5, weights='distance'),
-        'DecisionTree':DecisionTreeClassifier(max_depth=None),
-        'RandomForest':RandomForestClassifier(n_estimators=30),
-        'ExtraTreesClassifier':ExtraTreesClassifier(n_estimators=30),
-        'StochasticGradientDescent_Hinge':linear_model.SGDClassifier(loss='hinge', max_iter=1000, tol=1e-3),
-        'StochasticGradientDescent_Log':linear_model.SGDClassifier(loss='log', max_iter=1000, tol=1e-3),
-        'StochasticGradientDescent_Perceptron':linear_model.SGDClassifier(loss='perceptron', max_iter=1000, tol=1e-3),
-        'StochasticGradientDescent_ModifiedHuber':linear_model.SGDClassifier(loss='modified_huber', max_iter=1000, tol=1e-3),
-        'StochasticGradientDescent_SquaredHinge':linear_model.SGDClassifier(loss='squared_hinge', max_iter=1000, tol=1e-3),
-        'SupportVectorMachine_RBFKernel':SVC(kernel='rbf', gamma='scale'),
-        'SupportVectorMachine_SigmoidKernel':SVC(kernel='sigmoid', gamma='scale')
-    }
+    models = get_models()
+
+    if args.stream and (args.model_name not in models or not supports_streaming(models[args.model_name])):
+        parser.error("--stream needs a model with partial_fit, one of: " + ", ".join(name for name, clf in models.items() if supports_streaming(clf)))
 
     # ------------------------------------------------------------------------ #
     # Load Stroke-MRI DataSet
     # ------------------------------------------------------------------------ #
-    stroke_train = load_model_data(args.training_csv, header=1, predict_col=0)
-    X_train = stroke_train.X;
-    X_train_name = stroke_train.Xnames
-    y_train = stroke_train.y;
-    y_train_name = stroke_train.yname
-
-    n,d = X_train.shape # n = Number of Examples, d = Number of Features
-
-    normalized_X_train = preprocessing.scale(X_train)
+    if args.patients:
+        with stage("classify_voxels.load_patient_blocks") as s:
+            blocks = load_patient_blocks(args.patients, header=1, predict_col=0)
+            s.count(patients=len(blocks), rows=sum(len(y) for _, y in blocks.values()))
+        evaluation = "Leave-One-Patient-Out" if args.folds is None or args.folds >= len(blocks) else str(args.folds) + "-Fold Patient-Grouped"
+        print("Cross-Validating", evaluation, "Over", len(blocks), "Patients")
+    else:
+        blocks = None
+
+    if not args.stream and not (args.model_name == 'All' and blocks is not None): # Streaming Reads the Data a Chunk at a Time Instead
+        with stage("classify_voxels.load_training") as s:
+            stroke_train = load_model_data(args.training_csv, header=1, predict_col=0)
+            s.count(rows=len(stroke_train.y))
+        X_train = stroke_train.X;
+        X_train_name = stroke_train.Xnames
+        y_train = stroke_train.y;
+        y_train_name = stroke_train.yname
+
+        n,d = X_train.shape # n = Number of Examples, d = Number of Features
 
     if(args.model_name != 'All'):
-        stroke_test = load_model_test(args.prediction_csv, header=1, predict_col=3)
-        X_test = stroke_test.X;
-        X_test_name = stroke_test.Xnames
-        y_test = stroke_test.y;
-        y_test_name = stroke_test.yname
-
-        n,d = X_test.shape # n = Number of Examples, d = Number of Features
-
-        normalized_X_test = preprocessing.scale(X_test)
-
         print("Classifying using Sci-Kit Learn:",args.model_name,"Classifier")
-        clf = models[args.model_name]
-        clf.fit(normalized_X_train, y_train) #Full Model Training
-        y_pred_train = clf.predict(normalized_X_train)
-        train_error = metrics.f1_score(y_train, y_pred_train)
-        dump(clf, args.model_name + '.joblib')
+        if blocks is not None:
+            scores = grouped_error(models[args.model_name], blocks, n_folds=args.folds, n_jobs=args.jobs)
+            for i, score in enumerate(_SCORE_NAMES):
+                print(args.model_name, evaluation, "Training " + _SCORE_LABELS[score] + ":", str(scores[2 * i]))
+                print(args.model_name, evaluation, "Testing " + _SCORE_LABELS[score] + ":", str(scores[2 * i + 1]))
+        if args.stream:
+            with stage("classify_voxels.fit_streaming", model=args.model_name, epochs=args.epochs) as s:
+                pipeline, n = fit_streaming(models[args.model_name], args.training_csv, chunk_size=args.chunk_size, epochs=args.epochs)
+                s.count(rows=n)
+            train_error = streaming_f1_score(pipeline, args.training_csv, chunk_size=args.chunk_size)
+        else:
+            pipeline = make_model_pipeline(models[args.model_name])
+            with stage("classify_voxels.fit", model=args.model_name) as s:
+                pipeline.fit(X_train, y_train) #Full Model Training, Test Data Is Standardized With the Training Data's Statistics
+                s.count(rows=n)
+            y_pred_train = pipeline.predict(X_train)
+            train_error = metrics.f1_score(y_train, y_pred_train)
+        dump(pipeline, args.model_name + '.joblib') # Reload With predict_voxels.py to Predict Without the Training Data
         print(args.model_name, "Training F1 Score:",str(train_error))
 
-        y_pred_test = clf.predict(normalized_X_test)
-
         filename = args.model_name + ".csv"
-        if os.path.exists(filename):
-            try:
-                os.remove(filename)
-            except:
-                print("Could Not Remove", filename, "Insufficient Permissions")
-                sys.exit(1)
-            log = open(filename, "w+")
-
-        for i in range(len(y_test)): #How Many DataPoints
-            log.write(str(y_test[i][0])+','+str(y_test[i][1])+','+str(y_test[i][2])+','+str(y_pred_test[i])+'\n')
+        n = predict_in_chunks(pipeline, args.prediction_csv, filename, chunk_size=args.chunk_size)
+        print("Wrote", n, "Predictions to", filename)
     else: # Run Through ALL
-        # -------------------------------------------------------------------- #
-        # Plotting SetUp
-        # -------------------------------------------------------------------- #
-        train_f1_score = []
-        test_f1_score = []
-        model_names = []
-        #-----------------------------------------------------------------------
         filename = "model_analysis.csv"
         if os.path.exists(filename):
             try:
@@ -290,57 +663,39 @@ def main():
             except:
                 print("Could Not Remove",filename,"Insufficient Permissions")
                 sys.exit(1)
-        log = open(filename, "w+")
+        table = open(filename, "w", newline='')
+        writer = csv.DictWriter(table, fieldnames=_RESULT_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        table.flush()
+
+        def report(result):
+            writer.writerow(result) # Each Model's Row Is Written As Soon As It Finishes
+            table.flush()
+            key = result['model']
+            print("Classified using Sci-Kit Learn:", key, "Classifier")
+            print("TOOK", str(result['seconds']), "To Train")
+            if result['status'] != 'ok':
+                print(key, result['status'].upper() + ":", result['message'])
+            for score in _SCORE_NAMES:
+                if result['status'] == 'ok':
+                    print(key, "Training " + _SCORE_LABELS[score] + ":", str(result['train_' + score]))
+                    print(key, "Testing " + _SCORE_LABELS[score] + ":", str(result['test_' + score]))
+            print("-----------------------------------------------------------")
+            sys.stdout.flush()
 
         print("Testing All Classifiers")
-        for key, value in models.items():
-            print("Classifying using Sci-Kit Learn:",key,"Classifier")
-            log.write("Classifying using Sci-Kit Learn:" + ' ' + key + ' ' + "Classifier\n")
-            log.flush()
-            clf = value
-
-            start_time = time.time()
-            training_f1_error, testing_f1_error, train_accuracy, test_accuracy, train_precision, test_precision, train_recall, test_recall = error(clf, normalized_X_train, y_train)
-            print("TOOK", str(time.time() - start_time), "To Train")
-            log.write("TOOK " + str(time.time() - start_time) + " " + "To Train" + '\n')
-            log.flush()
-
-            print(key, "Training F1 Score:",str(training_f1_error))
-            log.write(key + ' ' + "F1 Score:" + ' ' + str(training_f1_error) + '\n')
-            log.flush()
-            print(key, "Testing F1 Score: " + str(testing_f1_error))
-            log.write(key + ' ' + "Testing F1 Score: " + ' ' + str(testing_f1_error) + '\n')
-            log.flush()
-
-            print(key, "Training Accuracy:",str(train_accuracy))
-            log.write(key + ' ' + "Training Accuracy:" + ' ' + str(train_accuracy) + '\n')
-            log.flush()
-            print(key, "Testing Accuracy: " + str(test_accuracy))
-            log.write(key + ' ' + "Testing Accuracy: " + ' ' + str(test_accuracy) + '\n')
-            log.flush()
-
-            print(key, "Training Precision:",str(train_precision))
-            log.write(key + ' ' + "Training Precision:" + ' ' + str(train_precision) + '\n')
-            log.flush()
-            print(key, "Testing Precision: " + str(test_precision))
-            log.write(key + ' ' + "Testing Precision: " + ' ' + str(test_precision) + '\n')
-            log.flush()
-
-            print(key, "Training Recall:",str(train_recall))
-            log.write(key + ' ' + "Training Recall:" + ' ' + str(train_recall) + '\n')
-            log.flush()
-            print(key, "Testing Recall: " + str(test_recall))
-            log.write(key + ' ' + "Testing Recall: " + ' ' + str(test_recall) + '\n')
-            log.flush()
-                
-            print("-----------------------------------------------------------")
-            log.write("-----------------------------------------------------------\n")
-            log.flush()
-            train_f1_score.append(training_f1_error)
-            test_f1_score.append(testing_f1_error)
-            model_names.append(key)
+        results = sweep_models(models, X_train if blocks is None else None, None if blocks is not None else y_train, n_jobs=args.jobs, max_models=args.parallel_models, timeout=args.timeout, on_result=report, blocks=blocks, n_folds=args.folds)
+        table.close()
+
+        # -------------------------------------------------------------------- #
+        # Plotting, in the Order of get_models
+        # -------------------------------------------------------------------- #
+        finished = {result['model']: result for result in results if result['status'] == 'ok'}
+        model_names = [key for key in models if key in finished]
+        train_f1_score = [finished[key]['train_f1'] for key in model_names]
+        test_f1_score = [finished[key]['test_f1'] for key in model_names]
 
-        plot_train_test(train_f1_error, test_f1_error, model_names)
+        plot_train_test(train_f1_score, test_f1_score, model_names)
         plt.savefig('plot.png')
 
 if __name__ == "__main__":
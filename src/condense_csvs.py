@@ -0,0 +1,281 @@
+# :: condense_csvs.py
+#####################################################
+# Condenses every patient's training CSV into one data
+# set, with a fixed number of feature columns, in a
+# single streaming pass over each CSV. Replaces the
+# text pipelines of verify-csvs.sh.
+#####################################################
+# :: Created By: Benji Brandt <benjibrandt@ucla.edu>,
+#                Roy Lin <rlin2k1@gmail.com>,
+#                David Macaraeg <dmacaraeg@g.ucla.edu>
+# :: Creation Date: 18 October 2026
+
+# Standard Library, whole imports
+import os
+import argparse
+import csv
+import re
+import shutil
+import tempfile
+
+# Standard Library, specific imports
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+# Dependency Imports
+import numpy as np
+
+# Local Imports
+from utilities import parse_csv_text
+
+# ----------------------------------------------------------------------------
+#  Argument Parsing
+# ----------------------------------------------------------------------------
+
+parser = argparse.ArgumentParser(description="Reports the column counts of each patient's training CSV, and optionally condenses them into one CSV or binary array, with a fixed number of feature columns.")
+parser.add_argument("directory_name", action="store", help="The directory containing the patient_{n}_training.csv files.")
+parser.add_argument("-n", "--normalize", action="store", type=int, dest="n_features", default=None, help="Condense the CSVs into one, truncating or padding every row to this many feature columns (after the label). Without this, column counts are only reported.")
+parser.add_argument("-o", "--output", action="store", dest="output", default=None, help="The file to condense into. Defaults to condensed.csv (or condensed.npy) in directory_name.")
+parser.add_argument("-f", "--format", action="store", dest="output_format", choices=["csv", "npy"], default="csv", help="Condense into a CSV, or into a binary .npy array (label, then features) which classify_voxels.py memory-maps instead of parsing.")
+parser.add_argument("-b", "--background-remove", action="store", type=float, nargs="?", const=30.0, dest="background", default=None, help="Drop rows with any feature at or below this value (default: 30), as background.")
+parser.add_argument("-i", "--ignore", action="store", type=int, dest="skip", default=1, help="The number of header lines to skip in each CSV.")
+parser.add_argument("--first-line", action="store", dest="first_line", default=None, help="The header of the condensed CSV. Defaults to Healthy, then a name per feature column taken from the first CSV's header.")
+parser.add_argument("--fill", action="store", type=float, dest="fill", default=0.0, help="The value to pad rows with fewer feature columns with.")
+parser.add_argument("-w", "--workers", action="store", type=int, dest="workers", default=1, help="The number of CSVs to read in parallel, each in its own process.")
+parser.add_argument("-c", "--chunk-size", action="store", type=int, dest="chunk_size", default=100000, help="The number of rows to read at a time, which bounds memory usage.")
+
+# ----------------------------------------------------------------------------
+#  Functions
+# ----------------------------------------------------------------------------
+
+_TRAINING_CSV = re.compile(r"^patient_(\d+)_training\.csv$")
+
+def find_training_csvs(directory_name):
+    """
+    Finds each patient's training CSV, as written by generate_csvs.py.
+
+    :param str directory_name: the directory to search. Subdirectories are not searched.
+    :return: a list of paths, ordered by patient number.
+    :rtype: list
+    """
+    matches = [(int(match.group(1)), file) for file in os.listdir(directory_name) for match in [_TRAINING_CSV.match(file)] if match]
+    return [os.path.join(directory_name, file) for (_, file) in sorted(matches)]
+
+
+def normalize_rows(data, n_features, fill=0.0, background=None):
+    """
+    Truncates or pads rows of label,feature,feature... to exactly n_features features, and drops background rows.
+
+    :param np.ndarray data: an array of shape (n, n_cols), labels first.
+    :param int n_features: the number of feature columns to keep after the label.
+    :param float fill: the value to pad missing feature columns with.
+    :param float background: if given, rows with any kept (not padded) feature at or below this value are dropped.
+    :return: an array of shape (n_kept, n_features + 1).
+    :rtype: np.ndarray
+    """
+    kept = data[:, :n_features + 1]
+    if background is not None:
+        kept = kept[~(kept[:, 1:] <= background).any(axis=1)]
+    if kept.shape[1] < n_features + 1:
+        kept = np.hstack((kept, np.full((len(kept), n_features + 1 - kept.shape[1]), fill)))
+    return kept
+
+
+def parse_row(line, columns=None):
+    """
+    Parses one row of a CSV, for rows which can't be parsed in bulk.
+
+    :param str line: the row.
+    :param Counter columns: if given, counts the row under "non-numeric" if it isn't numeric.
+    :return: an array of shape (1, n_cols), or None if the row isn't numeric (e.g. a header, repeated by appending to the CSV).
+    :rtype: np.ndarray
+    """
+    try:
+        return np.array(line.strip().split(","), dtype=np.float64)[np.newaxis]
+    except ValueError:
+        if columns is not None:
+            columns["non-numeric"] += 1
+        return None
+
+
+def read_normalized_chunks(filename, n_features, skip=1, fill=0.0, background=None, chunk_size=100000, columns=None):
+    """
+    Reads a training CSV in blocks of at most chunk_size rows, normalized by normalize_rows. Blocks are parsed in bulk
+    (see utilities.parse_csv_text); only blocks which can't be (e.g. from appending to a CSV with a different sample
+    count, or appending a second header) fall back to parsing row by row, skipping any non-numeric rows.
+
+    :param str filename: the path of a training CSV.
+    :param int n_features: see normalize_rows, or None to read rows as they are.
+    :param int skip: the number of header lines to skip.
+    :param float fill: see normalize_rows.
+    :param float background: see normalize_rows.
+    :param int chunk_size: the maximum number of rows per block.
+    :param Counter columns: if given, counts how many rows have each number of columns, and how many are "non-numeric".
+    :return: a generator of normalized arrays.
+    """
+    with open(filename, "r") as fid:
+        for _ in range(skip):
+            fid.readline()
+        while True:
+            lines = [line for line in islice(fid, chunk_size) if line.strip()]
+            if not lines:
+                break
+            blocks = None
+            if len({line.count(",") for line in lines}) == 1:
+                try:
+                    blocks = [parse_csv_text("".join(lines), source=filename)]
+                except ValueError: # e.g. a repeated header, with a name per column
+                    pass
+            if blocks is None: # ragged or non-numeric rows
+                blocks = [parse_row(line, columns) for line in lines]
+            for block in blocks:
+                if block is None:
+                    continue
+                if columns is not None:
+                    columns[block.shape[1]] += len(block)
+                yield block if n_features is None else normalize_rows(block, n_features, fill, background)
+
+
+def condense_file(filename, part_path, n_features, output_format="csv", skip=1, fill=0.0, background=None, chunk_size=100000):
+    """
+    Normalizes one training CSV (see read_normalized_chunks) into a part of the condensed output: CSV rows, or raw
+    float64 rows for a .npy array.
+
+    :param str filename: the path of a training CSV.
+    :param str part_path: the file to write the part to, or None to only count columns.
+    :param int n_features: see normalize_rows.
+    :param str output_format: either "csv" or "npy".
+    :param int skip: the number of header lines to skip.
+    :param float fill: see normalize_rows.
+    :param float background: see normalize_rows.
+    :param int chunk_size: the maximum number of rows to hold in memory at a time.
+    :return: a report of the form {"file": filename, "header": first line, "columns": {n_cols: n_rows}, "rows": int, "kept": int},
+        where columns may also count "non-numeric" rows, which aren't included in rows, and kept is None if part_path is.
+    :rtype: dict
+    """
+    with open(filename, "r") as fid:
+        header = fid.readline().rstrip("\r\n") if skip else ""
+    columns = Counter()
+    kept = 0
+    part = open(part_path, "w" if output_format == "csv" else "wb", newline="" if output_format == "csv" else None) if part_path else None
+    try:
+        writer = csv.writer(part) if part and output_format == "csv" else None
+        for block in read_normalized_chunks(filename, n_features if part else None, skip, fill, background, chunk_size, columns):
+            if writer is not None:
+                writer.writerows([int(row[0])] + row[1:] for row in block.tolist())
+            elif part is not None:
+                part.write(np.ascontiguousarray(block, dtype="<f8").tobytes())
+            kept += len(block)
+    finally:
+        if part is not None:
+            part.close()
+    skipped = columns.get("non-numeric", 0)
+    return {"file": filename, "header": header, "columns": dict(columns), "rows": sum(columns.values()) - skipped, "kept": kept if part else None}
+
+
+def condensed_header(header, n_features):
+    """
+    Names the columns of the condensed CSV: Healthy, then the first CSV's feature names if its header has a name per
+    column (e.g. for --features hemodynamic), else PixelDensity_0, PixelDensity_1, ...
+
+    :param str header: the first line of the first training CSV.
+    :param int n_features: the number of feature columns.
+    :return: the condensed CSV's header line.
+    :rtype: str
+    """
+    names = header.split(",")[1:] if header.count(",") > 1 else []
+    names = names[:n_features] + ["PixelDensity_{}".format(i) for i in range(len(names), n_features)]
+    return ",".join(["Healthy"] + names)
+
+
+def write_npy_header(fid, rows, cols):
+    """
+    Writes the header of a .npy array of float64 rows, to be followed by its raw data.
+
+    :param fid: a file opened for binary writing.
+    :param int rows: the number of rows.
+    :param int cols: the number of columns.
+    """
+    np.lib.format.write_array_header_1_0(fid, {"descr": "<f8", "fortran_order": False, "shape": (rows, cols)})
+
+
+def condense_csvs(directory_name, n_features=None, output=None, output_format="csv", background=None, skip=1, first_line=None, fill=0.0, workers=1, chunk_size=100000):
+    """
+    Reports the column counts of each patient's training CSV in directory_name and, if n_features is given, condenses them
+    into one output. Each CSV is read once, a chunk at a time, into a temporary part; workers CSVs are read at once, each
+    in its own process. The parts are then concatenated, in patient order, into output.
+
+    :param str directory_name: the directory containing the patient_{n}_training.csv files.
+    :param int n_features: the number of feature columns to truncate or pad every row to, or None to only report.
+    :param str output: the file to condense into. Defaults to condensed.csv (or condensed.npy) in directory_name.
+    :param str output_format: "csv", for a CSV with one header line, or "npy", for a binary array of shape (rows, n_features + 1).
+    :param float background: see normalize_rows.
+    :param int skip: the number of header lines to skip in each CSV.
+    :param str first_line: the condensed CSV's header. Defaults to condensed_header.
+    :param float fill: see normalize_rows.
+    :param int workers: how many CSVs to read at once.
+    :param int chunk_size: the maximum number of rows each process holds in memory at a time.
+    :return: a list of per-CSV reports, as returned by condense_file, in patient order.
+    :rtype: list
+    """
+    files = find_training_csvs(directory_name)
+    if not files:
+        raise ValueError("No patient_{{n}}_training.csv files found in directory: {}".format(directory_name))
+    output = output or os.path.join(directory_name, "condensed." + output_format)
+    part_dir = tempfile.mkdtemp(prefix=".condense_", dir=os.path.dirname(os.path.abspath(output))) if n_features is not None else None
+    try:
+        parts = [os.path.join(part_dir, "{}.part".format(i)) if part_dir else None for i in range(len(files))]
+        jobs = [(file, part, n_features, output_format, skip, fill, background, chunk_size) for (file, part) in zip(files, parts)]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                reports = list(executor.map(condense_file, *zip(*jobs)))
+        else:
+            reports = [condense_file(*job) for job in jobs]
+        if part_dir:
+            with open(output + ".tmp", "wb") as out:
+                if output_format == "csv":
+                    out.write(((first_line or condensed_header(reports[0]["header"], n_features)) + "\n").encode())
+                else:
+                    write_npy_header(out, sum(report["kept"] for report in reports), n_features + 1)
+                for part in parts:
+                    with open(part, "rb") as part_file:
+                        shutil.copyfileobj(part_file, out)
+            os.replace(output + ".tmp", output)
+    finally:
+        if part_dir:
+            shutil.rmtree(part_dir, ignore_errors=True)
+    return reports
+
+
+def print_column_report(reports, output=None):
+    """
+    Prints each CSV's column count (and the rows with any other count), then the rows kept, as verify-csvs.sh did.
+
+    :param list reports: per-CSV reports, as returned by condense_csvs.
+    :param str output: the condensed output, if one was written.
+    """
+    for report in reports:
+        counts = sorted(((cols, rows) for (cols, rows) in report["columns"].items() if cols != "non-numeric"), key=lambda count: -count[1])
+        line = "{}: {}".format(report["file"], counts[0][0] if counts else 0)
+        if len(counts) > 1:
+            line += " (also {})".format(", ".join("{} rows of {}".format(rows, cols) for (cols, rows) in counts[1:]))
+        if report["columns"].get("non-numeric"):
+            line += ", skipped {} non-numeric rows".format(report["columns"]["non-numeric"])
+        if report["kept"] is not None:
+            line += ", kept {} of {} rows".format(report["kept"], report["rows"])
+        print(line)
+    if output is not None:
+        print("Condensed {} rows into {}".format(sum(report["kept"] for report in reports), output))
+
+# ----------------------------------------------------------------------------
+#  Main
+# ----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    output = None
+    if args.n_features is not None:
+        output = args.output or os.path.join(args.directory_name, "condensed." + args.output_format)
+    reports = condense_csvs(args.directory_name, args.n_features, output, args.output_format, args.background, args.skip, args.first_line, args.fill, args.workers, args.chunk_size)
+    print_column_report(reports, output)
@@ -13,13 +13,28 @@ from random import sample
 from math import floor
 
 # Dependency Imports
-from scipy import interpolate
+from scipy import interpolate, ndimage
 import numpy as np
 
+# Local Imports
+from instrumentation import instrument
+
+# ----------------------------------------------------------------------------
+#  Constants
+# ----------------------------------------------------------------------------
+
+# The feature sets extract_features can compute per voxel.
+FEATURE_SETS = ("intensities", "hemodynamic")
+# The per-voxel summaries computed by hemodynamic_features, in column order.
+HEMODYNAMIC_FEATURES = ["Baseline", "TimeToPeak", "PeakEnhancement", "AreaUnderCurve", "MeanTransitTime", "BloodFlow", "WashInSlope", "WashOutSlope"]
+# The per-voxel statistics of a voxel's neighbourhood computed by neighbourhood_maps, in column order.
+NEIGHBOURHOOD_FEATURES = ["NeighbourhoodMean", "NeighbourhoodMeanPeak", "NeighbourhoodStd", "NeighbourhoodStdPeak", "NeighbourhoodGradient", "NeighbourhoodGradientPeak"]
+
 # ----------------------------------------------------------------------------
 #  Functions
 # ----------------------------------------------------------------------------
 
+@instrument(counts=lambda interpolation_dict: {"slices": len(interpolation_dict), "pixels": sum(len(coord_dict) for coord_dict in interpolation_dict.values())})
 def generate_interpolations_per_slice(slice_dict):
     """
     Takes the data from a slice dictionary in the form {slice_id: {pixel_coordinate: array_of_pixel_values_over_time}}
@@ -60,6 +75,7 @@ def sample_interp_intensity(interp_func, count):
     return l
 
 
+@instrument(counts=lambda resampled_dict: {"slices": len(resampled_dict), "pixels": sum(len(coord_dict) for coord_dict in resampled_dict.values())})
 def generate_resampled_slice_dict(interpolation_dict, n_intensity_vals):
     """
     Takes the data from a slice dictionary in the form {slice_id: {pixel_coordinate: array_of_pixel_values_over_time}}
@@ -79,3 +95,192 @@ def generate_resampled_slice_dict(interpolation_dict, n_intensity_vals):
                 for (slice_id, coord_dict) in interpolation_dict.items()
             }
     )
+
+
+def generate_sample_times(times, count):
+    """
+    Generates count evenly-spaced sample times across the domain of times, matching the spacing used by sample_interp_intensity.
+
+    :param np.ndarray times: acquisition times, in ascending order.
+    :param int count: the number of samples to obtain.
+    :return: an array of length count.
+    :rtype: np.ndarray
+    """
+    return np.linspace(float(times[0]), float(times[-1]), int(count), endpoint=False)
+
+
+def generate_resampling_matrix(times, count):
+    """
+    Generates the linear map from intensities at times to a cubic interpolation of them sampled at count evenly-spaced times.
+    A cubic spline is linear in the values it interpolates, so interpolating the identity matrix yields weights which
+    every curve acquired at times can share.
+
+    :param np.ndarray times: acquisition times, in ascending order.
+    :param int count: the number of samples to obtain.
+    :return: a matrix of shape (count, len(times)).
+    :rtype: np.ndarray
+    """
+    times = np.asarray(times, dtype="float64")
+    spline = interpolate.make_interp_spline(times, np.eye(len(times)), k=3) # same not-a-knot cubic as interp1d(kind="cubic")
+    return spline(generate_sample_times(times, count))
+
+
+@instrument(counts=lambda resampled: {"pixels": len(resampled)})
+def resample_slice(times, curves, count):
+    """
+    Resamples the intensity curves of many voxels which share acquisition times (e.g. one slice of a perfusion volume)
+    with a single matrix product, rather than one interpolation function per voxel.
+
+    :param np.ndarray times: acquisition times, in ascending order.
+    :param np.ndarray curves: an array of shape (n_voxels, len(times)), one intensity curve per row.
+    :param int count: the number of samples to obtain per curve.
+    :return: an array of shape (n_voxels, count), with values obtained at evenly-spaced intervals across each curve's interpolation.
+    :rtype: np.ndarray
+    """
+    return np.asarray(curves, dtype="float64").dot(generate_resampling_matrix(times, count).T)
+
+
+def acquisition_seconds(times):
+    """
+    Converts DCM acquisition times (HHMMSS.FFFFFF, as floats) to seconds after the first of them, so that differences between them are durations.
+
+    :param np.ndarray times: acquisition times, in ascending order.
+    :return: an array of the same length, starting at 0.
+    :rtype: np.ndarray
+    """
+    times = np.asarray(times, dtype="float64")
+    seconds = (times // 10000) * 3600 + (times // 100 % 100) * 60 + times % 100
+    return seconds - seconds[0]
+
+
+@instrument(counts=lambda features: {"pixels": len(features)})
+def hemodynamic_features(times, curves, baseline_points=3, signal_drop=False):
+    """
+    Summarizes the intensity curves of many voxels which share acquisition times (e.g. one slice of a perfusion volume),
+    with whole-array operations rather than a loop per voxel. Each curve's enhancement is its rise above its baseline
+    (or, if signal_drop, its fall below it, as in DSC perfusion), clipped at 0. The summaries, in the order of
+    HEMODYNAMIC_FEATURES, are:
+        Baseline: the mean intensity of the first baseline_points acquisitions, before the contrast arrives.
+        TimeToPeak: the seconds from the first acquisition to the peak enhancement.
+        PeakEnhancement: the largest enhancement.
+        AreaUnderCurve: the enhancement integrated over time, a proxy for blood volume.
+        MeanTransitTime: the enhancement's first moment in time, a proxy for mean transit time.
+        BloodFlow: AreaUnderCurve / MeanTransitTime, a proxy for blood flow (by the central volume theorem).
+        WashInSlope: the steepest rise in enhancement, per second.
+        WashOutSlope: the steepest fall in enhancement, per second (0 or negative).
+
+    :param np.ndarray times: DCM acquisition times, in ascending order. See acquisition_seconds.
+    :param np.ndarray curves: an array of shape (n_voxels, len(times)), one intensity curve per row.
+    :param int baseline_points: how many of the first acquisitions to average as the baseline.
+    :param bool signal_drop: whether the contrast lowers the signal, rather than raising it.
+    :return: an array of shape (n_voxels, len(HEMODYNAMIC_FEATURES)).
+    :rtype: np.ndarray
+    """
+    seconds = acquisition_seconds(times)
+    curves = np.asarray(curves, dtype="float64")
+    baseline = curves[:, :max(1, baseline_points)].mean(axis=1)
+    enhancement = baseline[:, np.newaxis] - curves if signal_drop else curves - baseline[:, np.newaxis]
+    np.clip(enhancement, 0, None, out=enhancement)
+
+    peak_idx = enhancement.argmax(axis=1)
+    peak = enhancement[np.arange(len(enhancement)), peak_idx]
+
+    # trapezoidal integrals of the enhancement, and of time * enhancement, as one matrix product each
+    dt = np.diff(seconds)
+    weights = np.zeros(len(seconds))
+    weights[:-1] += dt / 2
+    weights[1:] += dt / 2
+    area = enhancement.dot(weights)
+    moment = enhancement.dot(weights * seconds)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        transit_time = np.where(area > 0, moment / area, 0.0)
+        flow = np.where(transit_time > 0, area / transit_time, 0.0)
+
+    slopes = np.diff(enhancement, axis=1) / np.where(dt > 0, dt, np.inf) # acquisitions at the same time have no slope
+    wash_in = slopes.max(axis=1, initial=0.0)
+    wash_out = slopes.min(axis=1, initial=0.0)
+    return np.column_stack((baseline, seconds[peak_idx], peak, area, transit_time, flow, wash_in, wash_out))
+
+
+@instrument(counts=lambda maps: {"pixels": maps[0].size})
+def neighbourhood_maps(slice_volume, size):
+    """
+    Computes statistics of every voxel's size x size neighbourhood in a slice, with separable filters over the whole
+    (time, row, col) array at once, so the cost is linear in the slice's size. At each time point, the neighbourhood's
+    mean, standard deviation and gradient magnitude (by Sobel filters) are computed; each is then reduced over time to its
+    average and its peak. The maps, in the order of NEIGHBOURHOOD_FEATURES, are:
+        NeighbourhoodMean, NeighbourhoodMeanPeak: the neighbourhood's mean intensity, averaged over time and at its largest.
+        NeighbourhoodStd, NeighbourhoodStdPeak: the neighbourhood's standard deviation, likewise.
+        NeighbourhoodGradient, NeighbourhoodGradientPeak: the intensity's gradient magnitude, likewise.
+
+    :param np.ndarray slice_volume: an array of shape (n_times, rows, cols), e.g. one slice of a perfusion volume.
+    :param int size: the width of the neighbourhood, in pixels, e.g. 3 or 5.
+    :return: an array of shape (len(NEIGHBOURHOOD_FEATURES), rows, cols).
+    :rtype: np.ndarray
+    """
+    slice_volume = np.asarray(slice_volume, dtype="float64")
+    window = (1, size, size) # filter within each time point, never across them
+    mean = ndimage.uniform_filter(slice_volume, window)
+    std = ndimage.uniform_filter(slice_volume * slice_volume, window)
+    std -= mean * mean
+    np.sqrt(np.clip(std, 0, None, out=std), out=std)
+    gradient = np.hypot(ndimage.sobel(slice_volume, axis=1), ndimage.sobel(slice_volume, axis=2))
+    return np.stack([reduce(statistic, axis=0) for statistic in (mean, std, gradient) for reduce in (np.mean, np.max)])
+
+
+def feature_names(features, sample_count, neighbourhood=0):
+    """
+    Names the columns computed by extract_slice_features.
+
+    :param str features: one of FEATURE_SETS.
+    :param int sample_count: the number of intensity values per row, for "intensities".
+    :param int neighbourhood: the width of the neighbourhood whose statistics are appended, or 0 for none.
+    :return: a list of column names.
+    :rtype: list
+    """
+    if features == "hemodynamic":
+        names = list(HEMODYNAMIC_FEATURES)
+    else:
+        names = ["PixelDensity_{}".format(i) for i in range(sample_count)]
+    return names + (NEIGHBOURHOOD_FEATURES if neighbourhood else [])
+
+
+def extract_features(times, curves, sample_count, features="intensities", signal_drop=False):
+    """
+    Computes the features of many voxels which share acquisition times (e.g. one slice of a perfusion volume).
+
+    :param np.ndarray times: acquisition times, in ascending order.
+    :param np.ndarray curves: an array of shape (n_voxels, len(times)), one intensity curve per row.
+    :param int sample_count: the number of intensity values to obtain per curve, for "intensities".
+    :param str features: "intensities", for the curves resampled to sample_count values (see resample_slice),
+        or "hemodynamic", for their summaries (see hemodynamic_features).
+    :param bool signal_drop: for "hemodynamic", whether the contrast lowers the signal, rather than raising it.
+    :return: an array of shape (n_voxels, len(feature_names(features, sample_count))).
+    :rtype: np.ndarray
+    """
+    if features == "hemodynamic":
+        return hemodynamic_features(times, curves, signal_drop=signal_drop)
+    if features != "intensities":
+        raise ValueError("Unknown feature set: {}, expected one of: {}".format(features, ", ".join(FEATURE_SETS)))
+    return resample_slice(times, curves, sample_count)
+
+
+def extract_slice_features(times, slice_volume, rows, cols, sample_count, features="intensities", signal_drop=False, neighbourhood_stats=None):
+    """
+    Computes the features of some of a slice's voxels (see extract_features), followed by their neighbourhood statistics, if given.
+
+    :param np.ndarray times: the slice's acquisition times, in ascending order.
+    :param np.ndarray slice_volume: an array of shape (len(times), rows, cols), e.g. one slice of a perfusion volume.
+    :param np.ndarray rows: the row of each voxel to compute features for.
+    :param np.ndarray cols: the column of each voxel to compute features for.
+    :param int sample_count: see extract_features.
+    :param str features: see extract_features.
+    :param bool signal_drop: see extract_features.
+    :param np.ndarray neighbourhood_stats: the slice's neighbourhood_maps, or None to append nothing.
+    :return: an array with a row per voxel, and a column per name in feature_names.
+    :rtype: np.ndarray
+    """
+    values = extract_features(times, slice_volume[:, rows, cols].T, sample_count, features, signal_drop)
+    if neighbourhood_stats is None:
+        return values
+    return np.hstack((values, neighbourhood_stats[:, rows, cols].T))
@@ -0,0 +1,240 @@
+# :: dicom_index.py
+#####################################################
+# A persisted, header-only index of the DCM files in
+# a directory, so that scripts needing only metadata
+# never decode pixel data.
+#####################################################
+# :: Created By: Benji Brandt <benjibrandt@ucla.edu>,
+#                Roy Lin <rlin2k1@gmail.com>,
+#                David Macaraeg <dmacaraeg@g.ucla.edu>
+# :: Creation Date: 18 October 2026
+
+# Standard Library, whole imports
+import os
+import argparse
+import hashlib
+import json
+
+# Standard Library, specific imports
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+# Dependency Imports
+import pydicom
+
+# Local Imports
+from utilities import represents_int
+
+# ----------------------------------------------------------------------------
+#  Argument Parsing
+# ----------------------------------------------------------------------------
+
+parser = argparse.ArgumentParser(description="Indexes the headers of every patient's DCM files, refreshing only files which have changed.")
+
+parser.add_argument("directory_name", action="store", help="The directory containing information for all patients, structured as for generate_csvs.py.")
+parser.add_argument("-w", "--workers", action="store", type=int, dest="workers", default=os.cpu_count(), help="The number of processes to read headers with.")
+
+# ----------------------------------------------------------------------------
+#  Constants
+# ----------------------------------------------------------------------------
+
+INDEX_FILE = ".dicom_index.json"
+_INDEX_VERSION = 1
+REGISTRATION_MANIFEST = "registration_manifest.json"
+_MANIFEST_VERSION = 1
+_PARALLEL_THRESHOLD = 64 # below this many stale files, a process pool costs more than it saves
+
+# ----------------------------------------------------------------------------
+#  Functions
+# ----------------------------------------------------------------------------
+
+def _optional(dcm, attribute, cast):
+    value = getattr(dcm, attribute, None)
+    return None if value is None or value == "" else cast(value)
+
+
+def read_dicom_header(path):
+    """
+    Reads the metadata of a single DCM, stopping before its pixel data.
+
+    :param str path: the path of a DCM file.
+    :return: a dict of the form {"slice_location": float, "acquisition_number": int, "acquisition_time": str,
+        "rows": int, "columns": int, "series_uid": str, "series_number": int, "series_description": str},
+        where any value missing from the header is None.
+    :rtype: dict
+    """
+    dcm = pydicom.dcmread(path, stop_before_pixels=True)
+    return {
+        "slice_location": _optional(dcm, "SliceLocation", float),
+        "acquisition_number": _optional(dcm, "AcquisitionNumber", int),
+        "acquisition_time": _optional(dcm, "AcquisitionTime", str),
+        "rows": _optional(dcm, "Rows", int),
+        "columns": _optional(dcm, "Columns", int),
+        "series_uid": _optional(dcm, "SeriesInstanceUID", str),
+        "series_number": _optional(dcm, "SeriesNumber", int),
+        "series_description": _optional(dcm, "SeriesDescription", str),
+    }
+
+
+def index_path(directory_name, cache_dir=None):
+    """
+    Names the file an index of directory_name is persisted to.
+
+    :param str directory_name: the name of a directory with DCM files.
+    :param str cache_dir: a directory to keep the index in, rather than directory_name itself. Indexes of different
+        directories are told apart by a hash of their absolute paths.
+    :return: the index file's path.
+    :rtype: str
+    """
+    if cache_dir is None:
+        return os.path.join(directory_name, INDEX_FILE)
+    return os.path.join(cache_dir, hashlib.sha1(os.path.abspath(directory_name).encode()).hexdigest()[:16] + INDEX_FILE)
+
+
+def index_directory(directory_name, workers=1, persist=True, cache_dir=None):
+    """
+    Indexes the headers of all DCMs within directory_name. Will not look at subdirectories.
+    The index is persisted (see index_path), and on later calls only files whose size or mtime has changed are re-read;
+    files which no longer exist are dropped. If the index can't be written, e.g. to a read-only study, it is only warned about.
+
+    :param str directory_name: the name of a directory with DCM files to examine.
+    :param int workers: the number of processes to read stale headers with.
+    :param bool persist: whether to read and write the index file.
+    :param str cache_dir: see index_path. Created if needed.
+    :return: a dictionary of the form {file_name: header_record}, with records as from read_dicom_header plus "mtime" and "size".
+    :rtype: dict
+    """
+    index_file_path = index_path(directory_name, cache_dir)
+    cached = {}
+    if persist and os.path.exists(index_file_path):
+        with open(index_file_path, "r") as index_file:
+            stored = json.load(index_file)
+        if stored.get("version") == _INDEX_VERSION:
+            cached = stored["files"]
+
+    index = {}
+    stale = []
+    for file in sorted(os.listdir(directory_name)):
+        if file.endswith(".dcm"):
+            stat = os.stat(os.path.join(directory_name, file))
+            record = cached.get(file)
+            if record is not None and record["mtime"] == stat.st_mtime_ns and record["size"] == stat.st_size:
+                index[file] = record
+            else:
+                stale.append((file, stat))
+
+    paths = [os.path.join(directory_name, file) for (file, _) in stale]
+    if workers > 1 and len(stale) >= _PARALLEL_THRESHOLD:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            headers = list(executor.map(read_dicom_header, paths, chunksize=32))
+    else:
+        headers = [read_dicom_header(path) for path in paths]
+    for (file, stat), header in zip(stale, headers):
+        header["mtime"] = stat.st_mtime_ns
+        header["size"] = stat.st_size
+        index[file] = header
+
+    if persist and (stale or len(index) != len(cached)):
+        try:
+            if cache_dir is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+            with open(index_file_path + ".tmp", "w") as index_file:
+                json.dump({"version": _INDEX_VERSION, "files": index}, index_file)
+            os.replace(index_file_path + ".tmp", index_file_path)
+        except OSError:
+            print("WARNING: could not write DCM index {}".format(index_file_path))
+    return index
+
+
+def group_by_slice(index, acquisition_number=None):
+    """
+    Groups the files of an index by slice location.
+
+    :param dict index: an index, as returned by index_directory.
+    :param int acquisition_number: if given, only files from this acquisition are included.
+    :return: a dictionary of the form {slice_location: [file_name, ...]}, with each slice's files ordered by acquisition time.
+    :rtype: dict
+    """
+    slices = defaultdict(list)
+    for file, record in index.items():
+        if acquisition_number is None or record["acquisition_number"] == acquisition_number:
+            slices[record["slice_location"]].append(file)
+    for files in slices.values():
+        files.sort(key=lambda file: float(index[file]["acquisition_time"] or 0))
+    return dict(slices)
+
+
+def slice_locations(index):
+    """
+    Lists the distinct slice locations of an index.
+
+    :param dict index: an index, as returned by index_directory.
+    :return: the distinct slice locations, in ascending order.
+    :rtype: list
+    """
+    return sorted({record["slice_location"] for record in index.values()})
+
+
+def index_patients(structured_directory, workers=1):
+    """
+    Indexes every subdirectory (e.g. FLAIR, Perfusion) of every integer-named patient directory within structured_directory.
+
+    :param str structured_directory: the name of a directory with DCM files, structured as for generate_csvs.py.
+    :param int workers: the number of processes to read stale headers with.
+    :return: a dictionary of the form {patient: {subdirectory: index}}
+    :rtype: dict
+    """
+    patients = {}
+    for patient in sorted(os.listdir(structured_directory)):
+        patient_directory = os.path.join(structured_directory, patient)
+        if represents_int(patient) and os.path.isdir(patient_directory):
+            patients[patient] = {
+                subdirectory: index_directory(os.path.join(patient_directory, subdirectory), workers)
+                for subdirectory in sorted(os.listdir(patient_directory))
+                if os.path.isdir(os.path.join(patient_directory, subdirectory))
+            }
+    return patients
+
+
+def write_registration_manifest(directory_name, images):
+    """
+    Records the typed metadata of every registered image in a directory, so that readers never need to list the
+    directory or parse file names.
+
+    :param str directory_name: the directory holding the registered images.
+    :param list images: a list of dicts, each of the form {"file": file_name, "source": path_of_unregistered_image,
+        "slice_location": float, "acquisition_number": int, "acquisition_time": str}
+    :return: the manifest's path.
+    :rtype: str
+    """
+    manifest_path = os.path.join(directory_name, REGISTRATION_MANIFEST)
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump({"version": _MANIFEST_VERSION, "images": images}, manifest_file, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest_path
+
+
+def read_registration_manifest(directory_name):
+    """
+    Reads the manifest written by write_registration_manifest.
+
+    :param str directory_name: the directory holding the registered images.
+    :return: the manifest's images, as passed to write_registration_manifest, or None if the directory has no (current) manifest.
+    :rtype: list
+    """
+    manifest_path = os.path.join(directory_name, REGISTRATION_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as manifest_file:
+        manifest = json.load(manifest_file)
+    return manifest["images"] if manifest.get("version") == _MANIFEST_VERSION else None
+
+# ----------------------------------------------------------------------------
+#  Main
+# ----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print("Indexing DCMs in directory: {}".format(args.directory_name))
+    for patient, subdirectories in index_patients(str(args.directory_name), args.workers).items():
+        print("{}: {}".format(patient, ", ".join("{} {} files".format(subdirectory, len(index)) for (subdirectory, index) in subdirectories.items())))
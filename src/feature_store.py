@@ -0,0 +1,149 @@
+# :: feature_store.py
+#####################################################
+# A binary, memory-mappable alternative to the
+# per-patient CSVs written by generate_csvs.py.
+#####################################################
+# :: Created By: Benji Brandt <benjibrandt@ucla.edu>,
+#                Roy Lin <rlin2k1@gmail.com>,
+#                David Macaraeg <dmacaraeg@g.ucla.edu>
+# :: Creation Date: 18 October 2026
+
+# Standard Library, whole imports
+import os
+import json
+
+# Dependency Imports
+import numpy as np
+
+# ----------------------------------------------------------------------------
+#  Constants
+# ----------------------------------------------------------------------------
+
+# A feature store is a directory holding one raw binary file per column, plus a JSON header describing them:
+#   patient_1_test.features
+#        |--- header.json
+#        |--- coords.bin   <-- (rows, 2) pixel (row, col) coordinates
+#        |--- slice.bin    <-- (rows,) slice locations
+#        |--- label.bin    <-- (rows,) 0 for healthy, 1 for dead, -1 for unlabeled (test) voxels
+#        |--- features.bin <-- (rows, n_features) resampled intensities
+FEATURE_STORE_EXTENSION = ".features"
+HEADER_FILE = "header.json"
+UNLABELED = -1
+
+_COLUMNS = {
+    "coords": ("int32", 2),
+    "slice": ("float64", None),
+    "label": ("int8", None),
+    "features": ("float32", "n_features"),
+}
+
+# ----------------------------------------------------------------------------
+#  Functions
+# ----------------------------------------------------------------------------
+
+def is_feature_store(path):
+    """
+    Determines if the given path is a feature store written by FeatureStoreWriter.
+
+    :param str path:
+    :return: True if path is a directory containing a feature store header, else False.
+    :rtype: bool
+    """
+    return os.path.isfile(os.path.join(path, HEADER_FILE))
+
+
+def open_feature_store(path, mmap_mode="r"):
+    """
+    Memory-maps every column of a feature store. Nothing is parsed or copied; pages are read from disk as they're touched.
+
+    :param str path: the feature store's directory.
+    :param str mmap_mode: the mode to map columns with, as for np.memmap. "r" is read-only.
+    :return: a dict of the form {"header": header_dict, "coords": array, "slice": array, "label": array, "features": array}
+    :rtype: dict
+    """
+    with open(os.path.join(path, HEADER_FILE), "r") as header_file:
+        header = json.load(header_file)
+    store = {"header": header}
+    for name, column in header["columns"].items():
+        shape = tuple(column["shape"])
+        if shape[0] == 0: # np.memmap refuses to map empty files
+            store[name] = np.empty(shape, dtype=column["dtype"])
+        else:
+            store[name] = np.memmap(os.path.join(path, column["file"]), dtype=column["dtype"], mode=mmap_mode, shape=shape)
+    return store
+
+
+class FeatureStoreWriter:
+    def __init__(self, path, feature_names, metadata=None):
+        """
+        Streams voxel rows into a feature store. Columns are appended to as raw binary; the header is only written
+        by close(), so a store is never readable in a half-written state.
+
+        :param str path: the directory to write the store to. Created if needed; an existing store is overwritten.
+        :param list feature_names: a name per feature column, e.g. ["PixelDensity_0", "PixelDensity_1", ...]
+        :param dict metadata: any extra JSON-serializable values to record in the header (e.g. patient, sample_count).
+        """
+        self.path = path
+        self.feature_names = list(feature_names)
+        self.metadata = metadata or {}
+        self.rows = 0
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, HEADER_FILE)):
+            os.remove(os.path.join(path, HEADER_FILE))
+        self._files = {name: open(os.path.join(path, name + ".bin"), "wb") for name in _COLUMNS}
+
+    def append(self, coords, slice_locations, labels, features):
+        """
+        Appends a block of voxel rows to the store.
+
+        :param np.ndarray coords: an array of shape (n, 2) of pixel (row, col) coordinates.
+        :param slice_locations: an array of shape (n,), or a single slice location shared by every row.
+        :param labels: an array of shape (n,), or a single label shared by every row.
+        :param np.ndarray features: an array of shape (n, n_features).
+        """
+        features = np.asarray(features, dtype=_COLUMNS["features"][0])
+        n = len(features)
+        if features.ndim != 2 or features.shape[1] != len(self.feature_names):
+            raise ValueError("Expected features of shape (n, {}), got {}".format(len(self.feature_names), features.shape))
+        columns = {
+            "coords": np.asarray(coords).reshape(n, 2),
+            "slice": np.broadcast_to(slice_locations, (n,)),
+            "label": np.broadcast_to(labels, (n,)),
+            "features": features,
+        }
+        for name, (dtype, _) in _COLUMNS.items():
+            self._files[name].write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+        self.rows += n
+
+    def close(self, write_header=True):
+        """
+        Flushes all columns and writes the header, after which the store may be opened with open_feature_store.
+
+        :param bool write_header: if False, the columns are closed without a header, leaving the store unreadable.
+        """
+        for column_file in self._files.values():
+            column_file.close()
+        if not write_header:
+            return
+        header = {
+            "version": 1,
+            "rows": self.rows,
+            "feature_names": self.feature_names,
+            "columns": {
+                name: {
+                    "file": name + ".bin",
+                    "dtype": dtype,
+                    "shape": [self.rows] if width is None else [self.rows, len(self.feature_names) if width == "n_features" else width],
+                }
+                for (name, (dtype, width)) in _COLUMNS.items()
+            },
+            "metadata": self.metadata,
+        }
+        with open(os.path.join(self.path, HEADER_FILE), "w") as header_file:
+            json.dump(header, header_file, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(write_header=exc_type is None)
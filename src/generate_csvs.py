@@ -12,13 +12,21 @@
 import os
 import argparse
 import csv
+import json
+import time
 
 # Standard Library, specific imports
-from random import sample
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Dependency Imports
+import numpy as np
 
 # Local Imports
 import data_processing as dp
+import dicom_index as di
+import feature_store as fs
 import image_processing as ip
+from instrumentation import instrument, stage
 from utilities import represents_int
 
 # ----------------------------------------------------------------------------
@@ -28,9 +36,18 @@ from utilities import represents_int
 parser = argparse.ArgumentParser(description="Generates CSV training data from a set of perfusion and labeled flair images.")
 
 parser.add_argument("directory_name", action="store", help="The directory containing information for all patients.")
-parser.add_argument("sample_count", action="store", help="The number of intensity values to obtain for interpolation.")
+parser.add_argument("sample_count", action="store", help="The number of intensity values to obtain for interpolation (unused for --features hemodynamic).")
 parser.add_argument("nlive", action="store", help="The number of intensity arrays which represent surviving pixels to sample.")
 parser.add_argument("ndie", action="store", help="The number of intensity arrays which represent dying pixels to sample.")
+parser.add_argument("-f", "--format", action="store", dest="output_format", choices=["csv", "store"], default="csv", help="Write each data set as a CSV, or as a binary, memory-mappable feature store directory (see feature_store.py).")
+parser.add_argument("-s", "--seed", action="store", type=int, dest="seed", default=None, help="Seed the sampling of surviving and dying pixels, so that the training data is reproducible.")
+parser.add_argument("-w", "--workers", action="store", type=int, dest="workers", default=1, help="The number of patients to process in parallel, each in its own process, and of processes to index perfusion DCM headers with first.")
+parser.add_argument("-t", "--slice-tolerance", action="store", type=float, dest="slice_tolerance", default=None, help="How far (in the DCMs' slice location units) a FLAIR slice may be from the nearest perfusion slice to be paired with it. Defaults to half the perfusion slice spacing.")
+parser.add_argument("--strict-alignment", action="store_true", dest="strict_alignment", default=False, help="Fail a patient if any FLAIR slice has no perfusion slice within tolerance, rather than skipping that slice.")
+parser.add_argument("--features", action="store", dest="features", choices=dp.FEATURE_SETS, default="intensities", help="Write each voxel's resampled intensities (sample_count of them), or its {} hemodynamic summaries: {}.".format(len(dp.HEMODYNAMIC_FEATURES), ", ".join(dp.HEMODYNAMIC_FEATURES)))
+parser.add_argument("-n", "--neighbourhood", action="store", type=int, dest="neighbourhood", default=0, help="Append {} statistics of each voxel's n x n neighbourhood to its features: {}. 0 appends none.".format(len(dp.NEIGHBOURHOOD_FEATURES), ", ".join(dp.NEIGHBOURHOOD_FEATURES)))
+parser.add_argument("-b", "--background-threshold", action="store", type=float, dest="background_threshold", default=ip.BACKGROUND_THRESHOLD, help="Voxels whose mean perfusion intensity is at most this are background, and never written (see image_processing.brain_mask). 0 only skips voxels which are always 0.")
+parser.add_argument("--signal-drop", action="store_true", dest="signal_drop", default=False, help="For --features hemodynamic, measure enhancement as the signal's drop below its baseline, as in DSC perfusion, rather than its rise.")
 
 # ----------------------------------------------------------------------------
 #  Constants
@@ -38,52 +55,56 @@ parser.add_argument("ndie", action="store", help="The number of intensity arrays
 
 _PERFUSION = "Perfusion"
 _FLAIR = "FLAIR"
+_ALIGNMENT_FILE = "patient_{}_slice_alignment.json"
+_CACHE_DIR = ".generate_csvs_cache" # within the output directory, so that the patients' directories are only ever read
+_EXACT_TOLERANCE = 1e-3 # used when there's only one perfusion slice, and so no spacing to go by
+OUTPUT_VERSION = 3 # bump whenever process_patient writes different outputs for the same DCMs and arguments, so pipeline.py's cached outputs are regenerated
 
 # ----------------------------------------------------------------------------
 #  Functions
 # ----------------------------------------------------------------------------
 
-def sample_pixel_array(pixel_array, nlive, ndie):
+def sample_pixel_array(pixel_array, nlive, ndie, random_state=None):
     """
     Samples a pixel array for nlive and ndie coordinates of pixels which live and die, respectively.
+    If there are fewer than ndie dead pixels, the shortfall is made up with extra living pixels.
 
-    :param list_of_list pixel_array: a 2D array of pixels, representing an image
+    :param np.ndarray pixel_array: a 2D array of pixels, representing an image
     :param int nlive: roughly how many pixel coordinates we wish to obtain for living pixels
     :param int ndead: roughly how many pixel coordinates we wish to obtain for dead pixels
-    :return: a list of coordinates which point to roughly nlive pixels, and ndie pixels, combined
-    :rtype: dict
+    :param np.random.RandomState random_state: the generator to sample with. If None, an unseeded one is used.
+    :return: two arrays of shape (n, 2), holding the (x, y) coordinates of the sampled living and dead pixels, respectively
+    :rtype: tuple
     """
-    l = []
-    d = []
+    if random_state is None: random_state = np.random.RandomState()
     ndie = int(ndie)
     nlive = int(nlive)
-    for y in range(len(pixel_array)):
-        for x in range(len(pixel_array[0])):
-            if pixel_array[y][x] > 0:
-                d.append((x, y))
-            else:
-                l.append((x, y))
-    dead_sample = sample(d, ndie) if len(d) >= ndie else d
+    dead = np.asarray(pixel_array) > 0
+    dead_y, dead_x = np.nonzero(dead)
+    live_y, live_x = np.nonzero(~dead)
+    dead_sample = random_state.choice(len(dead_x), ndie, replace=False) if len(dead_x) >= ndie else np.arange(len(dead_x))
     if len(dead_sample) < ndie:
         nlive += ndie - len(dead_sample)
-    live_sample = sample(l, nlive) if len(l) >= nlive else l
-    return (live_sample, dead_sample)
+    live_sample = random_state.choice(len(live_x), nlive, replace=False) if len(live_x) >= nlive else np.arange(len(live_x))
+    return (np.column_stack((live_x[live_sample], live_y[live_sample])), np.column_stack((dead_x[dead_sample], dead_y[dead_sample])))
 
-def sample_labeled_flairs(flair_dict, nlive, ndie):
+def sample_labeled_flairs(flair_dict, nlive, ndie, random_state=None):
     """
     Samples a dictionary of the form: {flair_slice_locs: pixel_arrays} for nlive and ndie coordinates of pixels which live and die, respectively.
-    Does this for each slice in the dict.
+    Does this for each slice in the dict, in order of slice location, so that a seeded random_state always gives the same samples.
 
     :param dict flair_dict: a dict of the form: {flair_slice_locs: pixel_arrays}
     :param int nlive: roughly how many pixel coordinates we wish to obtain for living pixels
     :param int ndead: roughly how many pixel coordinates we wish to obtain for dead pixels
-    :return: a dict of the form: {slice_loc: [(living_coords, dead_coords)]}.
+    :param np.random.RandomState random_state: the generator to sample with. If None, an unseeded one is used.
+    :return: a dict of the form: {slice_loc: (living_coords, dead_coords)}.
     :rtype: dict
     """
+    if random_state is None: random_state = np.random.RandomState()
     return(
         {
-            slc: sample_pixel_array(pixel_array, nlive, ndie)
-            for (slc, pixel_array) in flair_dict.items()
+            slc: sample_pixel_array(flair_dict[slc], nlive, ndie, random_state)
+            for slc in sorted(flair_dict.keys())
         }
     )
 
@@ -103,7 +124,241 @@ def generate_normalized_slice_loc_map(slice_dict):
         norm_to_unorm[i] = slices[i]
     return unorm_to_norm, norm_to_unorm
 
-def parse_structured_dcm_data(structured_directory, sample_count, nlive, ndie, use_arr_storage=False):
+def align_slices(flair_locations, perfusion_locations, tolerance=None):
+    """
+    Pairs each FLAIR slice with the physically nearest perfusion slice, if it is within tolerance.
+
+    :param flair_locations: the FLAIR slice locations.
+    :param perfusion_locations: the perfusion slice locations, in ascending order.
+    :param float tolerance: the furthest a FLAIR slice may be from its perfusion slice. Defaults to half the median perfusion slice spacing.
+    :return: a dict of the form {flair_slice_location: perfusion_slice_index}, and a list of the unmatched FLAIR slice locations.
+    :rtype: tuple
+    """
+    perfusion_locations = np.asarray(perfusion_locations, dtype="float64")
+    if tolerance is None:
+        tolerance = np.median(np.diff(perfusion_locations)) / 2.0 if len(perfusion_locations) > 1 else _EXACT_TOLERANCE
+    alignment = {}
+    unmatched = []
+    for flair_loc in sorted(flair_locations):
+        nearest = int(np.argmin(np.abs(perfusion_locations - flair_loc))) if len(perfusion_locations) else None
+        if nearest is not None and abs(perfusion_locations[nearest] - flair_loc) <= tolerance:
+            alignment[flair_loc] = nearest
+        else:
+            unmatched.append(flair_loc)
+    return alignment, unmatched
+
+def align_patient_slices(patient, cache_dir, flair_directory, perfusion_directory, tolerance=None, strict=False):
+    """
+    Aligns a patient's FLAIR and perfusion slices (see align_slices) from headers alone, so that a mismatch is found
+    before any pixel data is decoded. The alignment, and the perfusion DCMs' header index, are cached in cache_dir,
+    and reused while both modalities' slice locations and the tolerance are unchanged.
+
+    :param str patient: the patient's number, used to name the cached alignment.
+    :param str cache_dir: the directory to cache the alignment in. Created if needed.
+    :param str flair_directory: the directory of the patient's coregistered, labeled FLAIRs.
+    :param str perfusion_directory: the directory of the patient's perfusion DCMs.
+    :param float tolerance: see align_slices.
+    :param bool strict: if True, any unmatched FLAIR slice is an error, rather than a warning.
+    :return: a dict of the form {flair_slice_location: perfusion_slice_index}
+    :rtype: dict
+    """
+    key = {
+        "flair_locations": sorted(ip.flair_files(flair_directory).keys()),
+        "perfusion_locations": di.slice_locations(di.index_directory(perfusion_directory, cache_dir=cache_dir)),
+        "tolerance": tolerance,
+    }
+    alignment_path = os.path.join(cache_dir, _ALIGNMENT_FILE.format(patient))
+    cached = None
+    if os.path.exists(alignment_path):
+        with open(alignment_path, "r") as alignment_file:
+            cached = json.load(alignment_file)
+    if cached is not None and cached["key"] == key:
+        alignment = {flair_loc: perf_slice for (flair_loc, perf_slice) in cached["alignment"]}
+        unmatched = cached["unmatched"]
+    else:
+        alignment, unmatched = align_slices(key["flair_locations"], key["perfusion_locations"], tolerance)
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(alignment_path + ".tmp", "w") as alignment_file:
+            json.dump({"key": key, "alignment": sorted(alignment.items()), "unmatched": unmatched}, alignment_file, indent=2)
+        os.replace(alignment_path + ".tmp", alignment_path)
+
+    if not alignment:
+        raise ValueError("No FLAIR slice in {} is within tolerance of a perfusion slice in {}".format(flair_directory, perfusion_directory))
+    if unmatched:
+        message = "FLAIR slice(s) at {} have no perfusion slice within tolerance".format(", ".join(str(flair_loc) for flair_loc in unmatched))
+        if strict:
+            raise ValueError(message)
+        print("WARNING: {}, skipping them...".format(message))
+    return alignment
+
+class CsvOutput:
+    def __init__(self, filename, labeled, feature_names=None):
+        """
+        Appends voxel rows to a CSV, taking the same arguments as feature_store.FeatureStoreWriter.
+        Labeled (training) rows are written as: label,intensity,intensity...
+        Unlabeled (test) rows are written as: x,y,z,intensity,intensity...
+
+        :param str filename: the CSV to append to.
+        :param bool labeled: whether rows are written in the training layout, rather than the test layout.
+        :param list feature_names: the header of the feature columns, if not the single "PixelDensity" over every intensity.
+        """
+        self.labeled = labeled
+        self._file = open(filename, mode="a+")
+        self._writer = csv.writer(self._file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        self._writer.writerow((["Healthy"] if labeled else ["X", "Y", "Z"]) + (feature_names or ["PixelDensity"]))
+
+    def append(self, coords, slice_loc, label, intensities):
+        if self.labeled:
+            self._writer.writerows([label, *intensity_arr] for intensity_arr in intensities.tolist())
+        else:
+            self._writer.writerows([row, col, slice_loc, *intensity_arr] for ((row, col), intensity_arr) in zip(coords.tolist(), intensities.tolist()))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def patient_output_path(patient, kind, output_format, output_dir="."):
+    """
+    Names the output for one of a patient's data sets:
+        if output_format is "csv": {output_dir}/patient_{patient}_{kind}.csv
+        if output_format is "store": {output_dir}/patient_{patient}_{kind}.features, a feature store (see feature_store.py)
+
+    :param str patient: the patient's number.
+    :param str kind: either "training" or "test".
+    :param str output_format: either "csv" or "store".
+    :param str output_dir: the directory outputs are written to.
+    :return: the path of the output.
+    :rtype: str
+    """
+    extension = fs.FEATURE_STORE_EXTENSION if output_format == "store" else ".csv"
+    return os.path.join(output_dir, "patient_{}_{}{}".format(patient, kind, extension))
+
+def open_patient_output(patient, kind, output_format, sample_count, output_dir=".", features="intensities", neighbourhood=0):
+    """
+    Opens the output for one of a patient's data sets, named as by patient_output_path.
+
+    :param str patient: the patient's number.
+    :param str kind: either "training" or "test".
+    :param str output_format: either "csv" or "store".
+    :param int sample_count: the number of intensity values per row, for "intensities".
+    :param str output_dir: the directory to write the output to.
+    :param str features: the feature set written per row, one of data_processing.FEATURE_SETS.
+    :param int neighbourhood: the width of the neighbourhood whose statistics follow the features, or 0 for none.
+    :return: an output with an append(coords, slice_loc, label, intensities) method, usable as a context manager.
+    """
+    path = patient_output_path(patient, kind, output_format, output_dir)
+    feature_names = dp.feature_names(features, sample_count, neighbourhood)
+    if output_format == "store":
+        return fs.FeatureStoreWriter(path, feature_names, {"patient": patient, "kind": kind, "sample_count": sample_count, "features": features, "neighbourhood": neighbourhood})
+    return CsvOutput(path, labeled=(kind == "training"), feature_names=None if features == "intensities" and not neighbourhood else feature_names)
+
+@instrument(counts=lambda summary: {"training_rows": summary["training_rows"], "test_rows": summary["test_rows"]})
+def process_patient(patient_directory, patient, sample_count, nlive, ndie, output_format="csv", seed=None, output_dir=".", flair_directory=None, slice_tolerance=None, strict_alignment=False, features="intensities", signal_drop=False, neighbourhood=0, background_threshold=ip.BACKGROUND_THRESHOLD):
+    """
+    Generates the training and test data for one patient, as patient_{patient}_training and patient_{patient}_test in output_dir.
+    Nothing is written to the patient's directory; headers and alignments are cached in output_dir/.generate_csvs_cache.
+
+    :param str patient_directory: the patient's directory, containing FLAIR and Perfusion subdirectories.
+    :param str patient: the patient's number, used to name the CSVs.
+    :param int sample_count: the number of intensity values to obtain for interpolation.
+    :param int nlive: roughly how many pixel coordinates we wish to obtain for living pixels
+    :param int ndead: roughly how many pixel coordinates we wish to obtain for dead pixels
+    :param str output_format: either "csv" or "store". See open_patient_output.
+    :param int seed: if given, the seed for sampling pixels, combined with the patient's number so each patient's samples are reproducible on their own.
+    :param str output_dir: the directory to write outputs to.
+    :param str flair_directory: the directory of the patient's coregistered, labeled FLAIRs, if not patient_directory/FLAIR.
+    :param float slice_tolerance: how far a FLAIR slice may be from its perfusion slice. See align_slices.
+    :param bool strict_alignment: if True, fail if any FLAIR slice has no perfusion slice, rather than skipping it.
+    :param str features: the features to write per voxel. See data_processing.extract_features.
+    :param bool signal_drop: for "hemodynamic" features, whether the contrast lowers the signal. See data_processing.hemodynamic_features.
+    :param int neighbourhood: if non-zero, append the statistics of each voxel's neighbourhood of this width. See data_processing.neighbourhood_maps.
+    :param float background_threshold: the mean intensity at or below which voxels are background, and skipped. See image_processing.brain_mask.
+    :return: a summary of the form {"patient": patient, "training_rows": int, "test_rows": int, "seconds": float}
+    :rtype: dict
+    """
+    start_time = time.time()
+    training_rows = 0
+    test_rows = 0
+    perfusion_directory = os.path.join(patient_directory, _PERFUSION)
+    flair_directory = flair_directory or os.path.join(patient_directory, _FLAIR)
+    print("Patient {}: aligning flair and perfusion slices...".format(patient))
+    cache_dir = os.path.join(output_dir, _CACHE_DIR)
+    flair_to_perf = align_patient_slices(patient, cache_dir, flair_directory, perfusion_directory, slice_tolerance, strict_alignment)
+    print("Patient {}: parsing perfusion data...".format(patient))
+    volume, perf_slices, times, mask = ip.load_perfusion_volume(perfusion_directory, background_threshold, cache_dir=cache_dir)
+    # with the above, we now have voxels mapped to intensity arrays
+    # now, we want to sample individual pixels per slice, 50% of which live, 50% of which die
+    print("Patient {}: parsing flair data...".format(patient))
+    labeled_flairs = ip.parse_flair_data(flair_directory, flair_to_perf.keys()) # only the slices which have a perfusion slice
+    print("Patient {}: sampling flair data...".format(patient))
+    with stage("generate_csvs.sample_labeled_flairs", patient=patient) as s:
+        lfd = sample_labeled_flairs(labeled_flairs, nlive, ndie, np.random.RandomState(None if seed is None else [seed, int(patient)]))
+        s.count(slices=len(lfd))
+    print("Patient {}: writing training {} file...".format(patient, output_format))
+    neighbourhoods = {} # the neighbourhood_maps of each training slice, reused for the test data
+    # Then resample the intensity arrays of those voxels a slice at a time, generate the outputs
+    with stage("generate_csvs.write_training", patient=patient, output_format=output_format) as s, open_patient_output(patient, "training", output_format, sample_count, output_dir, features, neighbourhood) as training_out:
+        for flair_slice, (live_coords, dead_coords) in lfd.items():
+            perf_slice = flair_to_perf[flair_slice] # the volume is ordered by slice location, as the alignment's perfusion slices are
+            for label, coords in ((0, live_coords), (1, dead_coords)):
+                cols, rows = coords.T
+                keep = mask[perf_slice, rows, cols] # some coordinates may still not carry over even with coregistration, such is a fact of life
+                rows, cols = rows[keep], cols[keep]
+                if neighbourhood and perf_slice not in neighbourhoods:
+                    neighbourhoods[perf_slice] = dp.neighbourhood_maps(volume[perf_slice], neighbourhood)
+                intensities = dp.extract_slice_features(times[perf_slice], volume[perf_slice], rows, cols, sample_count, features, signal_drop, neighbourhoods.get(perf_slice))
+                training_out.append(np.column_stack((rows, cols)), perf_slices[perf_slice], label, intensities)
+                training_rows += len(intensities)
+        s.count(rows=training_rows)
+    print("Patient {}: writing testing {} file...".format(patient, output_format))
+    with stage("generate_csvs.write_test", patient=patient, output_format=output_format) as s, open_patient_output(patient, "test", output_format, sample_count, output_dir, features, neighbourhood) as test_out:
+        for perf_slice, slice_loc in enumerate(perf_slices):
+            rows, cols = np.nonzero(mask[perf_slice])
+            neighbourhood_stats = neighbourhoods.pop(perf_slice, None) # no longer needed after this slice
+            if neighbourhood and neighbourhood_stats is None:
+                neighbourhood_stats = dp.neighbourhood_maps(volume[perf_slice], neighbourhood)
+            intensities = dp.extract_slice_features(times[perf_slice], volume[perf_slice], rows, cols, sample_count, features, signal_drop, neighbourhood_stats)
+            test_out.append(np.column_stack((rows, cols)), slice_loc, fs.UNLABELED, intensities)
+            test_rows += len(intensities)
+        s.count(rows=test_rows)
+    print("Patient {}: done!".format(patient))
+    return {"patient": patient, "training_rows": training_rows, "test_rows": test_rows, "seconds": time.time() - start_time}
+
+def find_patient_directories(structured_directory):
+    """
+    Finds every integer-named patient directory within structured_directory.
+
+    :param str structured_directory: the name of a directory with DCM files, structured as in parse_structured_dcm_data.
+    :return: a list of the form [(patient_directory, patient)], ordered by patient number.
+    :rtype: list
+    """
+    patients = []
+    for root, dirs, _ in os.walk(structured_directory):
+        for directory in dirs:
+            if represents_int(directory):
+                patients.append((os.path.join(root, directory), directory))
+    return sorted(patients, key=lambda patient: int(patient[1]))
+
+def print_patient_summary(summaries):
+    """
+    Prints a per-patient table of rows written and time taken.
+
+    :param list summaries: a list of summaries, as returned by process_patient.
+    """
+    print("{:>8} {:>14} {:>12} {:>10}".format("Patient", "Training Rows", "Test Rows", "Seconds"))
+    for summary in summaries:
+        if summary.get("error") is not None:
+            print("{:>8} FAILED: {}".format(summary["patient"], summary["error"]))
+        else:
+            print("{:>8} {:>14} {:>12} {:>10.2f}".format(summary["patient"], summary["training_rows"], summary["test_rows"], summary["seconds"]))
+
+@instrument(counts=lambda summaries: {"patients": len(summaries), "failed": sum(1 for summary in summaries if summary.get("error") is not None)})
+def parse_structured_dcm_data(structured_directory, sample_count, nlive, ndie, workers=1, output_format="csv", seed=None, slice_tolerance=None, strict_alignment=False, features="intensities", signal_drop=False, neighbourhood=0, background_threshold=ip.BACKGROUND_THRESHOLD):
     """
     Parses DCM data that has been structured in the following format:
         Patients <-- structured_directory_root
@@ -117,60 +372,46 @@ def parse_structured_dcm_data(structured_directory, sample_count, nlive, ndie, u
         |--- N
              |--- FLAIR
              |--- Perfusion
+    Writes a training and a test CSV (or feature store) per patient into the current directory, then prints a per-patient summary.
 
     :param str structured_directory: the name of a directory with DCM files, structured as above.
+    :param int sample_count: the number of intensity values to obtain for interpolation.
     :param int nlive: roughly how many pixel coordinates we wish to obtain for living pixels
     :param int ndead: roughly how many pixel coordinates we wish to obtain for dead pixels
-    :param bool use_arr_storage: affects form of return value. See below.
-    :return: a dictionary in one of the following forms: 
-        if use_arr_storage is True: {slice_id: [(time_stamp, pixel_array), (time_stamp, pixel_array)...]}
-        if use_arr_storage is False: {slice_id: {pixel_coordinate: array_of_pixel_values_over_time}}
-    :rtpye: dict
+    :param int workers: how many patients to process at once, each in its own process, and how many processes to index perfusion DCM headers with beforehand.
+    :param str output_format: either "csv" or "store". See open_patient_output.
+    :param int seed: if given, the seed for sampling pixels, making the training data reproducible.
+    :param float slice_tolerance: how far a FLAIR slice may be from its perfusion slice. See align_slices.
+    :param bool strict_alignment: if True, fail a patient if any FLAIR slice has no perfusion slice, rather than skipping it.
+    :param str features: the features to write per voxel. See data_processing.extract_features.
+    :param bool signal_drop: for "hemodynamic" features, whether the contrast lowers the signal. See data_processing.hemodynamic_features.
+    :param int neighbourhood: if non-zero, append the statistics of each voxel's neighbourhood of this width. See data_processing.neighbourhood_maps.
+    :param float background_threshold: the mean intensity at or below which voxels are background, and skipped. See image_processing.brain_mask.
+    :return: a list of per-patient summaries, as returned by process_patient, ordered by patient number.
+    :rtype: list
     """
-    for root, dirs, _ in os.walk(structured_directory):
-        for id_num, directory in enumerate(dirs):
-            if represents_int(directory):
-                print("Parsing directory: {}".format(directory))
-                print("Parsing perfusion data...")
-                dd = ip.parse_perfusion_data(os.path.join(root, directory, _PERFUSION), use_arr_storage)
-                print("Done!\nGenerating interpolations per slice...")
-                df = dp.generate_interpolations_per_slice(dd)
-                #dfd = dp.generate_resampled_slice_dict(df, sample_count)
-                # with the above, we now have voxels mapped to intensity arrays
-                # now, we want to sample individual pixels per slice, 50% of which live, 50% of which die
-                print("Done!\nParsing flair data...")
-                labeled_flairs = ip.parse_flair_data(os.path.join(root, directory, _FLAIR))
-                print("Done!\nSampling flair data...")
-                perf_to_normm, norm_to_perf = generate_normalized_slice_loc_map(df)
-                flair_to_norm, norm_to_flair = generate_normalized_slice_loc_map(labeled_flairs)
-                lfd = sample_labeled_flairs(labeled_flairs, nlive, ndie)
-                print("Done!\nWriting training CSV file...")
-                # Then grab the intensity arrays of those from dfd, generate the csvs
-                with open("patient_{}_training.csv".format(directory), mode="a+") as tracsv, open("patient_{}_test.csv".format(directory), mode="a+") as tstcsv:
-                    training_csv = csv.writer(tracsv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                    training_csv.writerow(["Healthy", "PixelDensity"])
-                    for unorm_flair_slice, (live_coords, dead_coords) in lfd.items():
-                        norm_flair_slice = flair_to_norm[unorm_flair_slice]
-                        unorm_perf_slice = norm_to_perf.get(norm_flair_slice)
-                        if unorm_perf_slice is None:
-                            print("WARNING: skipping unmatched perfusion slice...")
-                            continue
-                        for coord in live_coords:
-                            interp_func = df[unorm_perf_slice].get(coord)
-                            if interp_func is not None: # some coordinates may still not carry over even with coregistration, such is a fact of life
-                                training_csv.writerow([0, *(dp.sample_interp_intensity(interp_func, sample_count))])
-                        for coord in dead_coords:
-                            interp_func = df[unorm_perf_slice].get(coord)
-                            if interp_func is not None: # some coordinates may still not carry over even with coregistration, such is a fact of life
-                                 training_csv.writerow([1, *(dp.sample_interp_intensity(interp_func, sample_count))])
-                print("Done!\nWriting testing CSV file...")
-                with open("patient_{}_test.csv".format(directory), mode="a+") as tstcsv:
-                    test_csv = csv.writer(tstcsv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                    test_csv.writerow(["X", "Y", "Z", "PixelDensity"])
-                    for perf_slice, coord_dict in df.items():
-                        for coord, interp_func in coord_dict.items():
-                                test_csv.writerow([*coord, perf_slice, *(dp.sample_interp_intensity(interp_func, sample_count))])
-                print("Done!")
+    patients = find_patient_directories(structured_directory)
+    summaries = []
+    if workers > 1:
+        for patient_directory, _ in patients: # headers are read in parallel here, so each patient's process finds its index fresh
+            di.index_directory(os.path.join(patient_directory, _PERFUSION), workers, cache_dir=_CACHE_DIR)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(process_patient, patient_directory, patient, sample_count, nlive, ndie, output_format, seed, slice_tolerance=slice_tolerance, strict_alignment=strict_alignment, features=features, signal_drop=signal_drop, neighbourhood=neighbourhood, background_threshold=background_threshold): patient for (patient_directory, patient) in patients}
+            for n_done, future in enumerate(as_completed(futures), 1):
+                try:
+                    summaries.append(future.result())
+                except Exception as e:
+                    summaries.append({"patient": futures[future], "error": repr(e)})
+                print("Finished patient {} ({}/{})".format(futures[future], n_done, len(patients)))
+    else:
+        for patient_directory, patient in patients:
+            try:
+                summaries.append(process_patient(patient_directory, patient, sample_count, nlive, ndie, output_format, seed, slice_tolerance=slice_tolerance, strict_alignment=strict_alignment, features=features, signal_drop=signal_drop, neighbourhood=neighbourhood, background_threshold=background_threshold))
+            except Exception as e:
+                summaries.append({"patient": patient, "error": repr(e)})
+    summaries.sort(key=lambda summary: int(summary["patient"]))
+    print_patient_summary(summaries)
+    return summaries
 
 # ----------------------------------------------------------------------------
 #  Main
@@ -179,4 +420,4 @@ def parse_structured_dcm_data(structured_directory, sample_count, nlive, ndie, u
 if __name__ == '__main__':
     args = parser.parse_args()
     print("Processing DCMs in directory: {}".format(args.directory_name))
-    parse_structured_dcm_data(str(args.directory_name), args.sample_count, int(args.nlive), int(args.ndie))
+    parse_structured_dcm_data(str(args.directory_name), int(args.sample_count), int(args.nlive), int(args.ndie), args.workers, args.output_format, args.seed, args.slice_tolerance, args.strict_alignment, args.features, args.signal_drop, args.neighbourhood, args.background_threshold)
@@ -19,14 +19,16 @@ from operator import itemgetter
 
 # Dependency Impports
 import pydicom
+import numpy as np
+from scipy import ndimage
+
+# Local Imports
+import dicom_index as di
+from instrumentation import instrument
 
-<<<<<<< HEAD
-from src.utilities import represents_int
-=======
 # ----------------------------------------------------------------------------
 #  Argument Parsing
 # ----------------------------------------------------------------------------
->>>>>>> 46a4c19023d09fc6a835fe3d3351236698cded5f
 
 parser = argparse.ArgumentParser(description="Processes DCM files into python data structures.")
 
@@ -38,6 +40,8 @@ parser.add_argument("-r", "--recursive", action="store_true", dest="recursive",
 # ----------------------------------------------------------------------------
 
 PERFUSION = "Perfusion"
+# Voxels no brighter than this on average over time are background, as verify-csvs.sh --backgroundremove assumed.
+BACKGROUND_THRESHOLD = 30
 
 def random_sample_pixel_map(pixel_map, number_of_samples):
     """
@@ -84,6 +88,7 @@ def _sort_slice_dict(slice_dict, use_arr_storage):
                 pixel_arr.sort(key=itemgetter(0))
 
 
+@instrument(counts=lambda slice_dict: {"slices": len(slice_dict)})
 def parse_perfusion_data(directory_name, use_arr_storage=False):
     """
     Parses all DCMs within directory_name, creating a mapping between slice_id, pixel coordinates, and pixel intensity over time.
@@ -111,6 +116,78 @@ def parse_perfusion_data(directory_name, use_arr_storage=False):
     return slice_dict
 
 
+@instrument(counts=lambda mask: {"pixels": mask.size, "voxels": int(mask.sum())})
+def brain_mask(volume, threshold=BACKGROUND_THRESHOLD):
+    """
+    Separates brain tissue from background in a perfusion volume, using each voxel's mean intensity over time.
+    Voxels brighter than threshold are kept, then cleaned up with whole-volume morphology, within each slice: an
+    opening removes specks of noise and thin bridges to the skull, only each slice's largest connected region (the
+    brain) is kept, and holes within it (e.g. dark lesions or ventricles) are filled. Slices are never connected to
+    each other, so thick or gapped slices, and those at either end of the stack, keep their own brain.
+
+    :param np.ndarray volume: an array of shape (n_slices, n_times, rows, cols), as from load_perfusion_volume.
+    :param float threshold: the mean intensity at or below which voxels are background. If 0, every voxel which is
+        non-zero at any time point is kept, without any cleanup.
+    :return: a bool array of shape (n_slices, rows, cols), True for brain voxels.
+    :rtype: np.ndarray
+    """
+    if threshold <= 0:
+        return volume.any(axis=1)
+    in_plane = np.zeros((3, 3, 3), dtype=bool)
+    in_plane[1] = ndimage.generate_binary_structure(2, 1)
+    mask = volume.mean(axis=1) > threshold
+    mask = ndimage.binary_opening(mask, structure=in_plane, iterations=2)
+    labels, _ = ndimage.label(mask, structure=in_plane) # regions never span slices
+    for slice_idx, slice_labels in enumerate(labels):
+        sizes = np.bincount(slice_labels.ravel())
+        sizes[0] = 0 # the background
+        if sizes.any():
+            mask[slice_idx] = slice_labels == sizes.argmax()
+    return ndimage.binary_fill_holes(mask, structure=in_plane)
+
+
+@instrument(counts=lambda result: {"slices": result[0].shape[0], "files": result[0].shape[0] * result[0].shape[1], "pixels": result[0].size, "voxels": int(result[3].sum())})
+def load_perfusion_volume(directory_name, background_threshold=BACKGROUND_THRESHOLD, workers=1, cache_dir=None):
+    """
+    Parses all DCMs within directory_name into a single dense array, rather than a per-pixel dictionary.
+    Will not look at subdirectories.
+    Headers are read first (from the directory's dicom_index), so that the array is allocated once and each DCM's pixels are decoded straight into place.
+    If some slices have more time points than others, every slice is truncated to the shortest one.
+    The brain is masked out (see brain_mask) as soon as the pixels are decoded, so that background voxels need never be processed.
+
+    :param str directory_name: the name of a directory with DCM files to examine.
+    :param float background_threshold: see brain_mask.
+    :param int workers: the number of processes to read stale headers with (see dicom_index.index_directory).
+    :param str cache_dir: where to keep the directory's header index, rather than in the directory itself (see dicom_index.index_path).
+    :return: a tuple of the form (volume, slice_locations, times, mask), where:
+        volume is an array of shape (n_slices, n_times, rows, cols), in the DCMs' own pixel dtype.
+        slice_locations is a float array of shape (n_slices,), in ascending order.
+        times is a float array of shape (n_slices, n_times), with each slice's acquisition times in ascending order.
+        mask is a bool array of shape (n_slices, rows, cols), True for brain voxels (see brain_mask).
+    :rtype: tuple
+    """
+    index = di.index_directory(directory_name, workers, cache_dir=cache_dir)
+    slice_files = di.group_by_slice(index)
+    if not slice_files:
+        raise ValueError("No DCM files found in directory: {}".format(directory_name))
+
+    slice_locations = sorted(slice_files.keys())
+    n_times = min(len(files) for files in slice_files.values())
+    if any(len(files) != n_times for files in slice_files.values()):
+        print("WARNING: uneven time points per slice, truncating every slice to {}...".format(n_times))
+
+    volume = None
+    times = np.empty((len(slice_locations), n_times), dtype="float64")
+    for slice_idx, slice_loc in enumerate(slice_locations):
+        for time_idx, file in enumerate(slice_files[slice_loc][:n_times]):
+            pixels = pydicom.dcmread(os.path.join(directory_name, file)).pixel_array
+            if volume is None:
+                volume = np.empty((len(slice_locations), n_times) + pixels.shape, dtype=pixels.dtype)
+            volume[slice_idx, time_idx] = pixels
+            times[slice_idx, time_idx] = float(index[file]["acquisition_time"])
+    return volume, np.array(slice_locations, dtype="float64"), times, brain_mask(volume, background_threshold)
+
+
 def parse_perfusion_data_recursively(root_directory_name, use_arr_storage=False):
     """
     Parses all DCMs contained within subdirectories inside root_directory_name, creating a mapping between patient_id, slice_id, pixel coordinates, and pixel intensity over time.
@@ -130,23 +207,42 @@ def parse_perfusion_data_recursively(root_directory_name, use_arr_storage=False)
     return patient_dict
 
 
-def parse_flair_data(directory_name):
+def flair_files(directory_name):
     """
-    Parses all coregistered flair images in directory name.
-    Assumes files are named like: result_img-id_acqui-num_acqui-time_slice-loc
+    Finds the coregistered flair image of each slice in directory_name, without decoding any of them.
+    Slice locations are read from the directory's registration manifest (see register_images.py). Directories registered
+    before the manifest existed fall back to parsing file names, which are assumed to be like: result_img-id_acqui-num_acqui-time_slice-loc
 
     :param str directory_name: the name of a directory with DCM files to examine.
-    :return: a dictionary of the form {slice_id: pixel_array}
-    :rtpye: dict
+    :return: a dictionary of the form {slice_location: file_name}, with float slice locations.
+    :rtype: dict
     """
-    slice_dict = {}
+    manifest = di.read_registration_manifest(directory_name)
+    if manifest is not None:
+        return {float(image["slice_location"]): image["file"] for image in manifest}
+
+    files = {}
     match_flair_slice_loc = re.compile(r"_([+-]*[0-9]+\.*[0-9]*).dcm")
     for file in os.listdir(directory_name):
         if file.endswith(".dcm"):
-            dcm = pydicom.dcmread(os.path.join(directory_name, file))
-            slice_loc = match_flair_slice_loc.search(file).group(1)
-            slice_dict[slice_loc] = dcm.pixel_array
-    return slice_dict
+            files[float(match_flair_slice_loc.search(file).group(1))] = file
+    return files
+
+
+@instrument(counts=lambda slice_dict: {"files": len(slice_dict)})
+def parse_flair_data(directory_name, slice_locations=None):
+    """
+    Parses all coregistered flair images in directory name (see flair_files).
+
+    :param str directory_name: the name of a directory with DCM files to examine.
+    :param slice_locations: if given, only the images at these slice locations are decoded.
+    :return: a dictionary of the form {slice_location: pixel_array}, with float slice locations.
+    :rtpye: dict
+    """
+    files = flair_files(directory_name)
+    if slice_locations is not None:
+        files = {slice_loc: files[slice_loc] for slice_loc in slice_locations}
+    return {slice_loc: pydicom.dcmread(os.path.join(directory_name, file)).pixel_array for (slice_loc, file) in files.items()}
 
 def map_pixel_data(pixels, creation_time, slice_data=None, ignore_zero_intensity=True):
     """
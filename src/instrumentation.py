@@ -0,0 +1,178 @@
+# :: instrumentation.py
+#####################################################
+# Records the wall time, CPU time, item counts and
+# memory of each stage of the pipeline, as JSON lines.
+#####################################################
+# :: Created By: Benji Brandt <benjibrandt@ucla.edu>,
+#                Roy Lin <rlin2k1@gmail.com>,
+#                David Macaraeg <dmacaraeg@g.ucla.edu>
+# :: Creation Date: 18 October 2026
+
+# Standard Library, whole imports
+import os
+import sys
+import json
+import resource
+import threading
+import time
+
+# Standard Library, specific imports
+from functools import wraps
+
+# ----------------------------------------------------------------------------
+#  Constants
+# ----------------------------------------------------------------------------
+
+# Set to "1" (or "stderr") to write records to stderr, or to a path to append them to that file.
+# Read once, at import; worker processes inherit it from their parent.
+ENV_VAR = "STROKE_PROFILE"
+_DESTINATION = os.environ.get(ENV_VAR, "")
+ENABLED = _DESTINATION not in ("", "0")
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+_local = threading.local()
+
+# ----------------------------------------------------------------------------
+#  Functions
+# ----------------------------------------------------------------------------
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0 # bytes on macOS, kilobytes elsewhere
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE / (1024.0 * 1024.0)
+    except (OSError, IndexError, ValueError): # not Linux
+        return None
+
+
+def emit(record):
+    """
+    Writes a record as one JSON line, to the destination named by ENV_VAR.
+    Each line is written with a single append, so records from concurrent worker processes don't interleave.
+
+    :param dict record: a JSON-serializable record.
+    """
+    line = json.dumps(record, default=str) + "\n"
+    if _DESTINATION in ("1", "stderr"):
+        sys.stderr.write(line)
+        sys.stderr.flush()
+    else:
+        with open(_DESTINATION, "a") as profile:
+            profile.write(line)
+
+
+class _NullStage:
+    """Stands in for Stage while instrumentation is disabled, so that instrumented code costs one attribute lookup."""
+    def count(self, **counts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+class Stage:
+    def __init__(self, name, **fields):
+        """
+        Times a stage of the pipeline. On exit, emits a record of the form:
+            {"stage": name, "parent": enclosing stage or None, "pid": int, "wall_seconds": float, "cpu_seconds": float,
+             "rss_mb": float, "peak_rss_mb": float, "peak_rss_growth_mb": float, "counts": {...}, **fields}
+        where peak_rss_growth_mb is how far the stage raised the process' peak memory, and "error" is added if it raised.
+
+        :param str name: the stage's name, e.g. "generate_csvs.process_patient".
+        :param fields: any JSON-serializable values identifying this run of the stage, e.g. patient=1.
+        """
+        self.name = name
+        self.fields = fields
+        self.counts = {}
+
+    def count(self, **counts):
+        """
+        Adds to the stage's item counts, e.g. count(files=1, pixels=262144).
+        """
+        for item, n in counts.items():
+            self.counts[item] = self.counts.get(item, 0) + int(n)
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1] if stack else None
+        stack.append(self.name)
+        self._start_peak = _peak_rss_mb()
+        self._start_cpu = time.process_time()
+        self._start_wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_seconds = time.perf_counter() - self._start_wall
+        cpu_seconds = time.process_time() - self._start_cpu
+        _local.stack.pop()
+        peak = _peak_rss_mb()
+        record = {
+            "stage": self.name,
+            "parent": self.parent,
+            "pid": os.getpid(),
+            "wall_seconds": round(wall_seconds, 6),
+            "cpu_seconds": round(cpu_seconds, 6),
+            "rss_mb": _rss_mb(),
+            "peak_rss_mb": peak,
+            "peak_rss_growth_mb": peak - self._start_peak,
+            "counts": self.counts,
+        }
+        record.update(self.fields)
+        if exc_type is not None:
+            record["error"] = repr(exc_value)
+        emit(record)
+        return False
+
+
+def stage(name, **fields):
+    """
+    Instruments a block of code as a stage, e.g.
+        with stage("generate_csvs.write_test", patient=patient) as s:
+            ...
+            s.count(rows=len(intensities))
+
+    :param str name: the stage's name.
+    :param fields: any JSON-serializable values identifying this run of the stage.
+    :return: a Stage if instrumentation is enabled, else a no-op stand-in.
+    """
+    return Stage(name, **fields) if ENABLED else _NULL_STAGE
+
+
+def instrument(name=None, counts=None):
+    """
+    Decorates a function so that every call is instrumented as a stage.
+    If instrumentation is disabled, the function is returned undecorated, and costs nothing extra.
+
+    :param str name: the stage's name. Defaults to module.function.
+    :param counts: a function taking the decorated function's return value, and returning a dict of item counts,
+        e.g. lambda slice_dict: {"slices": len(slice_dict)}
+    :return: the decorator.
+    """
+    def decorator(function):
+        if not ENABLED:
+            return function
+        module = function.__module__
+        if module == "__main__": # name stages of a script by its file, as when it's imported
+            module = os.path.splitext(os.path.basename(getattr(sys.modules[module], "__file__", module)))[0]
+        stage_name = name or "{}.{}".format(module, function.__qualname__)
+
+        @wraps(function)
+        def instrumented(*args, **kwargs):
+            with Stage(stage_name) as s:
+                result = function(*args, **kwargs)
+                if counts is not None:
+                    s.count(**counts(result))
+            return result
+        return instrumented
+    return decorator
@@ -10,123 +10,168 @@
 import sys
 sys.path.append("..")
 import os
+import argparse
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 import pydicom
 from PIL import Image
-from matplotlib import pyplot as plt
 import numpy as np
-import png
-
-# slice location
-
-# grabbed from https://github.com/pydicom/pydicom/issues/352
-def dicom2png(source_folder, output_folder):
-    list_of_files = os.listdir(source_folder)
-    for file in list_of_files:
-        try:
-            ds = pydicom.dcmread(os.path.join(source_folder,file))
-            shape = ds.pixel_array.shape
-
-            # Convert to float to avoid overflow or underflow losses.
-            image_2d = ds.pixel_array.astype(float)
-
-            # Rescaling grey scale between 0-255
-            image_2d_scaled = (np.maximum(image_2d,0) / image_2d.max()) * 255.0
-
-            # Convert to uint
-            image_2d_scaled = np.uint8(image_2d_scaled)
-
-            # Write the PNG file
-            with open(os.path.join(output_folder, file.split(".")[0])+'.png' , 'wb') as png_file:
-                w = png.Writer(shape[1], shape[0], greyscale=True)
-                w.write(png_file, image_2d_scaled)
-        except:
-            print('Could not convert: ', file)
+import dicom_index as di
+from utilities import parse_csv_text
+
+# ----------------------------------------------------------------------------
+#  Argument Parsing
+# ----------------------------------------------------------------------------
+
+parser = argparse.ArgumentParser(description="Overlays predicted stroke tissue onto each patient's perfusion slices, as PNGs.")
+
+parser.add_argument("-d", "--directory", action="store", dest="stroke_output_dir", default="./stroke_outputs", help="The directory of prediction CSVs, named <patient number>_stroke_output.csv, with rows of x,y,z,label.")
+parser.add_argument("-w", "--workers", action="store", type=int, dest="workers", default=os.cpu_count(), help="The number of processes to render slices in.")
+
+# ----------------------------------------------------------------------------
+#  Constants
+# ----------------------------------------------------------------------------
+
+RED = (255, 0, 0)
+GREEN = (0, 255, 0)
+BLUE = (0, 0, 255)
+
+_HAS_STROKE_TISSUE = 1
+_MIN_HIGHLIGHT_INTENSITY = 100 # pixels this dark are background, and never highlighted
+_SLICE_TOLERANCE = 1e-3 # how far a prediction's z may be from a perfusion slice's location, after rounding in the CSV
+
+# ----------------------------------------------------------------------------
+#  Functions
+# ----------------------------------------------------------------------------
+
+def rescale_to_uint8(pixels):
+    """
+    Rescales a DCM's pixels to greyscale between 0-255.
+
+    :param np.ndarray pixels: a 2D array of pixels.
+    :return: the rescaled pixels.
+    :rtype: np.ndarray
+    """
+    # Convert to float to avoid overflow or underflow losses.
+    image_2d = pixels.astype(float)
+    peak = image_2d.max()
+    if peak <= 0:
+        return np.zeros(image_2d.shape, dtype=np.uint8)
+    return np.uint8(np.maximum(image_2d, 0) / peak * 255.0)
+
+def build_lesion_masks(prediction_csv, shape):
+    """
+    Builds a boolean mask of predicted stroke tissue per slice of a prediction CSV.
+
+    :param str prediction_csv: a CSV with rows of x,y,z,label, where z represents slice_location.
+    :param tuple shape: the (rows, cols) shape of each slice.
+    :return: the CSV's unique slice locations in ascending order, and a bool array of shape (n_slices, rows, cols),
+        True where a pixel is labeled as stroke tissue. Both are empty if the CSV has no rows.
+    :rtype: tuple
+    """
+    with open(prediction_csv, "r", encoding="utf-8-sig") as file_handler: # utf-8-sig removes the character that comes with excel csv
+        labels_data = parse_csv_text(file_handler.read(), source=prediction_csv)
+    if not labels_data.size: # e.g. nothing was predicted, as every voxel was background
+        return np.empty(0), np.zeros((0,) + tuple(shape), dtype=bool)
+    x_coords = labels_data[:, 0].astype(int)
+    y_coords = labels_data[:, 1].astype(int)
+    slice_locations, z_coords = np.unique(labels_data[:, 2], return_inverse=True) # e.g. slice number
+    lesion = (labels_data[:, 3].astype(int) == _HAS_STROKE_TISSUE) & (x_coords >= 0) & (y_coords >= 0) & (x_coords < shape[0]) & (y_coords < shape[1])
+    masks = np.zeros((len(slice_locations),) + tuple(shape), dtype=bool)
+    masks[z_coords[lesion], x_coords[lesion], y_coords[lesion]] = True
+    return slice_locations, masks
+
+def masks_by_slice(mask_locations, masks, slice_locations, tolerance=_SLICE_TOLERANCE):
+    """
+    Matches lesion masks to slices by slice location, so that slices with no predictions (e.g. which were all
+    background) don't shift the masks of the slices after them.
+
+    :param np.ndarray mask_locations: the slice location of each mask, as returned by build_lesion_masks.
+    :param np.ndarray masks: a bool array of shape (n_masks, rows, cols), as returned by build_lesion_masks.
+    :param slice_locations: the slice locations to match the masks to.
+    :param float tolerance: the furthest a mask may be from its slice.
+    :return: a bool array of shape (len(slice_locations), rows, cols), all False for slices without a mask.
+    :rtype: np.ndarray
+    """
+    slice_locations = np.asarray(slice_locations, dtype="float64")
+    by_slice = np.zeros((len(slice_locations),) + masks.shape[1:], dtype=bool)
+    if len(mask_locations) and len(slice_locations):
+        nearest = np.abs(slice_locations[:, np.newaxis] - mask_locations[np.newaxis, :]).argmin(axis=1)
+        matched = np.isclose(mask_locations[nearest], slice_locations, rtol=0, atol=tolerance)
+        by_slice[matched] = masks[nearest[matched]]
+        unmatched = np.setdiff1d(np.arange(len(mask_locations)), nearest[matched])
+        if len(unmatched):
+            print("WARNING: predictions at slice location(s) {} match no slice, skipping them...".format(", ".join(str(loc) for loc in mask_locations[unmatched])))
+    return by_slice
+
+def render_overlay(dcm_path, lesion_mask, png_path, color=RED, alpha=1.0):
+    """
+    Blends color onto the rescaled DCM wherever lesion_mask is set (and the DCM isn't background), and writes it as a PNG.
+
+    :param str dcm_path: the DCM to overlay.
+    :param np.ndarray lesion_mask: a bool array with the DCM's shape.
+    :param str png_path: where to write the PNG.
+    :param tuple color: the (r, g, b) color to highlight with.
+    :param float alpha: the opacity of the highlight, from 0 to 1.
+    :return: png_path
+    :rtype: str
+    """
+    pixels = pydicom.dcmread(dcm_path).pixel_array
+    picture = np.repeat(rescale_to_uint8(pixels)[:, :, np.newaxis], 3, axis=2)
+    highlight = lesion_mask & (pixels > _MIN_HIGHLIGHT_INTENSITY)
+    picture[highlight] = np.uint8((1 - alpha) * picture[highlight] + alpha * np.array(color))
+    Image.fromarray(picture, 'RGB').save(png_path)
+    return png_path
+
+def patient_render_tasks(prediction_csv, patient_no, workers=1):
+    """
+    Recreates ./Patients/<patient_no>/labeled_perfusions, and lists the work needed to render one overlay per slice of
+    the patient's first perfusion acquisition into it.
+    Prediction slices are matched to perfusion slices by slice location (see masks_by_slice).
+
+    :param str prediction_csv: a CSV with rows of x,y,z,label.
+    :param int patient_no: the patient's number.
+    :param int workers: the number of processes to read stale headers with (see dicom_index.index_directory).
+    :return: a list of (dcm_path, lesion_mask, png_path) tuples, for render_overlay.
+    :rtype: list
+    """
+    dcm_dir = "./Patients/{0}/Perfusion".format(patient_no)
+    index = di.index_directory(dcm_dir, workers) # header-only, and cached between runs
+    one_brain = di.group_by_slice(index, acquisition_number=1)
+    slice_locations = sorted(one_brain.keys())
+    ordered_one_brain_slices = [one_brain[slice_loc][0] for slice_loc in slice_locations]
+    first = index[ordered_one_brain_slices[0]]
+    mask_locations, masks = build_lesion_masks(prediction_csv, (first["rows"], first["columns"]))
+    masks = masks_by_slice(mask_locations, masks, slice_locations)
+
+    labeled_perfusions_dir = "./Patients/{0}/labeled_perfusions".format(patient_no)
+    if os.path.isdir(labeled_perfusions_dir):
+        shutil.rmtree(labeled_perfusions_dir)
+    os.makedirs(labeled_perfusions_dir)
+
+    tasks = []
+    for lesion_mask, dcm_file_name in zip(masks, ordered_one_brain_slices):
+        png_file = dcm_file_name.split(".")[0] + ".png"
+        tasks.append((os.path.join(dcm_dir, dcm_file_name), lesion_mask, os.path.join(labeled_perfusions_dir, png_file)))
+    return tasks
 
 # works for if for if format is x,y,z,label and z represents slice_location
-def main():
-    stroke_output_dir = "./stroke_outputs"
-
-    for csv_file in os.listdir(stroke_output_dir):
+def main(stroke_output_dir="./stroke_outputs", workers=1):
+    tasks = []
+    for csv_file in sorted(os.listdir(stroke_output_dir)):
         if csv_file.endswith(".csv"):
-            file_handler = open(os.path.join(stroke_output_dir, csv_file), "r")
             patient_no = int(csv_file.split("_")[0]) # assuming that the csv is named "<patient number>_stroke_output.csv"
+            tasks.extend(patient_render_tasks(os.path.join(stroke_output_dir, csv_file), patient_no, workers))
 
-            labels_data = [line.strip().split(",") for line in file_handler.readlines()]
-            labels_data[0][0] = labels_data[0][0].replace(u'\ufeff', '') # remove the character that comes with excel csv
-
-            slice_locations = sorted(set([float(label_data[2]) for label_data in labels_data])) # grabs all the unique slice_locations and orders them
-
-            slice_pixels = {}
-            for label_data in labels_data:
-                
-                x_coord = int(float(label_data[0]))
-                y_coord = int(float(label_data[1]))
-                z_coord = slice_locations.index(float(label_data[2])) # e.g. slice number
-                label = int(float(label_data[3]))
-                has_stroke_tissue = 1
-                if label == has_stroke_tissue:
-                    if z_coord not in slice_pixels.keys():
-                        slice_pixels[z_coord] = []
-                    slice_pixels[z_coord].append((y_coord, x_coord))
-
-            dcm_dir = "./Patients/{0}/Perfusion".format(patient_no)
-            one_brain = {}
-
-            for dcm_file in os.listdir(dcm_dir):
-                if dcm_file.endswith(".dcm"):
-                    dcm = pydicom.dcmread(os.path.join(dcm_dir, dcm_file))
-                    acquisition_no = dcm.AcquisitionNumber
-                    slice_loc = dcm.SliceLocation
-                    if acquisition_no == 1:
-                        one_brain[slice_loc] = dcm_file
-            
-            ordered_one_brain_slices = []
-            sorted_slice_locs = sorted(one_brain.keys())
-            for slice_loc in sorted_slice_locs:
-                if slice_loc in one_brain.keys():
-                    ordered_one_brain_slices.append(one_brain[slice_loc])
-            
-            labeled_perfusions_dir = "./Patients/{0}/labeled_perfusions".format(patient_no)
-            if not os.path.isdir(labeled_perfusions_dir):
-                os.system("mkdir {0}".format(labeled_perfusions_dir))
-            else: 
-                os.system("rm -rf {0}".format(labeled_perfusions_dir))
-                os.system("mkdir {0}".format(labeled_perfusions_dir))
-
-            for dcm_file in ordered_one_brain_slices:
-                os.system("cp {0} {1}".format(os.path.join(dcm_dir, dcm_file), os.path.join(labeled_perfusions_dir, dcm_file)))
-            
-            dicom2png(labeled_perfusions_dir, labeled_perfusions_dir)
-            
-            
-            for z_coord, x_y_coords in slice_pixels.items():
-                dcm_file_name = ordered_one_brain_slices[z_coord]
-
-                dcm = pydicom.read_file(os.path.join(labeled_perfusions_dir, dcm_file_name))
-                dcm_pixels = dcm.pixel_array
-
-                png_file = dcm_file_name.split(".")[0] + ".png"
-                picture = Image.open(os.path.join(labeled_perfusions_dir, png_file))
-                width, height = picture.size
-                if picture.mode != 'RGB':
-                    picture = picture.convert('RGB')
-
-                red = (255, 0, 0)
-                green = (0, 255, 0)
-                blue = (0, 0, 255)
-                
-                for x_y_coord in x_y_coords:
-                    y_coord = x_y_coord[0]j
-                    x_coord = x_y_coord[1]
-                    if x_coord >= 0 and y_coord >= 0 and x_coord < width and y_coord < height and dcm_pixels[x_coord, y_coord] > 100:
-                        picture.putpixel(x_y_coord, red)
-                os.system("rm {0}".format(os.path.join(labeled_perfusions_dir, dcm_file_name)))
-                picture.save(os.path.join(labeled_perfusions_dir, png_file))
-            
-            
-            
-            
-        
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            if tasks:
+                list(executor.map(render_overlay, *zip(*tasks), chunksize=4))
+    else:
+        for task in tasks:
+            render_overlay(*task)
+    print("Rendered {} slices".format(len(tasks)))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parser.parse_args()
+    main(args.stroke_output_dir, args.workers)
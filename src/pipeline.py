@@ -0,0 +1,368 @@
+# :: pipeline.py
+#####################################################
+# Runs registration -> CSV generation -> training,
+# re-executing only the stages and patients whose
+# inputs have changed since the last run.
+#####################################################
+# :: Created By: Benji Brandt <benjibrandt@ucla.edu>,
+#                Roy Lin <rlin2k1@gmail.com>,
+#                David Macaraeg <dmacaraeg@g.ucla.edu>
+# :: Creation Date: 18 October 2026
+
+# Standard Library, whole imports
+import os
+import argparse
+import hashlib
+import json
+import shutil
+import time
+
+# Standard Library, specific imports
+from concurrent.futures import ProcessPoolExecutor
+
+# Dependency Imports
+import numpy as np
+from joblib import dump
+
+# Local Imports
+import data_processing as dp
+import dicom_index as di
+import generate_csvs as gc
+import image_processing as ip
+from classify_voxels import get_models, make_model_pipeline
+from utilities import load_model_data
+
+# ----------------------------------------------------------------------------
+#  Argument Parsing
+# ----------------------------------------------------------------------------
+
+parser = argparse.ArgumentParser(description="Runs registration, CSV generation and training, reusing cached results for unchanged inputs.")
+
+parser.add_argument("directory_name", action="store", help="The directory containing information for all patients, structured as for generate_csvs.py.")
+parser.add_argument("sample_count", action="store", type=int, help="The number of intensity values to obtain for interpolation.")
+parser.add_argument("nlive", action="store", type=int, help="The number of intensity arrays which represent surviving pixels to sample.")
+parser.add_argument("ndie", action="store", type=int, help="The number of intensity arrays which represent dying pixels to sample.")
+parser.add_argument("model_name", action="store", choices=sorted(get_models().keys()), help="The model to train on every patient's training data.")
+parser.add_argument("-r", "--register", action="store", dest="mapping_csv", default=None, help="Register labeled FLAIRs first, using a register_images.py mapping CSV. Otherwise each patient's FLAIR directory is used as-is.")
+parser.add_argument("-f", "--format", action="store", dest="output_format", choices=["csv", "store"], default="csv", help="The format to generate each patient's data sets in.")
+parser.add_argument("-s", "--seed", action="store", type=int, dest="seed", default=0, help="The seed for sampling surviving and dying pixels. Generated data is only reused for the same seed.")
+parser.add_argument("-t", "--slice-tolerance", action="store", type=float, dest="slice_tolerance", default=None, help="How far a FLAIR slice may be from its perfusion slice, as for generate_csvs.py.")
+parser.add_argument("--strict-alignment", action="store_true", dest="strict_alignment", default=False, help="Fail a patient if any FLAIR slice has no perfusion slice within tolerance, as for generate_csvs.py.")
+parser.add_argument("--features", action="store", dest="features", choices=dp.FEATURE_SETS, default="intensities", help="The features to generate per voxel, as for generate_csvs.py.")
+parser.add_argument("--signal-drop", action="store_true", dest="signal_drop", default=False, help="For --features hemodynamic, measure enhancement as the signal's drop below its baseline, as for generate_csvs.py.")
+parser.add_argument("-n", "--neighbourhood", action="store", type=int, dest="neighbourhood", default=0, help="The width of the neighbourhood whose statistics are appended to each voxel's features, as for generate_csvs.py.")
+parser.add_argument("-b", "--background-threshold", action="store", type=float, dest="background_threshold", default=ip.BACKGROUND_THRESHOLD, help="The mean intensity at or below which voxels are background, as for generate_csvs.py.")
+parser.add_argument("-w", "--workers", action="store", type=int, dest="workers", default=1, help="The number of patients to process in parallel.")
+parser.add_argument("--cache-dir", action="store", dest="cache_dir", default=".pipeline_cache", help="The directory to cache stage outputs in.")
+parser.add_argument("-o", "--output-dir", action="store", dest="output_dir", default="pipeline_outputs", help="The directory to publish the latest outputs to.")
+
+# ----------------------------------------------------------------------------
+#  Constants
+# ----------------------------------------------------------------------------
+
+_DIGESTS_FILE = "file_digests.json"
+_COMPLETE_FILE = "complete.json"
+_REPORT_FILE = "pipeline_report.json"
+
+# ----------------------------------------------------------------------------
+#  Functions
+# ----------------------------------------------------------------------------
+
+class PipelineCache:
+    def __init__(self, cache_dir):
+        """
+        A content-addressed store of stage outputs, at cache_dir/{stage}/{key}, plus a report of hits and misses.
+        File contents are hashed at most once per (size, mtime); those digests persist in cache_dir between runs.
+
+        :param str cache_dir: the directory to cache stage outputs in. Created if needed.
+        """
+        self.cache_dir = cache_dir
+        self.report = []
+        os.makedirs(cache_dir, exist_ok=True)
+        digests_path = os.path.join(cache_dir, _DIGESTS_FILE)
+        self._digests = {}
+        if os.path.exists(digests_path):
+            with open(digests_path, "r") as digests_file:
+                self._digests = json.load(digests_file)
+
+    def file_digest(self, path):
+        """
+        Hashes the contents of a file, reusing the previous digest if its size and mtime are unchanged.
+
+        :param str path:
+        :return: the file's sha256 hex digest.
+        :rtype: str
+        """
+        stat = os.stat(path)
+        memo_key = os.path.abspath(path)
+        memo = self._digests.get(memo_key)
+        if memo is not None and memo[0] == stat.st_size and memo[1] == stat.st_mtime_ns:
+            return memo[2]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        self._digests[memo_key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def fingerprint(self, paths, **params):
+        """
+        Fingerprints a stage's inputs: the names and contents of its input files, and its parameters.
+
+        :param list paths: the stage's input files.
+        :param params: the stage's parameters; must be JSON-serializable.
+        :return: a hex digest, which changes if any input file or parameter does.
+        :rtype: str
+        """
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode())
+        for path in sorted(paths):
+            digest.update(os.path.basename(path).encode())
+            digest.update(self.file_digest(path).encode())
+        return digest.hexdigest()
+
+    def entry(self, stage, key):
+        """
+        :return: the directory holding the cached outputs of stage for key.
+        :rtype: str
+        """
+        return os.path.join(self.cache_dir, stage, key)
+
+    def is_cached(self, stage, key):
+        """
+        :return: True if stage has completed for key, else False.
+        :rtype: bool
+        """
+        return os.path.exists(os.path.join(self.entry(stage, key), _COMPLETE_FILE))
+
+    def begin(self, stage, key):
+        """
+        Clears and creates the directory for a stage's outputs, ahead of running it.
+
+        :return: the entry directory.
+        :rtype: str
+        """
+        entry = self.entry(stage, key)
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.makedirs(entry)
+        return entry
+
+    def complete(self, stage, key, item, seconds, **details):
+        """
+        Marks a stage's outputs as complete, so later runs with the same key reuse them.
+        """
+        with open(os.path.join(self.entry(stage, key), _COMPLETE_FILE), "w") as complete_file:
+            json.dump(dict(item=item, seconds=seconds, **details), complete_file)
+
+    def record(self, stage, item, key, hit, seconds=0.0):
+        """
+        Records a cache hit or miss in the report.
+        """
+        self.report.append({"stage": stage, "item": item, "key": key, "status": "hit" if hit else "miss", "seconds": seconds})
+
+    def save(self):
+        """
+        Persists file digests for the next run.
+        """
+        digests_path = os.path.join(self.cache_dir, _DIGESTS_FILE)
+        with open(digests_path + ".tmp", "w") as digests_file:
+            json.dump(self._digests, digests_file)
+        os.replace(digests_path + ".tmp", digests_path)
+
+
+def _dcm_files(directory_name):
+    return [os.path.join(directory_name, file) for file in os.listdir(directory_name) if file.endswith(".dcm")]
+
+
+def _flair_inputs(directory_name):
+    """The FLAIR DCMs, plus the registration manifest which names the file of each slice (see image_processing.flair_files)."""
+    manifest = os.path.join(directory_name, di.REGISTRATION_MANIFEST)
+    return _dcm_files(directory_name) + ([manifest] if os.path.exists(manifest) else [])
+
+
+def register_stage(cache, mappings, workers=1):
+    """
+    Registers each patient's labeled FLAIRs (see register_images.py), reusing cached results for patients whose
+    fixed, moving and labeled images are all unchanged.
+
+    :param PipelineCache cache:
+    :param list mappings: tuples of (number, flair, perfusion), as in register_images.py's MAPPINGCSV.
+    :param int workers: the number of processes to register in.
+    :return: a dictionary of the form {patient: directory_of_registered_flairs}
+    :rtype: dict
+    """
+    keys = {}
+    for number, flair, perfusion in mappings:
+        inputs = ["Patients/" + number + "/Perfusion/" + perfusion, "Patients/" + number + "/FLAIR/" + flair] + _dcm_files("Labeled/" + number)
+        keys[number] = cache.fingerprint(inputs, stage="register")
+    misses = []
+    for mapping in mappings:
+        if cache.is_cached("register", keys[mapping[0]]):
+            cache.record("register", mapping[0], keys[mapping[0]], hit=True)
+        else:
+            misses.append(mapping)
+
+    if misses:
+        import register_images # SimpleElastix is only needed when something must be registered
+        start_time = time.time()
+        register_images.register_patients(misses, workers)
+        seconds = (time.time() - start_time) / len(misses)
+        for number, _, _ in misses:
+            entry = cache.begin("register", keys[number])
+            shutil.copytree("RESULTS/" + number, os.path.join(entry, "FLAIR"))
+            cache.complete("register", keys[number], number, seconds)
+            cache.record("register", number, keys[number], hit=False, seconds=seconds)
+    return {number: os.path.join(cache.entry("register", keys[number]), "FLAIR") for (number, _, _) in mappings}
+
+
+def generate_stage(cache, structured_directory, flair_directories, sample_count, nlive, ndie, output_format="csv", seed=0, workers=1, **options):
+    """
+    Generates each patient's training and test data (see generate_csvs.py), reusing cached results for patients whose
+    perfusion and FLAIR DCMs, FLAIR registration manifest, the generation parameters and generate_csvs.OUTPUT_VERSION are all unchanged.
+    Sampling must be seeded, since unseeded results could never be reproduced from the cache.
+
+    :param PipelineCache cache:
+    :param str structured_directory: the directory containing information for all patients.
+    :param dict flair_directories: {patient: directory_of_registered_flairs} overriding each patient's FLAIR directory.
+    :param int sample_count: the number of intensity values to obtain for interpolation.
+    :param int nlive: roughly how many pixel coordinates we wish to obtain for living pixels
+    :param int ndead: roughly how many pixel coordinates we wish to obtain for dead pixels
+    :param str output_format: either "csv" or "store".
+    :param int seed: the seed for sampling pixels.
+    :param int workers: the number of patients to process in parallel.
+    :param options: any other keyword arguments of generate_csvs.process_patient, e.g. features="hemodynamic".
+    :return: a dictionary of the form {patient: (key, entry_directory)}
+    :rtype: dict
+    """
+    if seed is None:
+        raise ValueError("Generating data in the pipeline needs a seed, so that cached data is reproducible")
+    params = dict(options, stage="generate", version=gc.OUTPUT_VERSION, sample_count=sample_count, nlive=nlive, ndie=ndie, output_format=output_format, seed=seed)
+    entries = {}
+    misses = []
+    for patient_directory, patient in gc.find_patient_directories(structured_directory):
+        flair_directory = flair_directories.get(patient, os.path.join(patient_directory, gc._FLAIR))
+        inputs = _dcm_files(os.path.join(patient_directory, gc._PERFUSION)) + _flair_inputs(flair_directory)
+        key = cache.fingerprint(inputs, **params)
+        entries[patient] = (key, cache.entry("generate", key))
+        if cache.is_cached("generate", key):
+            cache.record("generate", patient, key, hit=True)
+        else:
+            misses.append((patient_directory, patient, flair_directory, cache.begin("generate", key), key))
+
+    def generated(patient, key, summary):
+        cache.complete("generate", key, patient, summary["seconds"], training_rows=summary["training_rows"], test_rows=summary["test_rows"])
+        cache.record("generate", patient, key, hit=False, seconds=summary["seconds"])
+
+    if workers > 1 and len(misses) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [(patient, key, executor.submit(gc.process_patient, patient_directory, patient, sample_count, nlive, ndie, output_format, seed, output_dir=entry, flair_directory=flair_directory, **options))
+                       for (patient_directory, patient, flair_directory, entry, key) in misses]
+            for patient, key, future in futures:
+                generated(patient, key, future.result())
+    else:
+        for patient_directory, patient, flair_directory, entry, key in misses:
+            generated(patient, key, gc.process_patient(patient_directory, patient, sample_count, nlive, ndie, output_format, seed, output_dir=entry, flair_directory=flair_directory, **options))
+    return entries
+
+
+def train_stage(cache, generated, model_name, output_format="csv"):
+    """
+    Trains model_name on every patient's training data (see classify_voxels.py), reusing the cached model if neither
+    any patient's generated data nor the model has changed.
+
+    :param PipelineCache cache:
+    :param dict generated: {patient: (key, entry_directory)}, as returned by generate_stage.
+    :param str model_name: a model name, as in classify_voxels.get_models.
+    :param str output_format: the format the training data was generated in.
+    :return: the path of the dumped model pipeline.
+    :rtype: str
+    """
+    patients = sorted(generated.keys(), key=int)
+    key = hashlib.sha256(json.dumps({"stage": "train", "model_name": model_name, "generated": [generated[patient][0] for patient in patients]}).encode()).hexdigest()
+    model_path = os.path.join(cache.entry("train", key), model_name + ".joblib")
+    if cache.is_cached("train", key):
+        cache.record("train", model_name, key, hit=True)
+        return model_path
+
+    start_time = time.time()
+    X, y = [], []
+    for patient in patients:
+        data = load_model_data(os.path.abspath(gc.patient_output_path(patient, "training", output_format, generated[patient][1])), header=1, predict_col=0)
+        X.append(data.X)
+        y.append(data.y)
+    pipeline = make_model_pipeline(get_models()[model_name])
+    pipeline.fit(np.concatenate(X), np.concatenate(y))
+    cache.begin("train", key)
+    dump(pipeline, model_path)
+    seconds = time.time() - start_time
+    cache.complete("train", key, model_name, seconds)
+    cache.record("train", model_name, key, hit=False, seconds=seconds)
+    return model_path
+
+
+def _publish(source, output_dir):
+    destination = os.path.join(output_dir, os.path.basename(source))
+    if os.path.isdir(destination):
+        shutil.rmtree(destination)
+    if os.path.isdir(source):
+        shutil.copytree(source, destination)
+    else:
+        shutil.copy2(source, destination)
+
+
+def print_cache_report(report):
+    """
+    Prints a table of cache hits and misses per stage and item, followed by per-stage totals.
+
+    :param list report: the report of a PipelineCache.
+    """
+    print("{:>10} {:>24} {:>6} {:>10}".format("Stage", "Item", "Cache", "Seconds"))
+    for row in report:
+        print("{:>10} {:>24} {:>6} {:>10.2f}".format(row["stage"], row["item"], row["status"], row["seconds"]))
+    for stage in ["register", "generate", "train"]:
+        rows = [row for row in report if row["stage"] == stage]
+        if rows:
+            hits = sum(1 for row in rows if row["status"] == "hit")
+            print("{}: {} hits, {} misses".format(stage, hits, len(rows) - hits))
+
+
+def run_pipeline(structured_directory, sample_count, nlive, ndie, model_name, mapping_csv=None, output_format="csv", seed=0, workers=1, cache_dir=".pipeline_cache", output_dir="pipeline_outputs", **options):
+    """
+    Runs every stage, publishes the outputs to output_dir, and reports cache hits and misses.
+    See the argument parser above for a description of each parameter; options are passed to generate_stage.
+
+    :return: the report of cache hits and misses, a list of dicts.
+    :rtype: list
+    """
+    cache = PipelineCache(cache_dir)
+    try:
+        flair_directories = {}
+        if mapping_csv is not None:
+            with open(mapping_csv, "r") as f:
+                mappings = [tuple(line.strip().split(",")[:3]) for line in f if line.strip()]
+            flair_directories = register_stage(cache, mappings, workers)
+        generated = generate_stage(cache, structured_directory, flair_directories, sample_count, nlive, ndie, output_format, seed, workers, **options)
+        model_path = train_stage(cache, generated, model_name, output_format)
+    finally:
+        cache.save()
+
+    os.makedirs(output_dir, exist_ok=True)
+    for patient, (_, entry) in generated.items():
+        for kind in ["training", "test"]:
+            _publish(gc.patient_output_path(patient, kind, output_format, entry), output_dir)
+    _publish(model_path, output_dir)
+    with open(os.path.join(output_dir, _REPORT_FILE), "w") as report_file:
+        json.dump(cache.report, report_file, indent=2)
+    print_cache_report(cache.report)
+    return cache.report
+
+# ----------------------------------------------------------------------------
+#  Main
+# ----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    run_pipeline(str(args.directory_name), args.sample_count, args.nlive, args.ndie, args.model_name, args.mapping_csv,
+                 args.output_format, args.seed, args.workers, args.cache_dir, args.output_dir,
+                 slice_tolerance=args.slice_tolerance, strict_alignment=args.strict_alignment, features=args.features, signal_drop=args.signal_drop,
+                 neighbourhood=args.neighbourhood, background_threshold=args.background_threshold)
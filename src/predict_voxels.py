@@ -0,0 +1,247 @@
+""" predict_voxels.py
+This module predicts voxel classes with a model pipeline previously trained and
+dumped by classify_voxels.py, without touching the training data. Predictions
+are made either from a test CSV, or straight from a patient's perfusion DCMs
+into a 3-D label volume, with no intermediate CSVs at all.
+
+USAGE: python3 predict_voxels.py MODEL_JOBLIB PREDICTION_CSV [-o OUTPUT_CSV]
+       python3 predict_voxels.py MODEL_JOBLIB PERFUSION_DIR --perfusion
+           [--nifti OUTPUT_NII] [--dicom-dir OUTPUT_DIR]
+Export Functions: predict, predict_volume
+
+Author(s):
+    Roy Lin
+
+Date Created:
+    October 18th, 2026
+"""
+
+# ---------------------------------------------------------------------------- #
+# Import Statements for the Necessary Packages
+# ---------------------------------------------------------------------------- #
+from utilities import iter_test_chunks
+from instrumentation import stage
+import data_processing as dp
+import dicom_index as di
+import image_processing as ip
+
+import numpy as np
+import pydicom
+
+from joblib import load
+import argparse
+import os
+import time
+
+def predict_in_chunks(model, prediction_csv, output_csv, chunk_size=100000, header=1, predict_col=2):
+    """
+    Streams the voxels of prediction_csv through model, chunk_size rows at a
+    time, writing each chunk's predictions in bulk. Peak memory is bounded by
+    chunk_size rather than by the size of prediction_csv.
+    Each line of output_csv is: x,y,z,predicted_class
+
+    Args:
+        model (Pipeline): Fitted Pipeline, Standardizing Then Classifying
+        prediction_csv (string): Path to the Test CSV (or Feature Store)
+        output_csv (string): Path to Write Predictions To. Overwritten
+        chunk_size (integer): Number of Voxels Per Chunk
+        header (integer): Number of Header Lines in prediction_csv
+        predict_col (integer): Features Are the Columns After predict_col, the
+            z Coordinate's in a Test CSV From generate_csvs.py
+    Returns:
+        (integer): Number of Voxels Predicted
+    """
+    n = 0
+    with stage("predict_voxels.predict_in_chunks") as s, open(output_csv, "w") as log:
+        for coords, X_chunk in iter_test_chunks(prediction_csv, chunk_size, header=header, predict_col=predict_col):
+            y_pred = model.predict(X_chunk)
+            np.savetxt(log, np.column_stack((coords, y_pred)), fmt=['%d', '%d', '%.10g', '%d'], delimiter=',')
+            n += len(y_pred)
+            s.count(rows=len(y_pred), chunks=1)
+    return n
+
+def predict(model_path, prediction_csv, output_csv=None, chunk_size=100000):
+    """
+    Loads a pipeline dumped by classify_voxels.py and predicts every voxel of
+    prediction_csv with it.
+
+    Args:
+        model_path (string): Path to the Dumped Pipeline, e.g. RandomForest.joblib
+        prediction_csv (string): Path to the Test CSV (or Feature Store)
+        output_csv (string): Path to Write Predictions To. Defaults to the
+            Model's File Name With a .csv Extension
+        chunk_size (integer): Number of Voxels Per Chunk
+    Returns:
+        (integer): Number of Voxels Predicted
+    """
+    if output_csv is None:
+        output_csv = os.path.splitext(os.path.basename(model_path))[0] + ".csv"
+    model = load(model_path)
+    return predict_in_chunks(model, prediction_csv, output_csv, chunk_size=chunk_size)
+
+def model_sample_count(model):
+    """
+    Finds how many resampled intensities per voxel a pipeline was trained on.
+
+    Args:
+        model (Pipeline): Fitted Pipeline, Standardizing Then Classifying
+    Returns:
+        (integer): Number of Features the Pipeline's Scaler Was Fitted On
+    """
+    return model.named_steps['scaler'].mean_.shape[0]
+
+def predict_volume(model, perfusion_directory, chunk_size=100000, features="intensities", signal_drop=False, neighbourhood=0, background_threshold=ip.BACKGROUND_THRESHOLD):
+    """
+    Predicts every voxel of a patient straight from their perfusion DCMs. The
+    series is decoded into one array (see image_processing.load_perfusion_volume),
+    the features of each slice's curves are computed in bulk (see
+    data_processing.extract_slice_features), then standardized and classified by the
+    pipeline, chunk_size voxels at a time. Nothing is written to disk.
+
+    Args:
+        model (Pipeline): Fitted Pipeline, Standardizing Then Classifying
+        perfusion_directory (string): Path to the Patient's Perfusion DCMs
+        chunk_size (integer): Number of Voxels to Predict at a Time
+        features (string): Feature Set the Pipeline Was Trained On, as Passed to generate_csvs.py
+        signal_drop (boolean): For "hemodynamic" Features, as Passed to generate_csvs.py
+        neighbourhood (integer): Width of the Neighbourhood Statistics the Pipeline Was Trained On, as Passed to generate_csvs.py
+        background_threshold (float): Mean Intensity At or Below Which Voxels Are Background, and Not Classified (see image_processing.brain_mask)
+    Returns:
+        (Numpy Array of Shape (n_slices, rows, cols)): Predicted Class Per
+            Voxel, 0 Outside of the Brain Mask
+        (Numpy Array of Shape (n_slices,)): Slice Locations, Ascending
+    """
+    n_features = model_sample_count(model)
+    sample_count = n_features - (len(dp.NEIGHBOURHOOD_FEATURES) if neighbourhood else 0) # for "intensities"
+    if len(dp.feature_names(features, sample_count, neighbourhood)) != n_features or sample_count < 1:
+        raise ValueError("The model was trained on {} features, which don't match --features {} and --neighbourhood {}".format(n_features, features, neighbourhood))
+    with stage("predict_voxels.predict_volume") as s:
+        volume, slice_locations, times, mask = ip.load_perfusion_volume(perfusion_directory, background_threshold)
+        labels = np.zeros(mask.shape, dtype=np.int16)
+        for z in range(len(slice_locations)):
+            rows, cols = np.nonzero(mask[z])
+            neighbourhood_stats = dp.neighbourhood_maps(volume[z], neighbourhood) if neighbourhood else None
+            for start in range(0, len(rows), chunk_size):
+                r, c = rows[start:start + chunk_size], cols[start:start + chunk_size]
+                labels[z, r, c] = model.predict(dp.extract_slice_features(times[z], volume[z], r, c, sample_count, features, signal_drop, neighbourhood_stats))
+            s.count(voxels=len(rows))
+    return labels, slice_locations
+
+def reference_dicoms(perfusion_directory):
+    """
+    Finds one DCM per slice of the patient's first perfusion acquisition, to
+    take geometry and patient metadata from.
+
+    Args:
+        perfusion_directory (string): Path to the Patient's Perfusion DCMs
+    Returns:
+        (list): Paths of the DCMs, Ordered by Slice Location
+    """
+    one_brain = di.group_by_slice(di.index_directory(perfusion_directory))
+    return [os.path.join(perfusion_directory, one_brain[slice_loc][0]) for slice_loc in sorted(one_brain.keys())]
+
+def write_nifti_mask(labels, slice_locations, perfusion_directory, output_path):
+    """
+    Writes a label volume as a NIfTI image, with voxel sizes taken from the
+    perfusion DCMs' pixel spacing and slice locations.
+
+    Args:
+        labels (Numpy Array of Shape (n_slices, rows, cols)): Predicted Classes
+        slice_locations (Numpy Array of Shape (n_slices,)): Slice Locations
+        perfusion_directory (string): Path to the Patient's Perfusion DCMs
+        output_path (string): Path to Write the Image To, e.g. mask.nii.gz
+    Returns:
+        (string): output_path
+    """
+    import nibabel as nib # Only Needed for NIfTI Output
+
+    reference = pydicom.dcmread(reference_dicoms(perfusion_directory)[0], stop_before_pixels=True)
+    row_spacing, col_spacing = [float(spacing) for spacing in getattr(reference, 'PixelSpacing', (1.0, 1.0))]
+    slice_spacing = float(np.median(np.diff(slice_locations))) if len(slice_locations) > 1 else 1.0
+    affine = np.diag([col_spacing, row_spacing, slice_spacing, 1.0])
+    affine[2, 3] = slice_locations[0]
+    nib.save(nib.Nifti1Image(np.transpose(labels, (2, 1, 0)), affine), output_path) # NIfTI Is Indexed (x, y, z)
+    return output_path
+
+def write_dicom_mask(labels, perfusion_directory, output_directory):
+    """
+    Writes a label volume as a new DCM series, one file per slice, copying the
+    geometry and patient metadata of the first perfusion acquisition.
+
+    Args:
+        labels (Numpy Array of Shape (n_slices, rows, cols)): Predicted Classes
+        perfusion_directory (string): Path to the Patient's Perfusion DCMs
+        output_directory (string): Directory to Write the Series To
+    Returns:
+        (list): Paths of the Written DCMs, Ordered by Slice Location
+    """
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    series_uid = pydicom.uid.generate_uid()
+    paths = []
+    for z, reference_path in enumerate(reference_dicoms(perfusion_directory)):
+        dcm = pydicom.dcmread(reference_path)
+        dcm.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian # Pixels Are Rewritten Uncompressed
+        dcm.is_little_endian = True
+        dcm.is_implicit_VR = False
+        dcm.SeriesInstanceUID = series_uid
+        dcm.SOPInstanceUID = pydicom.uid.generate_uid()
+        dcm.file_meta.MediaStorageSOPInstanceUID = dcm.SOPInstanceUID
+        dcm.SeriesDescription = 'Predicted Stroke Tissue'
+        dcm.SamplesPerPixel = 1
+        dcm.PhotometricInterpretation = 'MONOCHROME2'
+        dcm.BitsAllocated = 16
+        dcm.BitsStored = 16
+        dcm.HighBit = 15
+        dcm.PixelRepresentation = 1
+        dcm.PixelData = labels[z].astype('<i2').tobytes()
+        path = os.path.join(output_directory, os.path.basename(reference_path))
+        dcm.save_as(path)
+        paths.append(path)
+    return paths
+
+def main():
+    # ------------------------------------------------------------------------ #
+    # Parse Command Line Arguments
+    # ------------------------------------------------------------------------ #
+    parser = argparse.ArgumentParser(description="Predicts voxel classes with a model trained by classify_voxels.py.")
+
+    parser.add_argument("model_path", action="store", help="Indicate the path to the .joblib pipeline dumped by classify_voxels.py.")
+
+    parser.add_argument("prediction_csv", action="store", help="Indicate the path to the csv for the model to predict on, or with --perfusion, the patient's perfusion DCM directory.")
+
+    parser.add_argument("-p", "--perfusion", action="store_true", default=False, help="Predict every voxel straight from the perfusion DCMs in prediction_csv, without any intermediate CSVs.")
+
+    parser.add_argument("--nifti", action="store", default=None, dest="nifti_path", help="With --perfusion, write the predicted label volume as a NIfTI image to this path, e.g. mask.nii.gz.")
+
+    parser.add_argument("--dicom-dir", action="store", default=None, dest="dicom_dir", help="With --perfusion, write the predicted label volume as a DCM series into this directory.")
+
+    parser.add_argument("--features", action="store", choices=dp.FEATURE_SETS, default="intensities", help="With --perfusion, the features the model was trained on, as passed to generate_csvs.py.")
+
+    parser.add_argument("--signal-drop", action="store_true", default=False, dest="signal_drop", help="With --perfusion and --features hemodynamic, as passed to generate_csvs.py.")
+
+    parser.add_argument("-n", "--neighbourhood", action="store", type=int, default=0, help="With --perfusion, the neighbourhood width the model was trained with, as passed to generate_csvs.py.")
+
+    parser.add_argument("-b", "--background-threshold", action="store", type=float, default=ip.BACKGROUND_THRESHOLD, dest="background_threshold", help="With --perfusion, the mean intensity at or below which voxels are background, and left unclassified, as for generate_csvs.py.")
+
+    parser.add_argument("-o", "--output", action="store", default=None, dest="output_csv", help="Indicate the path to write predictions to. Defaults to {model_name}.csv.")
+
+    parser.add_argument("-c", "--chunk-size", action="store", type=int, default=100000, dest="chunk_size", help="The number of voxels to read, predict and write at a time, which bounds memory usage.")
+
+    args = parser.parse_args()
+
+    if args.perfusion:
+        start_time = time.time()
+        labels, slice_locations = predict_volume(load(args.model_path), args.prediction_csv, args.chunk_size, args.features, args.signal_drop, args.neighbourhood, args.background_threshold)
+        print("Predicted", labels.shape[0], "Slices in", str(time.time() - start_time), "Seconds:", int((labels == 1).sum()), "Voxels of Stroke Tissue")
+        if args.nifti_path:
+            print("Wrote", write_nifti_mask(labels, slice_locations, args.prediction_csv, args.nifti_path))
+        if args.dicom_dir:
+            print("Wrote", len(write_dicom_mask(labels, args.prediction_csv, args.dicom_dir)), "DCMs to", args.dicom_dir)
+        return
+
+    n = predict(args.model_path, args.prediction_csv, args.output_csv, args.chunk_size)
+    print("Wrote", n, "Predictions")
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,8 @@ coordinate axis of the fixed image.
 
 Image Registration with SimpleITK
 
-USAGE: python2 register_images.py MAPPINGCSV
-Export Function: register_images
+USAGE: python3 register_images.py MAPPINGCSV [--workers N]
+Export Functions: register_images, register_patients
 
 Author(s):
     Roy Lin
@@ -22,8 +22,12 @@ import SimpleITK as sitk # Image Registration
 from matplotlib import pyplot as plt # Plot Images
 import sys # Command Line Arguments
 import matplotlib
-import pydicom # For Acquisition Number, Slice Location, and Time
+import dicom_index as di # For Acquisition Number, Slice Location, and Time
+from instrumentation import instrument # Per-Stage Timing, Enabled by STROKE_PROFILE
 import os, shutil # Directory Manipulation
+import argparse # Command Line Arguments
+import hashlib, json # Transform Cache
+from concurrent.futures import ProcessPoolExecutor # Parallel Registration
 
 # Print Whole NumPy Array
 import sys
@@ -33,129 +37,276 @@ numpy.set_printoptions(threshold=sys.maxsize)
 matplotlib.use('tkagg') # MacOS Support for Displaying Images
 
 # ---------------------------------------------------------------------------- #
-# Image Registration Function
+# Constants
 # ---------------------------------------------------------------------------- #
-def register_images(fixed_image_path, directory_path, moving_image_path, number):
+TRANSFORM_CACHE_DIR = "RESULTS/transforms"
+TRANSFORM_TYPE = 'translation'
+
+# Transformix Filters Already Set Up in This Process, Keyed by Parameter Files,
+# Each Stored With the (mtime, size) of Its Files When It Was Set Up
+_transformix_filters = {}
+
+# ---------------------------------------------------------------------------- #
+# Image Registration Functions
+# ---------------------------------------------------------------------------- #
+def read_2d_image(image_path):
     """
-    Takes one fixed image, a directory of moving images, one moving image, and a
-    number. Transforms all moving images in the directory to the coordinate 
-    plane of the fixed image. Creates a New Directory called 'RESULT' and stores
-    the registered Dicoms inside with file name: 
-        result_DICOMFILENAME_AcquitionNumber_AcquitionTime_SliceLocation.dcm
-    
+    Reads a DCM, translating the 3-D DCM image to a 2-D frame.
+
+    Args:
+        image_path (string): Path to the DCM.
+
+    Returns:
+        (SimpleITK Image): 2-D Image.
+    """
+    image = sitk.ReadImage(image_path)
+    return sitk.Extract(image, (image.GetWidth(), image.GetHeight(), 0), \
+        (0, 0, 0))
+
+def transform_cache_key(fixed_image_path, moving_image_path):
+    """
+    Fingerprints the inputs of a registration: the contents of the fixed and
+    moving images, and the kind of transform.
+
     Args:
         fixed_image_path (string): Path to the Fixed Image.
-        directory_path (string): Path to the Directory Containing Moving Images.
-            Directory pointed to by directory_path must have at least ONE Image 
-            File inside. Can Specify Which Image (moving.dcm) to Use as the 
-            Image to Make the Transformation Matrix.
         moving_image_path (string): Path to the Moving Image.
-        number (string): Number of the Patient.
 
     Returns:
-        (Void): None.
+        (string): Hex Digest Identifying the Registration.
     """
-    
-    # ------------------------------------------------------------------------ #
-    # Load the Inputted Images from Command Line
-    # ------------------------------------------------------------------------ #
-    fixed = sitk.ReadImage(fixed_image_path)
+    digest = hashlib.sha256(TRANSFORM_TYPE.encode())
+    for path in (fixed_image_path, moving_image_path):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
 
-    moving = sitk.ReadImage(os.path.join(directory_path, moving_image_path))
+@instrument(counts=lambda files: {"files": len(files)})
+def compute_transform(fixed_image_path, moving_image_path, number, cache_dir=TRANSFORM_CACHE_DIR):
+    """
+    Registers the moving image to the fixed image coordinate plane with Elastix,
+    and writes the resulting TransformParameterMap to cache_dir. If cache_dir
+    already holds a transform for the same fixed and moving images, the Elastix
+    optimization is skipped entirely.
 
-    # ------------------------------------------------------------------------ #
-    # Translate 3-D DCM Images to 2-D Frame. Lose 3rd Dimension
-    # ------------------------------------------------------------------------ #
-    fixed = sitk.Extract(fixed, (fixed.GetWidth(), fixed.GetHeight(), 0), \
-        (0, 0, 0))
-    moving = sitk.Extract(moving, (moving.GetWidth(), moving.GetHeight(), 0), \
-        (0, 0, 0))
+    Args:
+        fixed_image_path (string): Path to the Fixed Image.
+        moving_image_path (string): Path to the Moving Image.
+        number (string): Number of the Patient.
+        cache_dir (string): Directory to Cache Transforms In.
+
+    Returns:
+        (list): Paths of the Cached Transform Parameter Files, in Order.
+    """
+    key = transform_cache_key(fixed_image_path, moving_image_path)
+    manifest_path = os.path.join(cache_dir, number + '.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest['key'] == key and all(os.path.exists(path) for path in manifest['files']):
+            print("Patient", number, "Reusing Cached Transform")
+            return manifest['files']
 
+    print("Patient", number, "Registering")
     # ------------------------------------------------------------------------ #
     # Register the Moving Image to the Fixed Image Coordinate Plane
     # ------------------------------------------------------------------------ #
     # Parameter Map for Translation
-    parameterMap = sitk.GetDefaultParameterMap('translation')
+    parameterMap = sitk.GetDefaultParameterMap(TRANSFORM_TYPE)
 
     # Create an Elastix Instance
     elastixImageFilter = sitk.ElastixImageFilter()
-    elastixImageFilter.SetFixedImage(fixed)
-    elastixImageFilter.SetMovingImage(moving)
+    elastixImageFilter.SetFixedImage(read_2d_image(fixed_image_path))
+    elastixImageFilter.SetMovingImage(read_2d_image(moving_image_path))
     elastixImageFilter.SetParameterMap(parameterMap)
     elastixImageFilter.Execute()
 
     # Can Use Parameter Map for Future Images
-    registeredImage = elastixImageFilter.GetResultImage()
     transformationMap = elastixImageFilter.GetTransformParameterMap()
 
-    transformixImageFilter = sitk.TransformixImageFilter()
-    transformixImageFilter.SetTransformParameterMap(transformationMap)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    files = []
+    for i, transformParameters in enumerate(transformationMap):
+        path = os.path.join(cache_dir, number + '_' + str(i) + '.txt')
+        sitk.WriteParameterFile(transformParameters, path)
+        files.append(path)
+    with open(manifest_path, 'w') as f:
+        json.dump({'key': key, 'files': files}, f)
+    return files
+
+@instrument(counts=lambda output_path: {"images": 1})
+def transform_labeled_image(transform_files, file_path, output_path):
+    """
+    Applies a cached transform to one labeled image, and writes the result as
+    an Int16 DCM. The Transformix filter is set up once per process and
+    transform, then reused for every image until the transform's files are
+    rewritten (e.g. by compute_transform, when the images change).
+
+    Args:
+        transform_files (tuple): Paths of the Transform Parameter Files.
+        file_path (string): Path to the Labeled Image.
+        output_path (string): Path to Write the Registered Image To.
+
+    Returns:
+        (string): output_path.
+    """
+    transform_files = tuple(transform_files)
+    versions = tuple((os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in transform_files)
+    cached_versions, transformixImageFilter = _transformix_filters.get(transform_files, (None, None))
+    if cached_versions != versions: # Never Set Up, or Set Up From a Since Rewritten Transform
+        transformixImageFilter = sitk.TransformixImageFilter()
+        transformixImageFilter.SetTransformParameterMap(sitk.ReadParameterFile(transform_files[0]))
+        for path in transform_files[1:]:
+            transformixImageFilter.AddTransformParameterMap(sitk.ReadParameterFile(path))
+        _transformix_filters[transform_files] = (versions, transformixImageFilter)
+
+    transformixImageFilter.SetMovingImage(read_2d_image(file_path))
+    transformixImageFilter.Execute()
+
+    registeredImage = transformixImageFilter.GetResultImage()
+
+    castFilter = sitk.CastImageFilter()
+    castFilter.SetOutputPixelType(sitk.sitkInt16)
+    # Convert floating type image (imgSmooth) to int type (imgFiltered)
+    imgFiltered = castFilter.Execute(registeredImage)
+
+    sitk.WriteImage(imgFiltered, output_path)
+    return output_path
 
+def registration_manifest(number):
+    """
+    Describes every labeled image of the patient, as it will be registered into
+    RESULTS/number, with file name:
+        result_DICOMFILENAME_AcquitionNumber_AcquitionTime_SliceLocation.dcm
+    SimpleITK drops these headers when it writes the registered images, so
+    they're kept in a manifest instead (see dicom_index.write_registration_manifest).
+
+    Args:
+        number (string): Number of the Patient.
+
+    Returns:
+        (list): One Dict per Image, of the Form {"file", "source",
+            "slice_location", "acquisition_number", "acquisition_time"}.
+    """
+    labeled_index = di.index_directory('Labeled/' + number) # Header-Only Metadata, Cached Between Runs
+
+    images = []
+    for file in sorted(labeled_index.keys()):
+        record = labeled_index[file]
+        images.append({
+            "file": "result_" + file[:-4] + '_' + str(record["acquisition_number"]) + '_' + str(record["acquisition_time"]) + '_' + str(record["slice_location"]) + '.dcm',
+            "source": os.path.join('Labeled/' + number, file),
+            "slice_location": record["slice_location"],
+            "acquisition_number": record["acquisition_number"],
+            "acquisition_time": record["acquisition_time"],
+        })
+    return images
+
+def labeled_image_tasks(number, transform_files, images):
+    """
+    Clears RESULTS/number, and lists the work needed to register every labeled
+    image of the patient into it.
+
+    Args:
+        number (string): Number of the Patient.
+        transform_files (list): Paths of the Patient's Transform Parameter Files.
+        images (list): The Patient's Images, as From registration_manifest.
+
+    Returns:
+        (list): Arguments for transform_labeled_image, One Tuple per Image.
+    """
     dir = "RESULTS/" + number
     if os.path.exists(dir):
         shutil.rmtree(dir)
-    os.mkdir(dir)
-
-    fixed = sitk.GetArrayFromImage(fixed)
-
-    for file in os.listdir('Labeled/' + number):
-        if(file.endswith(".dcm")):
-            filePath = os.path.join('Labeled/' + number, file)
-            moving = sitk.ReadImage(filePath)
-            moving = sitk.Extract(moving, (moving.GetWidth(), \
-                moving.GetHeight(), 0), (0, 0, 0))
-            transformixImageFilter.SetMovingImage(moving)
-            transformixImageFilter.Execute()
-
-            dcm = pydicom.dcmread(filePath)
-
-            registeredImage = transformixImageFilter.GetResultImage()
-
-            castFilter = sitk.CastImageFilter()
-            castFilter.SetOutputPixelType(sitk.sitkInt16)
-            # Convert floating type image (imgSmooth) to int type (imgFiltered)
-            imgFiltered = castFilter.Execute(registeredImage)
-
-            sitk.WriteImage(imgFiltered, dir + "/result_" + file[:-4] + '_' + str(dcm.AcquisitionNumber) + '_' + str(dcm.AcquisitionTime) + '_' + str(dcm.SliceLocation) + '.dcm')
-
-            # ---------------------------------------------------------------- #
-            # Show Image Translations
-            # ---------------------------------------------------------------- #
-            # moving = sitk.GetArrayFromImage(moving)
-
-            # figure = plt.figure()
-            # subplot = figure.add_subplot(1, 3, 1)
-            # imgplot = plt.imshow(fixed)
-            # subplot.set_title('Before Surgery. First MRI')
-            # subplot = figure.add_subplot(1, 3, 2)
-            # imgplot = plt.imshow(moving)
-            # subplot.set_title('After Surgery. Second MRI')
-            # subplot = figure.add_subplot(1, 3, 3)
-            # imgplot = plt.imshow(registeredImage)
-            # subplot.set_title('Moving Surgery Label to 1st MRI Coord System')
-            # plt.show()
+    os.makedirs(dir)
+    return [(tuple(transform_files), image["source"], dir + "/" + image["file"]) for image in images]
+
+@instrument()
+def register_images(fixed_image_path, directory_path, moving_image_path, number):
+    """
+    Takes one fixed image, a directory of moving images, one moving image, and a
+    number. Transforms all moving images in the directory to the coordinate 
+    plane of the fixed image. Creates a New Directory called 'RESULT' and stores
+    the registered Dicoms inside with file name: 
+        result_DICOMFILENAME_AcquitionNumber_AcquitionTime_SliceLocation.dcm
+    The transform is cached (see compute_transform), so re-registering after a
+    labeling fix skips the Elastix optimization.
+    
+    Args:
+        fixed_image_path (string): Path to the Fixed Image.
+        directory_path (string): Path to the Directory Containing Moving Images.
+            Directory pointed to by directory_path must have at least ONE Image 
+            File inside. Can Specify Which Image (moving.dcm) to Use as the 
+            Image to Make the Transformation Matrix.
+        moving_image_path (string): Path to the Moving Image.
+        number (string): Number of the Patient.
+
+    Returns:
+        (Void): None.
+    """
+    transform_files = compute_transform(fixed_image_path, os.path.join(directory_path, moving_image_path), number)
+    images = registration_manifest(number)
+    for task in labeled_image_tasks(number, transform_files, images):
+        transform_labeled_image(*task)
+    di.write_registration_manifest("RESULTS/" + number, images) # Written Last, so It Only Lists Finished Images
+
+@instrument(counts=lambda n_images: {"images": n_images})
+def register_patients(mappings, workers=1):
+    """
+    Registers many patients concurrently. Transforms are computed (or loaded
+    from the cache) one patient per worker, then every labeled image of every
+    patient is transformed in the same worker pool.
+
+    Args:
+        mappings (list): Tuples of (number, flair, perfusion), as in MAPPINGCSV.
+        workers (integer): Number of Processes to Use.
+
+    Returns:
+        (integer): Number of Labeled Images Registered.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        transforms = executor.map(compute_transform,
+            ["Patients/" + number + "/Perfusion/" + perfusion for (number, flair, perfusion) in mappings],
+            ["Patients/" + number + "/FLAIR/" + flair for (number, flair, perfusion) in mappings],
+            [number for (number, flair, perfusion) in mappings])
+        tasks = []
+        manifests = {}
+        for (number, flair, perfusion), transform_files in zip(mappings, transforms):
+            manifests[number] = registration_manifest(number)
+            tasks.extend(labeled_image_tasks(number, transform_files, manifests[number]))
+        if tasks:
+            list(executor.map(transform_labeled_image, *zip(*tasks), chunksize=8))
+    for number, images in manifests.items():
+        di.write_registration_manifest("RESULTS/" + number, images) # Written Last, so It Only Lists Finished Images
+    return len(tasks)
 
 def main():
     # ------------------------------------------------------------------------ #
     # Constructs Argument Parser for Parsing Arguments
     # ------------------------------------------------------------------------ #
-    if( (len(sys.argv) - 1) != 1):
-        print("One Argument Needed.")
-        print("USAGE: python2 register_images.py MAPPINGCSV")
-        exit()
-    
-    csv_mapping = sys.argv[1]
-    f = open(csv_mapping, 'r')
-
-    for line in f:
-        line = line.strip('\n')
-        line = line.split(',')
-        number = line[0]
-        flair = line[1]
-        perfusion = line[2]
-        fixed_path = "Patients/" + number + "/Perfusion/" + perfusion
-        directory_path = "Patients/" + number + "/FLAIR"
-        register_images(fixed_path, directory_path, flair, number)
+    parser = argparse.ArgumentParser(description="Registers labeled FLAIR images to the perfusion coordinate plane.")
+
+    parser.add_argument("mapping_csv", action="store", help="Indicate the path to a csv with rows of the form PATIENTNUMBER,FIXEDDICOM,MOVINGDICOM.")
+
+    parser.add_argument("-w", "--workers", action="store", type=int, default=1, help="The number of processes to register patients and transform labeled images in.")
+
+    args = parser.parse_args()
+
+    mappings = []
+    with open(args.mapping_csv, 'r') as f:
+        for line in f:
+            line = line.strip('\n')
+            line = line.split(',')
+            mappings.append((line[0], line[1], line[2]))
+
+    if args.workers > 1:
+        register_patients(mappings, args.workers)
+    else:
+        for number, flair, perfusion in mappings:
+            fixed_path = "Patients/" + number + "/Perfusion/" + perfusion
+            directory_path = "Patients/" + number + "/FLAIR"
+            register_images(fixed_path, directory_path, flair, number)
 
 if __name__ == "__main__":
     main()
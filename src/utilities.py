@@ -7,10 +7,14 @@
 #                David Macaraeg <dmacaraeg@g.ucla.edu>
 # :: Creation Date: 30 May 2019
 import os
+import warnings
 import numpy as np
+from itertools import islice
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 
+from feature_store import is_feature_store, open_feature_store
+
 def represents_int(s):
     """
     Determines if the given string represents an integer.
@@ -25,6 +29,290 @@ def represents_int(s):
     except ValueError:
         return False
 
+def csv_sidecar_path(filename):
+    """
+    Gives the path of the binary sidecar which caches the parsed contents of a CSV.
+
+    :param str filename: the path of a CSV file.
+    :return: the path of its sidecar, next to it.
+    :rtype: str
+    """
+    return filename + ".npy"
+
+_PARSE_BLOCK_BYTES = 1 << 21 # text held in memory at a time while parsing a whole CSV
+
+def parse_csv_text(text, dtype=np.float64, source="CSV"):
+    """
+    Parses the text of a purely numeric CSV in a single pass, using numpy's C tokenizer rather than np.loadtxt's per-line python loop,
+    so that no python object is created per value.
+    Every row must have the same number of columns (see condense_csvs.py --normalize).
+
+    :param str text: the CSV's rows, without any header.
+    :param dtype: the dtype to parse values as.
+    :param str source: where the text came from, for error messages.
+    :return: an array of shape (n_rows, n_cols)
+    :rtype: np.ndarray
+    """
+    text = text.strip()
+    if not text:
+        return np.empty((0, 0), dtype=dtype)
+    n_rows = text.count('\n') + 1
+    n_cols = text.split('\n', 1)[0].count(',') + 1
+    message = "{} is not a numeric CSV with {} columns in every row; normalize its column count first.".format(source, n_cols)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", DeprecationWarning) # older numpy only warns, and stops early, on unparseable values
+            data = np.fromstring(text.replace('\n', ','), dtype=dtype, sep=',')
+    except (ValueError, DeprecationWarning):
+        raise ValueError(message) from None
+    if data.size != n_rows * n_cols:
+        raise ValueError(message)
+    return data.reshape(n_rows, n_cols)
+
+def csv_shape(filename, skiprows=0):
+    """
+    Finds the shape of a numeric CSV without parsing it: its lines are counted in binary blocks, and its columns in its
+    first row. Blank lines are only discounted from the end of the file, so the row count is an upper bound.
+
+    :param str filename: the path of a CSV file.
+    :param int skiprows: the number of leading (header) lines to skip.
+    :return: a tuple of (n_rows, n_cols)
+    :rtype: tuple
+    """
+    n_lines = 0
+    trailing = 0 # newlines after the last non-blank character
+    has_rows = False
+    with open(filename, 'rb') as fid:
+        for block in iter(lambda: fid.read(1 << 20), b''):
+            n_lines += block.count(b'\n')
+            content = block.rstrip()
+            if content:
+                has_rows = True
+                trailing = block[len(content):].count(b'\n')
+            else:
+                trailing += block.count(b'\n')
+    if has_rows:
+        n_lines += 1 - trailing # the last row counts whether or not it ends in a newline, and blank lines after it don't
+    with open(filename, 'r') as fid:
+        for _ in range(skiprows):
+            fid.readline()
+        first = fid.readline().strip()
+    return max(n_lines - skiprows, 0), (first.count(',') + 1 if first else 0)
+
+def parse_csv_into(filename, out, skiprows=0, block_bytes=_PARSE_BLOCK_BYTES):
+    """
+    Parses a numeric CSV into a preallocated (or memory-mapped) array, about block_bytes of text at a time (see
+    parse_csv_text), so that only one block of text is ever held in memory, and no python object is created per row.
+
+    :param str filename: the path of a CSV file.
+    :param np.ndarray out: an array of shape (n_rows, n_cols), as from csv_shape.
+    :param int skiprows: the number of leading (header) lines to skip.
+    :param int block_bytes: the number of bytes of text to parse at a time; blocks always end at the end of a row.
+    :return: the number of rows of out filled.
+    :rtype: int
+    """
+    filled = 0
+    remainder = b''
+    with open(filename, 'rb') as fid:
+        for _ in range(skiprows):
+            fid.readline()
+        while True:
+            chunk = fid.read(block_bytes)
+            text = remainder + chunk
+            end = text.rfind(b'\n') + 1 if chunk else len(text) # the last block takes whatever is left
+            if not text:
+                break
+            text, remainder = text[:end], text[end:]
+            block = parse_csv_text(text.decode(), dtype=out.dtype, source=filename)
+            if block.size:
+                if block.shape[1] != out.shape[1] or filled + len(block) > len(out):
+                    raise ValueError("{} is not a numeric CSV with {} columns in every row; normalize its column count first.".format(filename, out.shape[1]))
+                out[filled:filled + len(block)] = block
+                filled += len(block)
+            if not chunk:
+                break
+    return filled
+
+def parse_csv(filename, skiprows=0, dtype=np.float64):
+    """
+    Parses a purely numeric CSV into one preallocated array, a block at a time (see parse_csv_into).
+
+    :param str filename: the path of a CSV file.
+    :param int skiprows: the number of leading (header) lines to skip.
+    :param dtype: the dtype to parse values as.
+    :return: an array of shape (n_rows, n_cols)
+    :rtype: np.ndarray
+    """
+    out = np.empty(csv_shape(filename, skiprows), dtype=dtype)
+    return out[:parse_csv_into(filename, out, skiprows)]
+
+def is_npy(filename):
+    """
+    Determines if the given path is a binary .npy array, rather than a CSV.
+
+    :param str filename:
+    :return: True if filename ends in .npy, else False.
+    :rtype: bool
+    """
+    return filename.endswith(".npy")
+
+def fresh_csv_sidecar(filename):
+    """
+    Finds the binary sidecar of a CSV, if it exists and is up to date.
+
+    :param str filename: the path of a CSV file.
+    :return: the path of the sidecar if it is newer than the CSV, else None.
+    :rtype: str
+    """
+    sidecar = csv_sidecar_path(filename)
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(filename):
+        return sidecar
+    return None
+
+def load_csv_matrix(filename, skiprows=0, cache=True):
+    """
+    Loads a numeric CSV as a float64 matrix, parsing it at most once.
+    When cache is True, the CSV is parsed a block at a time straight into a memory-mapped binary sidecar next to it (see
+    csv_sidecar_path, parse_csv_into), so the whole matrix is never held in memory, and later loads memory-map that
+    sidecar instead of parsing, for as long as it is newer than the CSV.
+    A .npy file (e.g. from condense_csvs.py --format npy) is memory-mapped as it is.
+
+    :param str filename: the path of a CSV file, or of a .npy array.
+    :param int skiprows: the number of leading (header) lines to skip, for a CSV.
+    :param bool cache: whether to read and write the binary sidecar.
+    :return: an array of shape (n_rows, n_cols), memory-mapped if cache is True or the file is a .npy array.
+    :rtype: np.ndarray
+    """
+    if is_npy(filename):
+        return np.load(filename, mmap_mode='r')
+    sidecar = fresh_csv_sidecar(filename) if cache else None
+    if sidecar is not None:
+        return np.load(sidecar, mmap_mode='r')
+    if not cache:
+        return parse_csv(filename, skiprows=skiprows)
+    sidecar = csv_sidecar_path(filename)
+    shape = csv_shape(filename, skiprows)
+    try:
+        out = np.lib.format.open_memmap(sidecar + ".tmp", mode='w+', dtype=np.float64, shape=shape) if shape[0] and shape[1] else None
+    except OSError:
+        print("WARNING: could not write CSV sidecar {}".format(sidecar))
+        return parse_csv(filename, skiprows=skiprows)
+    if out is None: # nothing to map
+        return parse_csv(filename, skiprows=skiprows)
+    try:
+        filled = parse_csv_into(filename, out, skiprows) # parsed straight into the sidecar, never all in memory
+        if filled != len(out): # blank lines were counted as rows, so the sidecar is rewritten at its true size
+            data = np.array(out[:filled])
+            del out
+            with open(sidecar + ".tmp", 'wb') as fid:
+                np.save(fid, data)
+        else:
+            out.flush()
+            del out
+    except BaseException:
+        os.remove(sidecar + ".tmp")
+        raise
+    os.replace(sidecar + ".tmp", sidecar)
+    return np.load(sidecar, mmap_mode='r')
+
+def iter_test_chunks(filename, chunk_size, header=0, predict_col=2):
+    """
+    Reads a test csv (or feature store) in blocks of at most chunk_size rows, split as Data.load_test would split it.
+    Only one block is held in memory at a time; a fresh binary sidecar or feature store is sliced rather than parsed.
+
+    :param str filename: the path of a test CSV or feature store, resolved as in Data.load_test.
+    :param int chunk_size: the maximum number of rows per block.
+    :param int header: the number of leading (header) lines to skip.
+    :param int predict_col: features are the columns after predict_col, which is the z coordinate's (2) in generate_csvs.py's test CSVs.
+    :return: a generator of (coords, X) tuples: an (n,3) array of x, y, z coordinates, and an (n,d) array of features.
+    """
+    dir = os.path.dirname(__file__)
+    f = os.path.join(dir, '..', 'data', filename)
+
+    if is_feature_store(f):
+        store = open_feature_store(f)
+        for start in range(0, store["header"]["rows"], chunk_size):
+            end = start + chunk_size
+            yield np.column_stack((store["coords"][start:end], store["slice"][start:end])), store["features"][start:end]
+        return
+
+    sidecar = fresh_csv_sidecar(f)
+    if sidecar is not None:
+        data = np.load(sidecar, mmap_mode='r')
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size, :3], data[start:start + chunk_size, predict_col + 1:]
+        return
+
+    with open(f, 'r') as fid:
+        for _ in range(header):
+            fid.readline()
+        while True:
+            lines = list(islice(fid, chunk_size))
+            if not lines:
+                break
+            data = parse_csv_text(''.join(lines), source=f)
+            yield data[:, :3], data[:, predict_col + 1:]
+
+def split_labels(data, predict_col):
+    """
+    Separates a block of training rows into features and labels, as views into data wherever possible.
+
+    :param np.ndarray data: an array of shape (n, n_cols).
+    :param int predict_col: the column holding labels, or None if there are none.
+    :return: a tuple of (X, y); y is None if predict_col is, and X is None if data has no other column.
+    :rtype: tuple
+    """
+    if predict_col is None:
+        return data[:,:], None
+    n_cols = data.shape[1]
+    if n_cols <= 1:
+        return None, data[:,0]
+    if predict_col in (0, -n_cols):
+        X = data[:,1:]
+    elif predict_col in (-1, n_cols - 1):
+        X = data[:,:-1]
+    else:
+        X = np.delete(data, predict_col, axis=1)
+    return X, data[:,predict_col]
+
+def iter_training_chunks(filename, chunk_size, header=0, predict_col=-1):
+    """
+    Reads a training csv (or feature store) in blocks of at most chunk_size rows, split as Data.load would split it.
+    Only one block is held in memory at a time; a fresh binary sidecar or feature store is sliced rather than parsed,
+    and a CSV without one is streamed, without writing a sidecar (which would need the whole CSV in memory).
+
+    :param str filename: the path of a training CSV, .npy array or feature store, resolved as in Data.load.
+    :param int chunk_size: the maximum number of rows per block.
+    :param int header: the number of leading (header) lines to skip.
+    :param int predict_col: the column holding labels.
+    :return: a generator of (X, y) tuples: an (n,d) array of features, and an (n,) array of labels.
+    """
+    dir = os.path.dirname(__file__)
+    f = os.path.join(dir, '..', 'data', filename)
+
+    if is_feature_store(f):
+        store = open_feature_store(f)
+        for start in range(0, store["header"]["rows"], chunk_size):
+            end = start + chunk_size
+            yield store["features"][start:end], store["label"][start:end]
+        return
+
+    sidecar = f if is_npy(f) else fresh_csv_sidecar(f)
+    if sidecar is not None:
+        data = np.load(sidecar, mmap_mode='r')
+        for start in range(0, len(data), chunk_size):
+            yield split_labels(data[start:start + chunk_size], predict_col)
+        return
+
+    with open(f, 'r') as fid:
+        for _ in range(header):
+            fid.readline()
+        while True:
+            lines = list(islice(fid, chunk_size))
+            if not lines:
+                break
+            yield split_labels(parse_csv_text(''.join(lines), source=f), predict_col)
+
 class Data:
     def __init__(self) :
         """
@@ -43,32 +331,28 @@ class Data:
         self.Xnames = None
         self.yname = None
 
-    def load(self, filename, header=0, predict_col=-1) :
-        """Load csv file into X array of features and y array of labels."""
+    def load(self, filename, header=0, predict_col=-1, cache=True) :
+        """
+        Load csv file into X array of features and y array of labels.
+        The csv is parsed at most once, and cached in a binary sidecar if cache is True (see load_csv_matrix).
+        """
         
         # determine filename
         dir = os.path.dirname(__file__)
         f = os.path.join(dir, '..', 'data', filename)
+
+        if is_feature_store(f):
+            self.load_feature_store(f)
+            return
         
         # load data
-        with open(f, 'r') as fid :
-            data = np.loadtxt(fid, delimiter=",", skiprows=header)
+        data = load_csv_matrix(f, skiprows=header, cache=cache)
         
-        # separate features and labels
-        if predict_col is None:
-            self.X = data[:,:]
-            self.y = None
-        else:
-            if data.ndim > 1:
-                self.X = np.delete(data, predict_col, axis=1)
-                # self.y = data[:,predict_col]
-                self.y = data[:,predict_col]
-            else:
-                self.X = None
-                self.y = data[:]
+        # separate features and labels, as views into data wherever possible
+        self.X, self.y = split_labels(data, predict_col)
         
         # load feature and label names
-        if header != 0:
+        if header != 0 and not is_npy(f):
             with open(f, 'r') as fid :
                 header = fid.readline().rstrip().split(",")
                 
@@ -86,27 +370,45 @@ class Data:
             self.Xnames = None
             self.yname = None
 
-    def load_test(self, filename, header=0, predict_col=-1):
-        """Load csv file into X array of features and y array of labels."""
+    def load_test(self, filename, header=0, predict_col=2, cache=True):
+        """
+        Load csv file into X array of features (the columns after predict_col, by default those after z) and y array of x, y, z coordinates.
+        The csv is parsed at most once, and cached in a binary sidecar if cache is True (see load_csv_matrix).
+        """
         
         # determine filename
         dir = os.path.dirname(__file__)
         f = os.path.join(dir, '..', 'data', filename)
 
+        if is_feature_store(f):
+            self.load_feature_store(f, test=True)
+            return
+
         self.Xnames = None
         self.yname = None
         
         # load data
-        with open(f, 'r') as fid:
-            data1 = np.loadtxt(fid, delimiter=",", skiprows=header, usecols=(0,1,2))
-            fid.close()
-        with open(f, 'r') as fid:
-            data = np.loadtxt(fid, delimiter=",", skiprows=header)
+        data = load_csv_matrix(f, skiprows=header, cache=cache)
 
+        # x, y, z coordinates, and the features past predict_col, as views into data
+        self.X = data[:,predict_col + 1:]
+        self.y = data[:,:3]
 
-        l = range(0, predict_col + 1)
-        self.X = np.delete(data, l, axis=1)
-        self.y = data1
+    def load_feature_store(self, path, test=False):
+        """
+        Memory-map a feature store (see feature_store.py) into X array of features and y array of labels.
+        Nothing is parsed; X and labels are read from disk on demand.
+        If test is True, y is instead the (n,3) array of x, y, z coordinates, matching load_test.
+        """
+        store = open_feature_store(path)
+        self.X = store["features"]
+        self.Xnames = store["header"]["feature_names"]
+        if test:
+            self.y = np.column_stack((store["coords"], store["slice"]))
+            self.yname = None
+        else:
+            self.y = store["label"]
+            self.yname = "Healthy"
         
 
 # helper functions
@@ -116,7 +418,7 @@ def load_model_data(filename, header=0, predict_col=-1):
     data.load(filename, header=header, predict_col=predict_col)
     return data
 
-def load_model_test(filename, header=0, predict_col=-1):
+def load_model_test(filename, header=0, predict_col=2):
     """Load csv file into Data class."""
     data = Data()
     data.load_test(filename, header=header, predict_col=predict_col)
@@ -0,0 +1,20 @@
+# :: conftest.py
+#####################################################
+# Puts src/ on the path, so tests import modules the
+# way the scripts in src/ import each other.
+#####################################################
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest
+
+
+@pytest.fixture
+def study(tmp_path):
+    """A small synthetic study of 2 patients (see benchmark.generate_synthetic_study), in tmp_path/Patients."""
+    import benchmark
+    directory = tmp_path / "Patients"
+    benchmark.generate_synthetic_study(str(directory), patients=2, slices=3, times=12, size=32, seed=0)
+    return directory
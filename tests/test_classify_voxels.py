@@ -0,0 +1,65 @@
+# :: test_classify_voxels.py
+#####################################################
+# Checks streamed training, and patient-grouped
+# cross-validation, on small separable data sets.
+#####################################################
+import numpy as np
+import pytest
+from sklearn import metrics
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+
+import classify_voxels as cv
+import generate_csvs as gc
+
+
+def write_training_csv(path, n=300, seed=0):
+    random_state = np.random.RandomState(seed)
+    X = random_state.rand(n, 4) * 100
+    y = (X[:, 0] + X[:, 1] > 100).astype(int)
+    np.savetxt(str(path), np.column_stack((y, X)), delimiter=",", fmt="%.6f", header="Healthy,PixelDensity", comments="")
+    return str(path), X, y
+
+
+def test_fit_streaming_matches_whole_data_statistics(tmp_path):
+    training_csv, X, y = write_training_csv(tmp_path / "patient_1_training.csv")
+    pipeline, n = cv.fit_streaming(SGDClassifier(loss="hinge", random_state=0), training_csv, chunk_size=64, epochs=20)
+    assert n == len(y)
+    scaler = pipeline.named_steps["scaler"]
+    np.testing.assert_allclose(scaler.mean_, X.mean(axis=0), rtol=1e-5)
+    np.testing.assert_allclose(scaler.var_, X.var(axis=0), rtol=1e-5)
+    f1 = cv.streaming_f1_score(pipeline, training_csv, chunk_size=64)
+    assert f1 == pytest.approx(metrics.f1_score(y, pipeline.predict(X)))
+    assert f1 > 0.9
+
+
+def test_grouped_error_round_trip_through_generated_patients(study, tmp_path):
+    output_dir = tmp_path / "csvs"
+    output_dir.mkdir()
+    rows = {}
+    for patient in (1, 2):
+        summary = gc.process_patient(str(study / str(patient)), str(patient), 10, 40, 40, seed=0, output_dir=str(output_dir))
+        rows[patient] = summary["training_rows"]
+
+    blocks = cv.load_patient_blocks(str(output_dir))
+    assert list(blocks) == [1, 2]
+    assert {patient: len(y) for patient, (X, y) in blocks.items()} == rows
+    scores = cv.grouped_error(LogisticRegression(), blocks, return_folds=True)
+    folds = scores[-1]
+    assert folds["test_patients"] == [[1], [2]] # leave-one-patient-out
+
+    # the first fold trains on patient 2 alone, and tests on patient 1 alone
+    X_train, y_train = blocks[2]
+    X_test, y_test = blocks[1]
+    pipeline = cv.make_model_pipeline(LogisticRegression()).fit(X_train, y_train)
+    assert folds["test_accuracy"][0] == pytest.approx(100 * metrics.accuracy_score(y_test, pipeline.predict(X_test)))
+    assert scores[3] == pytest.approx(folds["test_accuracy"].mean())
+
+
+def test_patient_folds_balance_voxels():
+    blocks = {patient: (None, np.zeros(size)) for patient, size in zip(range(1, 6), (50, 10, 40, 30, 20))}
+    folds = cv.patient_folds(blocks, n_folds=2)
+    assert sorted(sum(folds, [])) == [1, 2, 3, 4, 5] # every patient is tested exactly once
+    assert sorted(sum(len(blocks[patient][1]) for patient in fold) for fold in folds) == [70, 80]
+    assert cv.patient_folds(blocks) == [[1], [2], [3], [4], [5]]
+    with pytest.raises(ValueError):
+        cv.patient_folds({1: blocks[1]})
@@ -0,0 +1,38 @@
+# :: test_condense_csvs.py
+#####################################################
+# Condenses small training CSVs, including ones which
+# generate_csvs.py appended to more than once.
+#####################################################
+import numpy as np
+
+import condense_csvs as cc
+
+
+def write(path, text):
+    path.write_text(text)
+    return str(path)
+
+
+def test_appended_header_with_a_name_per_column_is_skipped(tmp_path):
+    write(tmp_path / "patient_1_training.csv", "A,B,C\n1,2,3\nA,B,C\n0,40,50\n")
+    reports = cc.condense_csvs(str(tmp_path), 2)
+    assert reports[0]["columns"] == {3: 2, "non-numeric": 1}
+    assert reports[0]["kept"] == 2
+    lines = (tmp_path / "condensed.csv").read_text().splitlines()
+    assert lines == ["Healthy,B,C", "1,2.0,3.0", "0,40.0,50.0"]
+
+
+def test_ragged_rows_are_truncated_and_padded(tmp_path):
+    write(tmp_path / "patient_1_training.csv", "Healthy,PixelDensity\n1,2,3,4\nHealthy,PixelDensity\n0,40\n")
+    write(tmp_path / "patient_2_training.csv", "Healthy,PixelDensity\n1,5,6,7\n")
+    reports = cc.condense_csvs(str(tmp_path), 2, output_format="npy", fill=-1.0)
+    assert [report["kept"] for report in reports] == [2, 1]
+    assert reports[0]["columns"]["non-numeric"] == 1
+    np.testing.assert_array_equal(np.load(str(tmp_path / "condensed.npy")), [[1, 2, 3], [0, 40, -1], [1, 5, 6]])
+
+
+def test_background_rows_are_dropped(tmp_path):
+    write(tmp_path / "patient_1_training.csv", "Healthy,PixelDensity\n1,2,300\n0,40,50\n")
+    reports = cc.condense_csvs(str(tmp_path), 2, background=30.0)
+    assert reports[0]["kept"] == 1
+    assert (tmp_path / "condensed.csv").read_text().splitlines()[1:] == ["0,40.0,50.0"]
@@ -0,0 +1,56 @@
+# :: test_data_processing.py
+#####################################################
+# Checks the hemodynamic summaries of intensity curves
+# against analytic contrast curves.
+#####################################################
+import numpy as np
+import pytest
+
+import data_processing as dp
+
+
+def gamma_variate(seconds, onset=5.0, alpha=3.0, beta=4.0, scale=10.0):
+    """A contrast bolus, peaking alpha * beta seconds after its onset."""
+    t = np.clip(seconds - onset, 0, None)
+    return scale * t ** alpha * np.exp(-t / beta)
+
+
+def test_acquisition_seconds_crosses_minutes():
+    assert dp.acquisition_seconds([115958.5, 120001.0, 120100.0]).tolist() == [0.0, 2.5, 61.5]
+
+
+def test_hemodynamic_features_of_a_gamma_variate():
+    seconds = np.arange(60.0)
+    times = 120000 + seconds # HHMMSS, all within one minute
+    bolus = gamma_variate(seconds)
+    curves = np.vstack((100 + bolus, 200 - bolus, np.full(len(seconds), 50.0)))
+
+    features = dp.hemodynamic_features(times, curves)
+    assert features.shape == (3, len(dp.HEMODYNAMIC_FEATURES))
+    named = dict(zip(dp.feature_names("hemodynamic", 0), features[0]))
+    assert named["Baseline"] == pytest.approx(100)
+    assert named["TimeToPeak"] == pytest.approx(5 + 3 * 4)
+    assert named["PeakEnhancement"] == pytest.approx(bolus.max())
+    assert named["AreaUnderCurve"] == pytest.approx(np.trapezoid(bolus, seconds))
+    assert named["MeanTransitTime"] == pytest.approx(np.trapezoid(bolus * seconds, seconds) / np.trapezoid(bolus, seconds))
+    assert named["BloodFlow"] == pytest.approx(named["AreaUnderCurve"] / named["MeanTransitTime"])
+    assert named["WashInSlope"] == pytest.approx(np.diff(bolus).max())
+    assert named["WashOutSlope"] == pytest.approx(np.diff(bolus).min())
+
+    # a signal drop is only enhancement when asked for; a flat curve never is
+    assert features[1, 2] == 0 and (features[2, 2:] == 0).all()
+    dropped = dp.hemodynamic_features(times, curves[1:2], signal_drop=True)
+    assert np.allclose(dropped[0, 1:], features[0, 1:])
+
+
+def test_feature_names_match_extracted_columns():
+    seconds = np.arange(12.0)
+    slice_volume = np.random.RandomState(0).rand(len(seconds), 8, 8) * 100
+    rows, cols = np.array([0, 3, 7]), np.array([1, 4, 7])
+    maps = dp.neighbourhood_maps(slice_volume, 3)
+    for features, sample_count in (("intensities", 5), ("hemodynamic", 5)):
+        values = dp.extract_slice_features(seconds, slice_volume, rows, cols, sample_count, features, neighbourhood_stats=maps)
+        assert values.shape == (3, len(dp.feature_names(features, sample_count, neighbourhood=3)))
+        assert np.array_equal(values[:, -len(dp.NEIGHBOURHOOD_FEATURES):], maps[:, rows, cols].T)
+    with pytest.raises(ValueError, match="Unknown feature set"):
+        dp.extract_features(seconds, slice_volume[:, rows, cols].T, 5, "perfusion")
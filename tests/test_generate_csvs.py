@@ -0,0 +1,77 @@
+# :: test_generate_csvs.py
+#####################################################
+# Checks the sampling of labeled pixels, and the
+# caches generate_csvs.py keeps in its output directory.
+#####################################################
+import os
+
+import numpy as np
+
+import dicom_index as di
+import generate_csvs as gc
+
+
+def labeled_slice():
+    pixels = np.zeros((20, 20), dtype=np.int16)
+    pixels[5:10, 5:10] = 1 # 25 dead pixels
+    return pixels
+
+
+def test_sample_pixel_array_splits_live_and_dead():
+    pixels = labeled_slice()
+    live, dead = gc.sample_pixel_array(pixels, 30, 10, np.random.RandomState(0))
+    assert live.shape == (30, 2) and dead.shape == (10, 2)
+    assert (pixels[dead[:, 1], dead[:, 0]] > 0).all() # coordinates are (x, y)
+    assert (pixels[live[:, 1], live[:, 0]] == 0).all()
+    assert len({tuple(coord) for coord in live}) == 30 # sampled without replacement
+
+
+def test_sample_pixel_array_makes_up_dead_shortfall_with_live_pixels():
+    live, dead = gc.sample_pixel_array(labeled_slice(), 30, 40, np.random.RandomState(0))
+    assert len(dead) == 25
+    assert len(live) == 30 + 15
+
+
+def test_seeded_sampling_is_reproducible():
+    flairs = {5.0: labeled_slice(), -5.0: labeled_slice()}
+    first = gc.sample_labeled_flairs(flairs, 10, 10, np.random.RandomState(7))
+    second = gc.sample_labeled_flairs(dict(reversed(list(flairs.items()))), 10, 10, np.random.RandomState(7))
+    assert list(first) == [-5.0, 5.0]
+    for slice_loc in first:
+        for ours, theirs in zip(first[slice_loc], second[slice_loc]):
+            np.testing.assert_array_equal(ours, theirs)
+
+
+def test_alignment_is_cached_outside_the_study_and_reused(study, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    flair_directory, perfusion_directory = str(study / "1" / "FLAIR"), str(study / "1" / "Perfusion")
+    before = sorted(path.name for path in study.rglob("*"))
+    alignment = gc.align_patient_slices("1", cache_dir, flair_directory, perfusion_directory)
+    assert sorted(alignment.values()) == [0, 1, 2]
+    assert sorted(path.name for path in study.rglob("*")) == before # nothing written to the study
+
+    calls = []
+    align_slices = gc.align_slices
+    monkeypatch.setattr(gc, "align_slices", lambda *args: calls.append(args) or align_slices(*args))
+    assert gc.align_patient_slices("1", cache_dir, flair_directory, perfusion_directory) == alignment
+    assert not calls # unchanged inputs reuse the cached alignment
+    gc.align_patient_slices("1", cache_dir, flair_directory, perfusion_directory, tolerance=1.0)
+    assert len(calls) == 1 # a new tolerance invalidates it
+
+
+def test_dicom_index_is_cached_and_refreshed_per_changed_file(study, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    perfusion_directory = str(study / "1" / "Perfusion")
+    index = di.index_directory(perfusion_directory, cache_dir=cache_dir)
+    assert os.path.exists(di.index_path(perfusion_directory, cache_dir))
+    assert not os.path.exists(os.path.join(perfusion_directory, di.INDEX_FILE))
+
+    read = []
+    read_dicom_header = di.read_dicom_header
+    monkeypatch.setattr(di, "read_dicom_header", lambda path: read.append(path) or read_dicom_header(path))
+    assert di.index_directory(perfusion_directory, cache_dir=cache_dir) == index
+    assert not read # nothing changed, so no header is re-read
+    changed = os.path.join(perfusion_directory, sorted(index)[0])
+    os.utime(changed, ns=(0, 0))
+    di.index_directory(perfusion_directory, cache_dir=cache_dir)
+    assert read == [changed]
@@ -0,0 +1,38 @@
+# :: test_image_processing.py
+#####################################################
+# Checks that the brain mask keeps each slice's own
+# largest region.
+#####################################################
+import numpy as np
+
+import image_processing as ip
+
+
+def disc(shape, centre, radius):
+    rows, cols = np.ogrid[:shape[0], :shape[1]]
+    return (rows - centre[0]) ** 2 + (cols - centre[1]) ** 2 <= radius ** 2
+
+
+def test_brain_mask_keeps_each_slices_largest_region():
+    shape = (40, 40)
+    brains = [disc(shape, (12, 12), 8), disc(shape, (27, 27), 8), disc(shape, (20, 8), 5)] # a different place on every slice
+    others = [disc(shape, (30, 30), 4), disc(shape, (10, 30), 4), np.zeros(shape, dtype=bool)]
+    means = np.zeros((3,) + shape)
+    for slice_idx, (brain, other) in enumerate(zip(brains, others)):
+        means[slice_idx][brain | other] = 100
+    means[0, 12, 12] = 0 # a dark lesion, filled back in
+    means[1, 2, 2] = 100 # a speck of noise, opened away
+    volume = np.repeat(means[:, np.newaxis], 4, axis=1) # constant over 4 time points
+
+    mask = ip.brain_mask(volume)
+    for slice_idx, brain in enumerate(brains): # the smallest, on the last slice, isn't dropped
+        assert not (mask[slice_idx] & ~brain).any() # nor is the other region, nor the speck, kept
+        assert mask[slice_idx].sum() > 0.9 * brain.sum() # the opening only rounds off the edges
+    assert mask[0, 12, 12]
+
+
+def test_brain_mask_without_threshold_keeps_any_signal():
+    volume = np.zeros((2, 3, 5, 5))
+    volume[0, 2, 1, 1] = 1
+    mask = ip.brain_mask(volume, threshold=0)
+    assert mask.sum() == 1 and mask[0, 1, 1]
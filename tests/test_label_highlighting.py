@@ -0,0 +1,27 @@
+# :: test_label_highlighting.py
+#####################################################
+# Checks that lesion masks land on the perfusion slice
+# at their own slice location.
+#####################################################
+import numpy as np
+
+import label_highlighting as lh
+
+
+def test_prediction_csv_skipping_a_slice(tmp_path):
+    # perfusion slices at -10, -5, 0 and 5; the CSV has no rows at -5 or 0, e.g. as they were all background
+    prediction_csv = tmp_path / "1_stroke_output.csv"
+    prediction_csv.write_text("1,2,-10,1\n3,3,-10,0\n0,1,5,1\n")
+    mask_locations, masks = lh.build_lesion_masks(str(prediction_csv), (4, 4))
+    by_slice = lh.masks_by_slice(mask_locations, masks, [-10.0, -5.0, 0.0, 5.0])
+    assert by_slice.shape == (4, 4, 4)
+    assert by_slice[0, 1, 2] and by_slice[0].sum() == 1
+    assert not by_slice[1].any() and not by_slice[2].any()
+    assert by_slice[3, 0, 1] and by_slice[3].sum() == 1
+
+
+def test_empty_prediction_csv(tmp_path):
+    prediction_csv = tmp_path / "1_stroke_output.csv"
+    prediction_csv.write_text("")
+    mask_locations, masks = lh.build_lesion_masks(str(prediction_csv), (4, 4))
+    assert not lh.masks_by_slice(mask_locations, masks, [-5.0, 0.0]).any()
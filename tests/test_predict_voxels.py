@@ -0,0 +1,67 @@
+# :: test_predict_voxels.py
+#####################################################
+# Round trips a synthetic study through generate_csvs,
+# a trained pipeline, and predict_voxels.
+#####################################################
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+
+import benchmark
+import classify_voxels as cv
+import data_processing as dp
+import generate_csvs as gc
+import predict_voxels as pv
+from utilities import load_model_data, load_model_test
+
+SAMPLE_COUNT = 10
+
+
+def generate(tmp_path, output_format, **options):
+    study = tmp_path / "Patients"
+    output_dir = tmp_path / output_format
+    output_dir.mkdir()
+    if not study.exists():
+        benchmark.generate_synthetic_study(str(study), patients=1, slices=2, times=12, size=32, seed=0)
+    gc.process_patient(str(study / "1"), "1", SAMPLE_COUNT, 40, 40, output_format, seed=0, output_dir=str(output_dir), **options)
+    return output_dir
+
+
+def test_test_csv_features_match_training_and_store(tmp_path):
+    csv_dir = generate(tmp_path, "csv")
+    store_dir = generate(tmp_path, "store")
+    training = load_model_data(str(csv_dir / "patient_1_training.csv"), header=1, predict_col=0)
+    test = load_model_test(str(csv_dir / "patient_1_test.csv"), header=1)
+    store = load_model_test(str(store_dir / "patient_1_test.features"))
+    assert training.X.shape[1] == test.X.shape[1] == SAMPLE_COUNT
+    np.testing.assert_allclose(test.X, store.X)
+    np.testing.assert_array_equal(test.y, store.y)
+
+
+def test_predict_from_generated_csv_and_store(tmp_path):
+    csv_dir = generate(tmp_path, "csv")
+    store_dir = generate(tmp_path, "store")
+    training = load_model_data(str(csv_dir / "patient_1_training.csv"), header=1, predict_col=0)
+    pipeline = cv.make_model_pipeline(LogisticRegression()).fit(training.X, training.y)
+    csv_predictions = tmp_path / "from_csv.csv"
+    store_predictions = tmp_path / "from_store.csv"
+    n = pv.predict_in_chunks(pipeline, str(csv_dir / "patient_1_test.csv"), str(csv_predictions), chunk_size=100)
+    assert n == len(load_model_test(str(csv_dir / "patient_1_test.csv"), header=1).y)
+    assert pv.predict_in_chunks(pipeline, str(store_dir / "patient_1_test.features"), str(store_predictions), chunk_size=100) == n
+    np.testing.assert_array_equal(np.loadtxt(str(csv_predictions), delimiter=","), np.loadtxt(str(store_predictions), delimiter=","))
+
+
+def test_neighbourhood_features_predict_the_same_from_csv_and_perfusion(tmp_path):
+    csv_dir = generate(tmp_path, "csv", neighbourhood=3)
+    training = load_model_data(str(csv_dir / "patient_1_training.csv"), header=1, predict_col=0)
+    assert training.X.shape[1] == SAMPLE_COUNT + len(dp.NEIGHBOURHOOD_FEATURES)
+    pipeline = cv.make_model_pipeline(LogisticRegression()).fit(training.X, training.y)
+    csv_predictions = tmp_path / "from_csv.csv"
+    pv.predict_in_chunks(pipeline, str(csv_dir / "patient_1_test.csv"), str(csv_predictions), chunk_size=100)
+    labels, slice_locations = pv.predict_volume(pipeline, str(tmp_path / "Patients" / "1" / "Perfusion"), chunk_size=100, neighbourhood=3)
+
+    predicted = np.loadtxt(str(csv_predictions), delimiter=",")
+    rows, cols = predicted[:, 0].astype(int), predicted[:, 1].astype(int)
+    slices = np.searchsorted(slice_locations, predicted[:, 2])
+    assert np.allclose(slice_locations[slices], predicted[:, 2])
+    np.testing.assert_array_equal(labels[slices, rows, cols], predicted[:, 3])
+    assert len(np.unique(predicted[:, 3])) == 2 # both classes are predicted, so the comparison means something
@@ -0,0 +1,62 @@
+# :: test_utilities.py
+#####################################################
+# Checks the block-wise CSV parser, and its sidecar,
+# against np.loadtxt.
+#####################################################
+import os
+
+import numpy as np
+import pytest
+
+import utilities
+
+
+def write_csv(path, data, header="Healthy,PixelDensity"):
+    np.savetxt(str(path), data, delimiter=",", fmt="%.6f", header=header, comments="")
+    return str(path)
+
+
+@pytest.fixture
+def csv_data(tmp_path):
+    data = np.random.RandomState(0).rand(500, 7) * 1000
+    return write_csv(tmp_path / "patient_1_training.csv", data)
+
+
+@pytest.mark.parametrize("block_bytes", [16, 1000, utilities._PARSE_BLOCK_BYTES])
+def test_parse_csv_into_matches_loadtxt(csv_data, block_bytes):
+    expected = np.loadtxt(csv_data, delimiter=",", skiprows=1)
+    out = np.empty(utilities.csv_shape(csv_data, skiprows=1))
+    assert utilities.parse_csv_into(csv_data, out, skiprows=1, block_bytes=block_bytes) == len(expected)
+    np.testing.assert_array_equal(out, expected)
+
+
+def test_parse_csv_matches_loadtxt(csv_data):
+    parsed = utilities.parse_csv(csv_data, skiprows=1)
+    assert parsed.dtype == np.float64
+    np.testing.assert_array_equal(parsed, np.loadtxt(csv_data, delimiter=",", skiprows=1))
+
+
+def test_load_csv_matrix_writes_and_reuses_a_sidecar(csv_data):
+    expected = np.loadtxt(csv_data, delimiter=",", skiprows=1)
+    os.utime(csv_data, (0, 0)) # so the sidecar is always newer
+    parsed = utilities.load_csv_matrix(csv_data, skiprows=1)
+    assert isinstance(parsed, np.memmap) and parsed.dtype == np.float64
+    np.testing.assert_array_equal(parsed, expected)
+    assert utilities.fresh_csv_sidecar(csv_data) is not None
+    np.testing.assert_array_equal(utilities.load_csv_matrix(csv_data, skiprows=1), expected)
+
+
+def test_csv_shape_ignores_trailing_blank_lines(tmp_path):
+    path = tmp_path / "blank.csv"
+    path.write_text("Healthy,PixelDensity\r\n1,2\r\n3,4\r\n\r\n\r\n")
+    assert utilities.csv_shape(str(path), skiprows=1) == (2, 2)
+    np.testing.assert_array_equal(utilities.load_csv_matrix(str(path), skiprows=1), [[1, 2], [3, 4]])
+
+
+@pytest.mark.parametrize("text", ["1,2,3\n4,5\n", "1,2,3\n4,A,6\n", "1,,3\n"])
+def test_malformed_csv_asks_to_normalize(tmp_path, text):
+    path = tmp_path / "bad.csv"
+    path.write_text(text)
+    with pytest.raises(ValueError, match="normalize its column count"):
+        utilities.load_csv_matrix(str(path))
+    assert not os.path.exists(utilities.csv_sidecar_path(str(path)) + ".tmp")